@@ -0,0 +1,310 @@
+import asyncio
+import os
+import threading
+import time
+from server import HANDSHAKE_TIMEOUT, ChatServer, clean_filename, set_keepalive
+from eventlog import WARNING, event_log
+from protocol import STREAM_CHUNK, clamp_range, requested_ranges
+from outbound import AsyncOutboundQueue, FileRange, batch_bytes
+
+class AsyncChatServer(ChatServer):
+    # Event-loop version of ChatServer: every connection is a coroutine on a
+    # single asyncio loop instead of an OS thread. Clients are keyed by their
+    # StreamWriter; the chat logic (TEXT_MESSAGE, WHISPER, user list) is shared
+    # with the threaded server, only the socket I/O is overridden here.
+    def __init__(self, *args, **kwargs):
+        self.server = None
+        self.loop = None
+        self.writer_tasks = set()
+        # Bus events that arrive before the loop is running
+        self.bus_lock = threading.Lock()
+        self.early_bus_events = []
+        super().__init__(*args, **kwargs)
+
+    def start(self):
+        # Nothing runs until serve_forever starts accepting on the loop
+        pass
+
+    async def serve_forever(self):
+        with self.bus_lock:
+            self.loop = asyncio.get_running_loop()
+            for event in self.early_bus_events:
+                self.loop.call_soon(super().dispatch_bus_event, event)
+            self.early_bus_events = []
+        self.timer_task = asyncio.create_task(self.run_timers())
+        # The listening socket was bound in ChatServer.__init__
+        self.server = await asyncio.start_server(self.handle_client, sock=self.server_socket)
+        event_log.log("server_started", f"Server started on {self.host}:{self.port} (asyncio)",
+                      host=self.host, port=self.port, mode="asyncio", pid=os.getpid())
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def run_timers(self):
+        # The timer wheel ticks on the loop, so its callbacks run there too
+        while self.running:
+            await asyncio.sleep(self.timers.tick)
+            self.fire_timers()
+
+    async def handle_client(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        event_log.log("connection_opened", f"Connection from {address}", address=address)
+        self.metrics.connections.inc()
+        try:
+            # Get nickname first; a client that does not send it in time is
+            # closed, which ends the read
+            deadline = self.set_timer(HANDSHAKE_TIMEOUT, lambda: self.close_client(writer))
+            nickname_data = await reader.read(1024)
+            self.timers.cancel(deadline)
+            if not nickname_data:
+                raise ConnectionError("No nickname received")
+
+            nickname = self.register_client(writer, nickname_data, address)
+            info = self.clients[writer]
+            info['reader'] = reader
+            framed = info['framed']
+            decoder = info['decoder']
+
+            # Send user list and announce the join
+            self.client_joined(writer, nickname)
+
+            # Main message loop
+            recv_size = 65536 if framed else 4096
+            while True:
+                try:
+                    # Handle every complete message already buffered, then read more
+                    for message in decoder.messages():
+                        message_type = self.received(message)
+                        wait = self.throttle(writer, message)
+                        if wait is None:
+                            continue
+                        if wait:
+                            # Not reading meanwhile: TCP pushes back on the sender
+                            await asyncio.sleep(wait)
+                        started = time.perf_counter()
+                        await self.handle_message(writer, nickname, message)
+                        elapsed = time.perf_counter() - started
+                        self.metrics.handler.observe(elapsed, message_type)
+                        if self.profiler is not None:
+                            self.profiler.handled(message_type, nickname, elapsed)
+                    # read() returns without suspending while data is buffered,
+                    # so yield explicitly to let the writer tasks drain
+                    await asyncio.sleep(0)
+
+                    data = await reader.read(recv_size)
+                    if not data:
+                        break
+                    info['last_seen'] = time.monotonic()
+                    self.metrics.bytes_in.inc(amount=len(data))
+                    decoder.feed(data)
+
+                except ConnectionResetError:
+                    break
+
+        except Exception as e:
+            self.client_error(writer, e)
+        finally:
+            self.remove_client(writer)
+
+    async def handle_message(self, client, nickname, message):
+        # File transfers and history need to await; everything else is plain
+        # fan-out and goes through the shared implementation.
+        if message['type'] == 'FILE_METADATA':
+            if not self.may_share_in(client, message):
+                return
+            if self.reuse_content(client, nickname, message):
+                return
+            if self.uses_streams(client, message):
+                await self.start_upload(client, nickname, message)
+            else:
+                await self.handle_file_upload(client, nickname, message)
+        elif message['type'] == 'FILE_REQUEST':
+            stream = message['stream'] if self.uses_streams(client, message) else None
+            codec = self.download_codec(client, message) if stream is not None else None
+            for offset, length in requested_ranges(message):
+                await self.handle_file_download(client, message['filename'], offset, length,
+                                                stream, codec)
+        elif message['type'] in ('HISTORY', 'SEARCH'):
+            # Reading the log and the index must not hold up the loop
+            info = self.clients.get(client)
+            if info is not None:
+                if message['type'] == 'HISTORY':
+                    reply = await asyncio.to_thread(self.history_page, info, message)
+                else:
+                    reply = await asyncio.to_thread(self.search_results, info, message)
+                self.send_to_client(client, reply)
+        else:
+            super().handle_message(client, nickname, message)
+
+    async def start_upload(self, client, nickname, metadata):
+        # A resumed upload's partial file is hashed again; keep that off the loop
+        try:
+            filesize = int(metadata['size'])
+            safe_filename = clean_filename(metadata['filename'])
+            self.take_over_transfer(metadata.get('transfer'))
+            upload_file = await asyncio.to_thread(self.open_upload, metadata.get('transfer'), filesize)
+        except (OSError, ValueError) as e:
+            self.upload_failed(client, metadata['stream'], e)
+            return
+        self.upload_ready(client, nickname, metadata, safe_filename, filesize, upload_file)
+
+    async def handle_file_upload(self, client, nickname, metadata):
+        reader = self.clients[client]['reader']
+        decoder = self.clients[client]['decoder']
+        upload = None
+        try:
+            filesize = int(metadata['size'])
+            safe_filename = clean_filename(metadata['filename'])
+
+            # Send acknowledgment
+            self.send_to_client(client, {
+                "type": "FILE_ACK",
+                "status": "ready",
+                "filename": safe_filename
+            })
+            event_log.log("upload_started", nickname=nickname, filename=safe_filename,
+                          size=filesize, stream=None, offset=0)
+
+            # Receive file data, starting with whatever the decoder already buffered
+            # Disk writes, hashing and the commit run off the loop, a
+            # STREAM_CHUNK at a time; sharing the file happens back on it
+            limiter = self.clients[client]['limiter']
+            upload = await asyncio.to_thread(self.store.begin)
+            pending = []
+            received = upload.size
+            while received < filesize:
+                size = min(8192, filesize - received)
+                chunk = decoder.take_raw(size) or await reader.read(size)
+                if not chunk:
+                    raise ConnectionError("Transfer interrupted")
+                pending.append(chunk)
+                received += len(chunk)
+                if received == filesize or received - upload.size >= STREAM_CHUNK:
+                    await asyncio.to_thread(upload.write, b''.join(pending))
+                    pending = []
+                wait = limiter.file_bytes(len(chunk))
+                if wait:
+                    await asyncio.sleep(wait)
+
+            content_id, path = await asyncio.to_thread(upload.commit)
+            self.file_committed(nickname, metadata, safe_filename, upload, content_id, path)
+
+        except Exception as e:
+            if upload is not None:
+                upload.discard()
+            event_log.log("upload_failed", f"File transfer error: {str(e)}", WARNING,
+                          nickname=nickname, filename=metadata.get('filename'), error=str(e))
+            try:
+                self.send_to_client(client, {
+                    "type": "FILE_ACK",
+                    "status": "error",
+                    "message": str(e)
+                })
+            except:
+                pass
+
+    async def handle_file_download(self, client, filename, offset=0, length=None, stream=None,
+                                   codec=None):
+        info = self.downloadable(client, filename)
+        if info is None:
+            return
+        if not self.is_remote(info):
+            # Local files are queued as a FileRange; nothing to wait for
+            super().handle_file_download(client, filename, offset, length, stream, codec)
+            return
+
+        # Files on another node come over a blocking socket; keep that off the loop
+        offset, length = clamp_range(info['size'], offset, length)
+        if stream is not None and client in self.clients:
+            self.clients[client]['outbound'].set_stream_codec(stream, codec)
+        self.download_started(client, filename, offset, length, stream)
+        try:
+            f = await asyncio.to_thread(self.bus.open_remote_file, info['node'], filename,
+                                        offset, length, self.clients.get(client, {}).get('nickname'))
+        except (OSError, KeyError) as e:
+            self.file_unavailable(client, filename, e)
+            return
+
+        try:
+            self.send_to_client(client, self.file_start(filename, offset, length, stream, codec))
+
+            # Send file data through the queue, waiting for the writer task
+            # whenever the queue is above its low-water mark
+            outbound = self.clients[client]['outbound']
+            with f:
+                while True:
+                    data = await asyncio.to_thread(f.read, STREAM_CHUNK)
+                    if not data:
+                        break
+                    if stream is None:
+                        accepted = await outbound.put_bulk(data)
+                    else:
+                        accepted = await outbound.put_stream(stream, data, offset)
+                    if not accepted:
+                        raise ConnectionError("Client disconnected or cancelled the download")
+                    offset += len(data)
+
+        except Exception as e:
+            self.download_failed(client, filename, e)
+
+    def create_outbound(self, client):
+        outbound = AsyncOutboundQueue(self.max_queue_bytes, self.max_queue_messages,
+                                      self.slow_consumer_policy)
+        task = asyncio.create_task(self.client_writer(client, outbound))
+        self.writer_tasks.add(task)
+        task.add_done_callback(self.writer_tasks.discard)
+        return outbound
+
+    async def client_writer(self, client, outbound):
+        # Only this task waits on the client's transport; broadcast just queues
+        try:
+            while True:
+                batch = await outbound.get_batch(self.coalesce_window)
+                if not batch:
+                    break
+                pending = []
+                for segment in batch:
+                    if isinstance(segment, FileRange):
+                        # loop.sendfile() needs the transport flushed first
+                        client.writelines(pending)
+                        pending = []
+                        await client.drain()
+                        await segment.send_async(self.loop, client.transport)
+                    else:
+                        pending.append(segment)
+                client.writelines(pending)
+                await client.drain()
+                self.metrics.bytes_out.inc(amount=batch_bytes(batch))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.remove_client(client)
+
+    def close_client(self, client):
+        client.close()
+
+    def keep_alive(self, client):
+        set_keepalive(client.get_extra_info('socket'), self.ping_interval, self.ping_timeout)
+
+    def profiled_tasks(self):
+        # Every connection is a task; sample where each one is waiting
+        return lambda: asyncio.all_tasks(self.loop)
+
+    def profile_finished(self, client, reply):
+        # The profile ran on its own thread; reply from the loop
+        self.loop.call_soon_threadsafe(super().profile_finished, client, reply)
+
+    def dispatch_bus_event(self, event):
+        # Bus events arrive on the bus reader thread; handle them on the loop
+        with self.bus_lock:
+            if self.loop is None:
+                self.early_bus_events.append(event)
+                return
+        self.loop.call_soon_threadsafe(super().dispatch_bus_event, event)
+
+    def shutdown(self):
+        self.running = False
+        if self.server:
+            self.server.close()
+        else:
+            self.server_socket.close()
+        event_log.log("server_stopped", pid=os.getpid())
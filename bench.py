@@ -0,0 +1,428 @@
+import argparse
+import json
+import os
+import platform
+import selectors
+import socket
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from binary import BinaryDecoder, NameTable, encode
+from bench_encoding import NICKNAMES, per_call, transcript
+from protocol import FRAMING, FrameDecoder, encode_message, make_decoder
+from search import SearchIndex
+
+# Microbenchmarks for the hot paths, run the same way every time so that
+# protocol and server changes can be judged by numbers:
+#
+#     codec          message encode/decode, JSON and binary, per message
+#     client         the client's receive path: framed and legacy decoders
+#                    fed 64 KiB at a time, and ModernChatClient's own
+#                    receive_messages when client.py imports here
+#     broadcast      ChatServer.broadcast to N clients on socket pairs,
+#                    until the clients have read every message
+#     user_list      update_user_list for a room of 5000 users
+#     transfer       handle_file_upload / handle_file_download over a
+#                    local socket pair
+#     search         SearchIndex.search over a million indexed messages,
+#                    for a common word the searcher's rooms never saw
+#
+# The server benchmarks run a real ChatServer (no history, resume or rate
+# limits) in a temporary directory. --save writes the results as a
+# baseline; --compare checks them against one and exits with status 1 if
+# anything got worse by more than --threshold.
+#
+#     python bench.py --save bench-baseline.json
+#     python bench.py --compare bench-baseline.json --threshold 0.15
+
+BROADCAST_SIZES = (10, 100, 1000)
+ROOM_SIZE = 5000
+TRANSFER_SIZE = 64 * 1024 * 1024
+CHUNK = 65536
+DEFAULT_THRESHOLD = 0.15
+SEARCH_SIZE = 1000000
+
+BENCHMARKS = {}
+
+
+def benchmark(function):
+    # Each benchmark returns {name: (value, unit, "lower" or "higher" is better)}
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+@benchmark
+def codec():
+    messages = transcript(2000)
+    table = NameTable()
+    decoder = BinaryDecoder()
+    for name in NICKNAMES + ["general"]:
+        decoder.read_message(table.definition(table.intern(name)))
+    json_frames = [encode_message(m, True) for m in messages]
+    binary_payloads = [encode(m, table)[0] for m in messages]
+
+    def decode_json():
+        frames = FrameDecoder()
+        frames.feed(b''.join(json_frames))
+        for _ in frames.messages():
+            pass
+
+    def decode_binary():
+        for payload in binary_payloads:
+            decoder.decode(payload)
+
+    n = len(messages)
+    return {
+        "json_encode_us": (per_call(lambda: [encode_message(m, True) for m in messages], 5) / n,
+                           "us", "lower"),
+        "json_decode_us": (per_call(decode_json, 5) / n, "us", "lower"),
+        "binary_encode_us": (per_call(lambda: [encode(m, table) for m in messages], 5) / n,
+                             "us", "lower"),
+        "binary_decode_us": (per_call(decode_binary, 5) / n, "us", "lower"),
+    }
+
+
+@benchmark
+def client():
+    messages = transcript(20000)
+    framed = b''.join(encode_message(m, True) for m in messages)
+    legacy = b''.join(encode_message(m, False) for m in messages)
+
+    def feed(stream, is_framed):
+        decoder = make_decoder(is_framed, server_side=False)
+        for start in range(0, len(stream), CHUNK):
+            decoder.feed(stream[start:start + CHUNK])
+            for _ in decoder.messages():
+                pass
+
+    n = len(messages)
+    results = {
+        "client_framed_decode_us": (per_call(lambda: feed(framed, True), 1) / n, "us", "lower"),
+        "client_legacy_decode_us": (per_call(lambda: feed(legacy, False), 1) / n, "us", "lower"),
+    }
+    receive = client_receive(framed, n)
+    if receive is not None:
+        results["client_receive_messages_us"] = (receive, "us", "lower")
+    return results
+
+
+def client_receive(stream, count):
+    # ModernChatClient.receive_messages on a stand-in without a window,
+    # reading stream from a socket pair; None when client.py cannot be
+    # imported (it needs Tk, emoji, sounddevice and scipy)
+    try:
+        from client import ModernChatClient
+    except ImportError as e:
+        print(f"  skipping client_receive_messages_us: {e}")
+        return None
+
+    class Root:
+        def after(self, delay, callback):
+            pass
+
+    best = None
+    for _ in range(3):
+        reader, writer = socket.socketpair()
+        stand_in = object.__new__(ModernChatClient)
+        stand_in.client_socket = reader
+        stand_in.decoder = make_decoder(True, server_side=False)
+        stand_in.last_seq = 0
+        stand_in.root = Root()
+        stand_in.process_message = lambda message: None
+        sender = threading.Thread(target=lambda: (writer.sendall(stream), writer.close()))
+        started = time.perf_counter()
+        sender.start()
+        stand_in.receive_messages()
+        elapsed = time.perf_counter() - started
+        sender.join()
+        reader.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best / count * 1e6
+
+
+class BenchServer:
+    # A ChatServer with clients on socket pairs; a drain thread reads
+    # whatever the server writes to them
+    def __init__(self):
+        from server import ChatServer
+        self.server = ChatServer('127.0.0.1', 0, max_queue_bytes=1 << 30,
+                                 max_queue_messages=1 << 20, history_keep=0, resume_grace=0,
+                                 rate_limits={}, ping_interval=0)
+        self.server.start()
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.received = 0
+        self.clients = []
+        self.running = True
+        threading.Thread(target=self.drain, daemon=True).start()
+
+    def connect(self, nickname, drained=True):
+        ours, theirs = socket.socketpair()
+        hello = json.dumps({"nickname": nickname, "framing": FRAMING}).encode('utf-8')
+        self.server.register_client(theirs, hello, ('bench', len(self.clients)))
+        self.clients.append((theirs, ours))
+        if drained:
+            ours.setblocking(False)
+            self.selector.register(ours, selectors.EVENT_READ)
+        return theirs, ours
+
+    def drain(self):
+        while self.running:
+            for key, _ in self.selector.select(0.1):
+                try:
+                    data = key.fileobj.recv(1 << 20)
+                except (BlockingIOError, OSError):
+                    continue
+                with self.lock:
+                    self.received += len(data)
+
+    def wait_drained(self, expected, timeout=30):
+        # Until the clients have read expected bytes in all
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if self.received >= expected:
+                    return
+            time.sleep(0.001)
+        raise TimeoutError(f"Clients read {self.received} of {expected} bytes")
+
+    def settle(self, quiet=0.5):
+        # Wait out join notices and user lists still on their way; returns
+        # the bytes read so far
+        while True:
+            with self.lock:
+                received = self.received
+            time.sleep(quiet)
+            with self.lock:
+                if self.received == received:
+                    return received
+
+    def disconnect_all(self):
+        for theirs, ours in self.clients:
+            self.server.remove_client(theirs)
+            try:
+                self.selector.unregister(ours)
+            except (KeyError, ValueError):
+                pass
+            ours.close()
+        self.clients = []
+
+    def close(self):
+        self.disconnect_all()
+        self.running = False
+        self.server.shutdown()
+
+
+@benchmark
+def broadcast(bench):
+    results = {}
+    message = {"type": "TEXT_MESSAGE", "room": "general", "sender": "alice",
+               "message": "Are we still meeting at three?", "time": "14:05"}
+    for size in BROADCAST_SIZES:
+        for n in range(size):
+            bench.connect(f"user{n}")
+        recipients = bench.server.clients.items()
+        number = max(10, 20000 // size)
+        frame = len(encode_message(message, True))
+        best = None
+        for _ in range(3):
+            received = bench.settle()
+            started = time.perf_counter()
+            for _ in range(number):
+                bench.server.broadcast(message, recipients)
+            # Delivered means written by the writers and read by the clients
+            bench.wait_drained(received + number * size * frame)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        results[f"broadcast_{size}_us_per_recipient"] = (best / number / size * 1e6,
+                                                         "us", "lower")
+        bench.disconnect_all()
+    return results
+
+
+@benchmark
+def user_list(bench):
+    room = "big"
+    tracker = bench.server.room_presence(room)
+    for n in range(ROOM_SIZE):
+        tracker.record(f"user{n}", 1)
+    tracker.flush()
+    for n in range(100):
+        bench.connect(f"watcher{n}")
+    recipients = bench.server.clients.items()
+    number = 20
+    elapsed = min(timeit.repeat(lambda: bench.server.update_user_list(room, recipients),
+                                number=number, repeat=3))
+    bench.disconnect_all()
+    return {f"user_list_{ROOM_SIZE}_to_100_ms": (elapsed / number * 1000, "ms", "lower")}
+
+
+def read_frames(sock, decoder, until):
+    # Messages from sock until one of type until; returns that message
+    while True:
+        for message in decoder.messages():
+            if message['type'] == until:
+                return message
+        data = sock.recv(CHUNK)
+        if not data:
+            raise ConnectionError("Server closed the connection")
+        decoder.feed(data)
+
+
+@benchmark
+def transfer(bench):
+    block = os.urandom(1 << 20)
+    best_upload = best_download = None
+    for attempt in range(3):
+        filename = f"bench{attempt}.bin"
+        theirs, ours = bench.connect(f"uploader{attempt}", drained=False)
+        decoder = FrameDecoder()
+        metadata = {"type": "FILE_METADATA", "filename": filename, "size": TRANSFER_SIZE}
+        handler = threading.Thread(target=bench.server.handle_file_upload,
+                                   args=(theirs, f"uploader{attempt}", metadata))
+        started = time.perf_counter()
+        handler.start()
+        read_frames(ours, decoder, 'FILE_ACK')
+        for _ in range(TRANSFER_SIZE // len(block)):
+            ours.sendall(block)
+        handler.join()
+        elapsed = time.perf_counter() - started
+        best_upload = elapsed if best_upload is None else min(best_upload, elapsed)
+
+        started = time.perf_counter()
+        bench.server.handle_file_download(theirs, filename)
+        read_frames(ours, decoder, 'FILE_START')
+        remaining = TRANSFER_SIZE - len(decoder.take_raw(TRANSFER_SIZE))
+        while remaining:
+            data = ours.recv(min(remaining, 1 << 20))
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            remaining -= len(data)
+        elapsed = time.perf_counter() - started
+        best_download = elapsed if best_download is None else min(best_download, elapsed)
+        bench.disconnect_all()
+    return {
+        "upload_mb_per_second": (TRANSFER_SIZE / best_upload / 1e6, "MB/s", "higher"),
+        "download_mb_per_second": (TRANSFER_SIZE / best_download / 1e6, "MB/s", "higher"),
+    }
+
+
+class EmptyHistory:
+    # Stands in for HistoryLog: nothing to rebuild, nothing to fetch
+    on_append = on_compact = None
+
+    def scan(self):
+        return iter(())
+
+    def fetch(self, seq, key):
+        return None
+
+
+@benchmark
+def search():
+    index = SearchIndex(EmptyHistory())
+    while not index.ready:
+        time.sleep(0.01)
+    busy = ["#busy"]
+    message = {"type": "TEXT_MESSAGE", "room": "busy", "sender": "alice",
+               "message": "hello again, are we still meeting at three?"}
+    index.add_batch([(seq, 0.0, busy, message) for seq in range(1, SEARCH_SIZE + 1)])
+    quiet = {"type": "TEXT_MESSAGE", "room": "quiet", "sender": "bob", "message": "nothing new"}
+    index.add_batch([(SEARCH_SIZE + seq, 0.0, ["#quiet"], quiet) for seq in range(1, 1001)])
+    whisper = {"type": "WHISPER", "sender": "bob", "target": "me", "message": "see you"}
+    index.add_batch([(SEARCH_SIZE + 1000 + seq, 0.0, ["@bob", "@me"], whisper)
+                     for seq in range(1, 101)])
+    number = 100
+    elapsed = min(timeit.repeat(lambda: index.search("hello", ["#quiet", "@me"]),
+                                number=number, repeat=3))
+    return {"search_no_match_ms": (elapsed / number * 1000, "ms", "lower")}
+
+
+def run(names):
+    results = {}
+    bench = None
+    directory = tempfile.TemporaryDirectory()
+    cwd = os.getcwd()
+    # The server keeps its files under the working directory
+    os.chdir(directory.name)
+    try:
+        for name in names:
+            print(f"Running {name}...")
+            function = BENCHMARKS[name]
+            if function.__code__.co_argcount:
+                if bench is None:
+                    bench = BenchServer()
+                results.update(function(bench))
+            else:
+                results.update(function())
+    finally:
+        if bench is not None:
+            bench.close()
+        os.chdir(cwd)
+        directory.cleanup()
+    return {name: {"value": round(value, 4), "unit": unit, "better": better}
+            for name, (value, unit, better) in results.items()}
+
+
+def compare(results, baseline, threshold):
+    # Prints current against baseline; returns the names that got worse
+    # by more than threshold
+    regressions = []
+    print(f"\n{'benchmark':<36}{'baseline':>12}{'current':>12}{'change':>9}")
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name:<36}{'-':>12}{result['value']:>12.4g}{'new':>9}")
+            continue
+        change = result['value'] / old['value'] - 1 if old['value'] else 0.0
+        worse = change if result['better'] == "lower" else -change
+        flag = "  REGRESSION" if worse > threshold else ""
+        print(f"{name:<36}{old['value']:>12.4g}{result['value']:>12.4g}{change:>+9.1%}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hot path microbenchmarks")
+    parser.add_argument('--only', help=f"comma-separated subset of {', '.join(BENCHMARKS)}")
+    parser.add_argument('--save', metavar='FILE', help="write the results as a baseline")
+    parser.add_argument('--compare', metavar='FILE', help="compare against a saved baseline")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown counted as a regression (default 0.15)")
+    args = parser.parse_args()
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(unknown)}")
+
+    results = run(names)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+    else:
+        regressions = []
+        print()
+        for name, result in results.items():
+            print(f"{name:<36}{result['value']:>12.4g} {result['unit']}")
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "saved": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "results": results
+            }, f, indent=2)
+        print(f"Baseline written to {args.save}")
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import argparse
+import json
+import random
+import timeit
+from binary import BinaryDecoder, NameTable, encode
+from compression import MessageCompressor
+from protocol import HEADER
+
+# Compares the JSON and binary message encodings for every message type the
+# binary codec has a schema for: bytes per message (steady state, nicknames
+# and rooms already interned) and encode/decode time per message. A mixed
+# chat transcript then shows bytes per message on the wire with and without
+# the zlib message stream on top.
+#
+#     python bench_encoding.py [--number 20000]
+
+NICKNAMES = ["alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi"]
+
+SAMPLES = [
+    {"type": "TEXT_MESSAGE", "room": "general", "sender": "alice",
+     "message": "Are we still meeting at three?", "time": "14:05"},
+    {"type": "WHISPER", "sender": "bob", "target": "alice", "message": "I'll be a bit late",
+     "time": "14:06"},
+    {"type": "SYSTEM_MESSAGE", "room": "general", "message": "carol joined the chat",
+     "time": "14:07"},
+    {"type": "USER_LIST", "room": "general", "users": NICKNAMES, "version": 42},
+    {"type": "USER_JOINED", "room": "general", "users": ["carol"], "version": 43},
+    {"type": "USER_LEFT", "room": "general", "users": ["dave", "erin"], "version": 44},
+    {"type": "FILE_AVAILABLE", "filename": "notes.txt", "size": 18234, "sender": "carol",
+     "private": False, "time": "14:08", "room": "general"},
+    {"type": "FILE_ACK", "status": "ready", "filename": "notes.txt", "stream": 3, "offset": 0,
+     "transfer": "9f86d081884c7d659a2feaa0c55ad015"},
+    {"type": "FILE_START", "filename": "notes.txt", "size": 18234, "offset": 0, "length": 18234,
+     "sha256": "2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824", "stream": 7},
+    {"type": "FILE_METADATA", "filename": "notes.txt", "size": 18234, "room": "general",
+     "sha256": "2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824", "stream": 3,
+     "transfer": "9f86d081884c7d659a2feaa0c55ad015", "compression": "zlib"},
+    {"type": "FILE_REQUEST", "filename": "notes.txt", "stream": 7, "compression": "zlib"},
+    {"type": "JOIN", "room": "random"},
+    {"type": "ROOM_LIST", "rooms": [{"name": "general", "users": 8}, {"name": "random", "users": 3}]},
+]
+
+
+def per_call(function, number):
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e6
+
+
+WORDS = ("the meeting is moved to after lunch can you send me slides I think we should "
+         "ship it today please review my file thanks sounds good see you later").split()
+
+
+def transcript(count, seed=1):
+    # Chat-like traffic: mostly room messages, some whispers and presence
+    rng = random.Random(seed)
+    messages = []
+    for n in range(count):
+        kind = rng.random()
+        sender = rng.choice(NICKNAMES)
+        time = f"{9 + n // 600 % 12:02d}:{n // 10 % 60:02d}"
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 14)))
+        if kind < 0.8:
+            messages.append({"type": "TEXT_MESSAGE", "room": "general", "sender": sender,
+                             "message": text, "time": time})
+        elif kind < 0.9:
+            messages.append({"type": "WHISPER", "sender": sender, "target": rng.choice(NICKNAMES),
+                             "message": text, "time": time})
+        else:
+            messages.append({"type": "USER_JOINED", "room": "general", "users": [sender],
+                             "version": n})
+    return messages
+
+
+def wire_bytes(payloads, batch=8):
+    # (plain, zlib stream) framed bytes per message, writer batches of batch
+    frames = [HEADER.pack(len(payload)) + payload for payload in payloads]
+    compressor = MessageCompressor()
+    compressed = sum(len(compressor.compress(frames[i:i + batch])) + HEADER.size
+                     for i in range(0, len(frames), batch))
+    return sum(map(len, frames)) / len(frames), compressed / len(frames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON vs binary message encoding")
+    parser.add_argument('--number', type=int, default=20000, help="calls per timing")
+    args = parser.parse_args()
+
+    table = NameTable()
+    decoder = BinaryDecoder()
+    for name in NICKNAMES + ["general", "random"]:
+        decoder.read_message(table.definition(table.intern(name)))
+
+    print(f"{'type':<16}{'json B':>8}{'bin B':>8}"
+          f"{'json enc':>10}{'bin enc':>9}{'json dec':>10}{'bin dec':>9}   (times in us)")
+    totals = [0, 0]
+    for message in SAMPLES:
+        json_payload = json.dumps(message).encode('utf-8')
+        binary_payload, _ = encode(message, table)
+        assert decoder.decode(binary_payload) == message, message['type']
+        totals[0] += len(json_payload)
+        totals[1] += len(binary_payload)
+
+        row = [
+            len(json_payload),
+            len(binary_payload),
+            per_call(lambda: json.dumps(message).encode('utf-8'), args.number),
+            per_call(lambda: encode(message, table), args.number),
+            per_call(lambda: json.loads(json_payload.decode('utf-8')), args.number),
+            per_call(lambda: decoder.decode(binary_payload), args.number),
+        ]
+        print(f"{message['type']:<16}{row[0]:>8}{row[1]:>8}"
+              f"{row[2]:>10.2f}{row[3]:>9.2f}{row[4]:>10.2f}{row[5]:>9.2f}")
+
+    print(f"\nPayload bytes for one of each: JSON {totals[0]}, binary {totals[1]} "
+          f"({totals[1] / totals[0]:.0%})")
+
+    messages = transcript(5000)
+    json_wire = wire_bytes([json.dumps(m).encode('utf-8') for m in messages])
+    binary_wire = wire_bytes([encode(m, table)[0] for m in messages])
+    print(f"Mixed transcript, framed bytes per message: JSON {json_wire[0]:.1f} "
+          f"(zlib stream {json_wire[1]:.1f}), binary {binary_wire[0]:.1f} "
+          f"(zlib stream {binary_wire[1]:.1f})")
+
+
+if __name__ == "__main__":
+    main()
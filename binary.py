@@ -0,0 +1,307 @@
+import json
+import re
+import threading
+
+# Compact binary encoding for the common message types, as an alternative to
+# JSON for framed clients that ask for it in the handshake ("encoding":
+# "binary"). Binary frames carry BINARY_FLAG in the length word (see
+# protocol.py), so they can be mixed freely with JSON frames: message types
+# without a schema here, and CONNECTION_SUCCESS, still go out as JSON.
+#
+# A binary payload is
+#
+#     [type][varint bitmask of the schema fields present][fields...]
+#     [varint length][JSON object of any other keys]
+#
+# Field kinds:
+#   uint   unsigned LEB128 varint
+#   bool   one byte
+#   str    varint byte length + UTF-8
+#   name   interned string: varint id + 1, or 0 and the string inline
+#   names  varint count + that many names
+#   time   "HH:MM" as varint minutes + 1, or 0 and the string inline
+#   hex    lowercase hex (hashes, transfer ids) as varint byte length + 1 and
+#          the raw bytes, or 0 and the string inline
+#   json   varint length + JSON
+# A value that does not fit its kind goes into the trailing JSON instead, so
+# every message round-trips.
+#
+# Nicknames and room names are interned: the sender numbers each string the
+# first time it uses it and sends an INTERN message (type 0: varint id and
+# the string) ahead of the first message on a connection that refers to it.
+# The server keeps one table for all connections, so a broadcast is still
+# encoded once, and tracks per connection which ids it has defined. Each
+# client's own table is capped (MAX_CLIENT_NAMES ids, MAX_CLIENT_NAME_CHARS
+# of text) on both ends: the client sends names inline past the caps, and a
+# client that defines names beyond them anyway is disconnected.
+
+TYPES = [
+    ("TEXT_MESSAGE", [("room", "name"), ("sender", "name"), ("message", "str"), ("time", "time"),
+                      ("seq", "uint")]),
+    ("WHISPER", [("sender", "name"), ("target", "name"), ("message", "str"), ("time", "time"),
+                 ("seq", "uint")]),
+    ("SYSTEM_MESSAGE", [("room", "name"), ("message", "str"), ("time", "time"), ("seq", "uint")]),
+    ("USER_LIST", [("room", "name"), ("users", "names"), ("version", "uint")]),
+    ("USER_JOINED", [("room", "name"), ("users", "names"), ("version", "uint"), ("seq", "uint")]),
+    ("USER_LEFT", [("room", "name"), ("users", "names"), ("version", "uint"), ("seq", "uint")]),
+    ("FILE_AVAILABLE", [("filename", "str"), ("size", "uint"), ("sender", "name"),
+                        ("private", "bool"), ("time", "time"), ("room", "name"),
+                        ("target", "name"), ("seq", "uint")]),
+    ("FILE_ACK", [("status", "str"), ("filename", "str"), ("stream", "uint"), ("offset", "uint"),
+                  ("transfer", "hex"), ("message", "str")]),
+    ("FILE_START", [("filename", "str"), ("size", "uint"), ("offset", "uint"), ("length", "uint"),
+                    ("sha256", "hex"), ("stream", "uint"), ("compression", "str")]),
+    ("FILE_METADATA", [("filename", "str"), ("size", "uint"), ("sha256", "hex"), ("room", "name"),
+                       ("target", "name"), ("stream", "uint"), ("transfer", "hex"),
+                       ("compression", "str")]),
+    ("FILE_REQUEST", [("filename", "str"), ("stream", "uint"), ("offset", "uint"),
+                      ("length", "uint"), ("compression", "str")]),
+    ("FILE_CANCEL", [("stream", "uint")]),
+    ("JOIN", [("room", "name")]),
+    ("LEAVE", [("room", "name")]),
+    ("USER_LIST_REQUEST", [("room", "name")]),
+    ("ROOM_LIST", [("rooms", "json")]),
+    ("STATS", [("compression", "json")]),
+]
+
+INTERN = 0
+TYPE_IDS = {name: number for number, (name, _) in enumerate(TYPES, 1)}
+SCHEMAS = {number: (name, fields) for number, (name, fields) in enumerate(TYPES, 1)}
+
+# Interned strings per table; later ones are sent inline
+MAX_NAMES = 65536
+MAX_CLIENT_NAMES = 1024
+MAX_CLIENT_NAME_CHARS = 64 * 1024
+
+TIME = re.compile(r'(?:[01]\d|2[0-3]):[0-5]\d$')
+HEX = re.compile(r'(?:[0-9a-f]{2})+$')
+
+
+class NameTable:
+    # The sending side's interned strings
+    def __init__(self, limit=MAX_NAMES, max_chars=None):
+        self.limit = limit
+        self.max_chars = max_chars
+        self.chars = 0
+        self.lock = threading.Lock()
+        self.ids = {}
+        self.names = []
+
+    def intern(self, name):
+        # The id of name, or None once the table is full
+        number = self.ids.get(name)
+        if number is None:
+            with self.lock:
+                number = self.ids.get(name)
+                if number is None and self.has_room(name):
+                    number = self.ids[name] = len(self.names)
+                    self.names.append(name)
+                    self.chars += len(name)
+        return number
+
+    def has_room(self, name):
+        if len(self.names) >= self.limit:
+            return False
+        return self.max_chars is None or self.chars + len(name) <= self.max_chars
+
+    def definition(self, number):
+        out = bytearray((INTERN,))
+        write_uint(out, number)
+        write_str(out, self.names[number])
+        return bytes(out)
+
+
+def write_uint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_uint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def write_str(out, text):
+    data = text.encode('utf-8')
+    write_uint(out, len(data))
+    out += data
+
+
+def read_str(data, pos):
+    length, pos = read_uint(data, pos)
+    end = pos + length
+    if end > len(data):
+        raise ValueError("Truncated string")
+    return data[pos:end].decode('utf-8'), end
+
+
+def fits(kind, value):
+    if kind == "uint":
+        return type(value) is int and value >= 0
+    if kind == "bool":
+        return type(value) is bool
+    if kind in ("str", "name", "time", "hex"):
+        return type(value) is str
+    if kind == "names":
+        return type(value) is list and all(type(item) is str for item in value)
+    return True
+
+
+def write_name(out, table, text, used):
+    number = table.intern(text)
+    if number is None:
+        out.append(0)
+        write_str(out, text)
+    else:
+        write_uint(out, number + 1)
+        used.append(number)
+
+
+def encode(message, table):
+    # (payload, ids of the interned names it uses), or None without a schema
+    number = TYPE_IDS.get(message.get('type'))
+    if number is None:
+        return None
+    fields = SCHEMAS[number][1]
+    body = bytearray()
+    used = []
+    present = 0
+    consumed = {'type'}
+    for bit, (key, kind) in enumerate(fields):
+        value = message.get(key)
+        if value is None or not fits(kind, value):
+            continue
+        present |= 1 << bit
+        consumed.add(key)
+        if kind == "uint":
+            write_uint(body, value)
+        elif kind == "str":
+            write_str(body, value)
+        elif kind == "name":
+            write_name(body, table, value, used)
+        elif kind == "names":
+            write_uint(body, len(value))
+            for item in value:
+                write_name(body, table, item, used)
+        elif kind == "time":
+            if TIME.match(value):
+                write_uint(body, int(value[:2]) * 60 + int(value[3:]) + 1)
+            else:
+                body.append(0)
+                write_str(body, value)
+        elif kind == "hex":
+            if HEX.match(value):
+                raw = bytes.fromhex(value)
+                write_uint(body, len(raw) + 1)
+                body += raw
+            else:
+                body.append(0)
+                write_str(body, value)
+        elif kind == "bool":
+            body.append(1 if value else 0)
+        else:
+            write_str(body, json.dumps(value))
+
+    out = bytearray((number,))
+    write_uint(out, present)
+    out += body
+    extra = {key: value for key, value in message.items() if key not in consumed}
+    if extra:
+        write_str(out, json.dumps(extra))
+    else:
+        out.append(0)
+    return bytes(out), used
+
+
+class BinaryDecoder:
+    # The receiving side: holds the peer's interned strings, optionally
+    # limited to ids below max_names and max_chars of text
+    def __init__(self, max_names=None, max_chars=None):
+        self.names = {}
+        self.max_names = max_names
+        self.max_chars = max_chars
+        self.chars = 0
+
+    def read_name(self, data, pos):
+        number, pos = read_uint(data, pos)
+        if not number:
+            return read_str(data, pos)
+        try:
+            return self.names[number - 1], pos
+        except KeyError:
+            raise ValueError(f"Unknown interned name {number - 1}")
+
+    def decode(self, data):
+        # The message, or None for an INTERN definition
+        try:
+            return self.read_message(data)
+        except (IndexError, UnicodeDecodeError) as e:
+            raise ValueError(f"Malformed binary message: {e}")
+
+    def define(self, name_id, name):
+        if self.max_names is not None and name_id >= self.max_names:
+            raise ValueError(f"Interned name id {name_id} out of range")
+        chars = self.chars + len(name) - len(self.names.get(name_id, ''))
+        if self.max_chars is not None and chars > self.max_chars:
+            raise ValueError("Too much interned name text")
+        self.names[name_id] = name
+        self.chars = chars
+
+    def read_message(self, data):
+        number = data[0]
+        if number == INTERN:
+            name_id, pos = read_uint(data, 1)
+            self.define(name_id, read_str(data, pos)[0])
+            return None
+        if number not in SCHEMAS:
+            raise ValueError(f"Unknown binary message type {number}")
+        type_name, fields = SCHEMAS[number]
+        message = {"type": type_name}
+        present, pos = read_uint(data, 1)
+        for bit, (key, kind) in enumerate(fields):
+            if not present >> bit & 1:
+                continue
+            if kind == "uint":
+                value, pos = read_uint(data, pos)
+            elif kind == "str":
+                value, pos = read_str(data, pos)
+            elif kind == "name":
+                value, pos = self.read_name(data, pos)
+            elif kind == "names":
+                count, pos = read_uint(data, pos)
+                value = []
+                for _ in range(count):
+                    item, pos = self.read_name(data, pos)
+                    value.append(item)
+            elif kind == "time":
+                minutes, pos = read_uint(data, pos)
+                if minutes:
+                    value = f"{(minutes - 1) // 60:02d}:{(minutes - 1) % 60:02d}"
+                else:
+                    value, pos = read_str(data, pos)
+            elif kind == "hex":
+                length, pos = read_uint(data, pos)
+                if length:
+                    value = data[pos:pos + length - 1].hex()
+                    pos += length - 1
+                else:
+                    value, pos = read_str(data, pos)
+            elif kind == "bool":
+                value = bool(data[pos])
+                pos += 1
+            else:
+                text, pos = read_str(data, pos)
+                value = json.loads(text)
+            message[key] = value
+        extra, pos = read_str(data, pos)
+        if extra:
+            message.update(json.loads(extra))
+        return message
@@ -1,22 +1,77 @@
 import os
 import json
+import hashlib
 import socket
 import threading
+import uuid
+import bisect
 import emoji
 from tkinter import *
 from tkinter import ttk, scrolledtext, messagebox, filedialog
 from datetime import datetime
 from styles import Styles
 from emoji_picker import EmojiPicker
+from protocol import (FRAMING, STREAM_CHUNK, chunk_data, encode_binary_message, encode_compressed,
+                      encode_data, encode_message, make_decoder, is_framed_reply)
+from binary import MAX_CLIENT_NAME_CHARS, MAX_CLIENT_NAMES, NameTable
+from compression import CODECS, MESSAGE_CODEC, MessageCompressor, worth_compressing
 import sounddevice as sd
 from scipy.io.wavfile import write
 
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Consecutive bad chunks before a download is given up
+MAX_CHUNK_RETRIES = 3
+
+# Codec for file bodies when the server offers it; lzma packs text tighter
+# but is far slower per chunk
+TRANSFER_CODEC = "zlib"
+
+# Earlier messages shown on entering a room
+HISTORY_PAGE = 50
+
+# "binary" asks the server for the compact encoding (binary.py) instead of JSON
+MESSAGE_ENCODING = os.environ.get("CHAT_ENCODING", "json")
+
 class ModernChatClient:
     def __init__(self):
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.file_dir = "client_files"
         os.makedirs(self.file_dir, exist_ok=True)
         self.whisper_target = None
+        self.framed = False
+        self.decoder = make_decoder(False, server_side=False)
+        self.send_lock = threading.Lock()
+        # Compression agreed with the server; the compressor carries state
+        # from message to message, so it is only used under send_lock
+        self.codecs = []
+        self.compressor = None
+        # Our interned names when the server agreed to the binary encoding
+        self.names = None
+        # File chunks give way to chat messages waiting for the socket
+        self.send_priority = threading.Condition()
+        self.control_waiting = 0
+        # Transfers running as streams, by stream id. Unfinished uploads
+        # (by transfer id) and downloads are kept across connections and
+        # resumed from the last confirmed byte after reconnecting.
+        self.streams = False
+        self.stream_ids = 0
+        self.uploads = {}
+        self.transfers = {}
+        self.downloads = {}
+        self.online_users = []
+        self.user_list_version = None
+        self.current_room = "general"
+        # Lets a dropped connection pick up where it left off: the server's
+        # token for our session and the last event seq we saw
+        self.resume_token = None
+        self.resume_server = None
+        self.last_seq = 0
         
         # Create root window
         self.root = Tk()
@@ -176,6 +231,29 @@ class ModernChatClient:
         self.root.grid_columnconfigure(0, weight=1)  # Main content expands
         self.root.grid_columnconfigure(1, weight=0)  # User list stays fixed width
         
+        # Room switcher
+        self.room_frame = Frame(self.user_frame, bg=self.styles.bg_medium, padx=10, pady=10)
+        self.room_frame.pack(fill=X)
+        
+        Label(self.room_frame, text="ROOM", bg=self.styles.bg_medium,
+            fg=self.styles.text_secondary, font=self.styles.font_bold).pack(anchor=W)
+        
+        self.room_combo = ttk.Combobox(
+            self.room_frame,
+            values=[self.current_room],
+            width=12,
+            font=self.styles.font_normal,
+            postcommand=self.request_room_list
+        )
+        self.room_combo.set(self.current_room)
+        self.room_combo.pack(side=LEFT, fill=X, expand=True)
+        self.room_combo.bind("<<ComboboxSelected>>", self.switch_room)
+        self.room_combo.bind("<Return>", self.switch_room)
+        
+        self.room_btn = Button(self.room_frame, text="Join", command=self.switch_room,
+                            state=DISABLED, **self.styles.secondary_button_style)
+        self.room_btn.pack(side=LEFT, padx=(5, 0))
+        
         self.user_list_label = Label(
             self.user_frame,
             text="ONLINE (0)",
@@ -240,25 +318,26 @@ class ModernChatClient:
 
             if self.whisper_target:
                 msg_data["target"] = self.whisper_target
+            else:
+                msg_data["room"] = self.current_room
 
-            # Send metadata
-            self.client_socket.sendall(json.dumps(msg_data).encode('utf-8'))
+            if self.streams:
+                self.start_upload(filepath, msg_data)
+                return
+
+            # Send metadata; the hash lets the server skip the transfer if
+            # it already has the content
+            msg_data["sha256"] = file_digest(filepath)
+            self.send_json(msg_data)
 
             # Wait for acknowledgment with timeout
             self.client_socket.settimeout(5.0)
-            ack_data = b''
-            while True:
-                chunk = self.client_socket.recv(1024)
-                if not chunk:
-                    raise ConnectionError("No response from server")
-                ack_data += chunk
-                try:
-                    ack = json.loads(ack_data.decode('utf-8'))
-                    if ack.get("status") != "ready":
-                        raise Exception("Server not ready for file transfer")
-                    break
-                except json.JSONDecodeError:
-                    continue
+            ack = self.recv_message()
+            if ack.get("status") == "exists":
+                self.display_system_message(f"{basename} sent successfully")
+                return
+            if ack.get("status") != "ready":
+                raise Exception("Server not ready for file transfer")
 
             # Send file data in chunks
             with open(filepath, 'rb') as f:
@@ -268,11 +347,260 @@ class ModernChatClient:
             self.display_system_message(f"{basename} sent successfully")
 
         except Exception as e:
+            # A failed transfer is no reason to drop the chat connection
             messagebox.showerror("Error", f"Failed to send file: {str(e)}")
-            self.disconnect()
         finally:
             self.client_socket.settimeout(None)  # Reset timeout
 
+    def request_room_list(self):
+        if self.disconnect_btn['state'] == NORMAL:
+            try:
+                self.send_json({"type": "ROOM_LIST"})
+            except OSError:
+                pass
+    
+    def switch_room(self, event=None):
+        room = " ".join(self.room_combo.get().split())[:32] or "general"
+        if room == self.current_room or self.disconnect_btn['state'] != NORMAL:
+            return
+        
+        # Switch before asking: the receive thread may get the new room's
+        # snapshot before JOIN returns, and drops it for any other room
+        previous = self.current_room
+        self.current_room = room
+        self.user_list_version = None
+        self.room_combo.set(room)
+        self.update_user_list([])
+        try:
+            # Join first so the new room's snapshot arrives before we let go
+            self.send_json({"type": "JOIN", "room": room})
+            self.send_json({"type": "LEAVE", "room": previous})
+            self.send_json({"type": "HISTORY", "room": room, "limit": HISTORY_PAGE})
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to switch room: {str(e)}")
+            return
+        
+        self.display_system_message(f"Switched to room {room}")
+    
+    def in_current_room(self, message):
+        # Messages from servers without rooms carry no room at all
+        return message.get('room', self.current_room) == self.current_room
+    
+    def send_json(self, message):
+        # The receive thread sends too (USER_LIST_REQUEST), keep writes whole
+        with self.send_priority:
+            self.control_waiting += 1
+        try:
+            with self.send_lock:
+                if self.names is not None:
+                    data = encode_binary_message(message, self.names)
+                else:
+                    data = encode_message(message, self.framed)
+                if self.compressor is not None:
+                    data = encode_compressed(self.compressor.compress([data]))
+                self.client_socket.sendall(data)
+        finally:
+            with self.send_priority:
+                self.control_waiting -= 1
+                self.send_priority.notify_all()
+    
+    def send_data(self, stream, offset, data, codec=None):
+        frame = encode_data(stream, offset, data, codec)
+        with self.send_priority:
+            self.send_priority.wait_for(lambda: not self.control_waiting)
+        with self.send_lock:
+            self.client_socket.sendall(frame)
+    
+    def new_stream(self):
+        self.stream_ids += 1
+        return self.stream_ids
+    
+    def start_upload(self, filepath, metadata):
+        # Hashing a large file takes a while; keep it off the Tk thread
+        threading.Thread(target=self.hash_and_upload, args=(filepath, metadata),
+                         daemon=True).start()
+    
+    def hash_and_upload(self, filepath, metadata):
+        try:
+            # Lets the server skip the transfer if it already has the content
+            metadata["sha256"] = file_digest(filepath)
+            # The transfer id lets the server keep the partial file if we
+            # lose the connection half way
+            transfer = uuid.uuid4().hex
+            metadata["transfer"] = transfer
+            self.transfers[transfer] = {"path": filepath, "metadata": metadata, "stream": None,
+                                        "generation": 0}
+            self.send_upload(transfer)
+        except (OSError, ConnectionError) as e:
+            basename = os.path.basename(filepath)
+            self.root.after(0, lambda: self.display_system_message(
+                f"Failed to send {basename}: {e}"))
+    
+    def send_upload(self, transfer):
+        # The FILE_ACK arrives on the receive thread, which starts the upload
+        # from the offset the server confirms
+        upload = self.transfers[transfer]
+        upload['stream'] = self.new_stream()
+        upload['metadata']["stream"] = upload['stream']
+        upload['metadata'].pop("compression", None)
+        if TRANSFER_CODEC in self.codecs and worth_compressing(upload['path']):
+            upload['metadata']["compression"] = TRANSFER_CODEC
+        self.uploads[upload['stream']] = transfer
+        self.send_json(upload['metadata'])
+    
+    def upload_stream(self, transfer, stream, generation, offset):
+        upload = self.transfers.get(transfer)
+        basename = os.path.basename(upload['path'])
+        try:
+            with open(upload['path'], 'rb') as f:
+                f.seek(offset)
+                while chunk := f.read(STREAM_CHUNK):
+                    if upload['stream'] != stream or upload['generation'] != generation:
+                        # Superseded by a resend request or a reconnect
+                        return
+                    self.send_data(stream, offset, chunk, upload['metadata'].get('compression'))
+                    offset += len(chunk)
+        except (OSError, ConnectionError) as e:
+            self.root.after(0, lambda: self.display_system_message(
+                f"Sending {basename} paused: {e}; it resumes when you reconnect"))
+    
+    def start_download(self, filename, save_path):
+        download = {"filename": filename, "path": save_path, "file": None, "next": 0,
+                    "end": None, "size": None, "sha256": None, "codec": None, "retries": 0}
+        self.display_system_message(f"Downloading {filename}...")
+        self.request_download(download)
+    
+    def request_download(self, download):
+        # Ask for whatever we do not have yet: everything the first time,
+        # the rest of the range after a reconnect or a bad chunk
+        stream = self.new_stream()
+        self.downloads[stream] = download
+        request = {
+            "type": "FILE_REQUEST",
+            "filename": download['filename'],
+            "stream": stream
+        }
+        if TRANSFER_CODEC in self.codecs:
+            # The server leaves files that are compressed already alone
+            request["compression"] = TRANSFER_CODEC
+        if download['end'] is not None:
+            request["offset"] = download['next']
+            request["length"] = download['end'] - download['next']
+        self.send_json(request)
+    
+    def resume_transfers(self):
+        # Called after connecting: pick up every unfinished transfer
+        downloads = list(self.downloads.values())
+        self.uploads = {}
+        self.downloads = {}
+        if not self.streams:
+            if self.transfers or downloads:
+                self.display_system_message("This server cannot resume unfinished transfers")
+            self.transfers = {}
+            return
+        pending = list(self.transfers)
+        if pending or downloads:
+            self.display_system_message(f"Resuming {len(pending) + len(downloads)} transfer(s)")
+        for transfer in pending:
+            self.transfers[transfer]['generation'] += 1
+            self.send_upload(transfer)
+        for download in downloads:
+            self.request_download(download)
+    
+    def suspend_downloads(self):
+        for download in self.downloads.values():
+            if download['file'] is not None:
+                download['file'].close()
+                download['file'] = None
+    
+    def process_stream_message(self, message):
+        # Transfer messages of streams; runs on the receive thread
+        stream = message['stream']
+        if message['type'] == 'FILE_ACK':
+            transfer = self.uploads.get(stream)
+            upload = self.transfers.get(transfer)
+            if upload is None:
+                return
+            basename = os.path.basename(upload['path'])
+            status = message.get('status')
+            if status in ('ready', 'resend'):
+                upload['generation'] += 1
+                threading.Thread(target=self.upload_stream, daemon=True,
+                                 args=(transfer, stream, upload['generation'],
+                                       message.get('offset', 0))).start()
+                return
+            del self.uploads[stream]
+            del self.transfers[transfer]
+            if status in ('done', 'exists'):
+                # "exists": the server already had this content, nothing to send
+                text = f"File {basename} sent successfully"
+            else:
+                text = f"File transfer failed: {message.get('message', 'Server not ready')}"
+            self.root.after(0, lambda: self.display_system_message(text))
+            return
+        
+        download = self.downloads.get(stream)
+        if download is None:
+            return
+        data = b''
+        if message['type'] == 'FILE_START':
+            resuming = download['end'] is not None
+            download['file'] = open(download['path'], 'r+b' if resuming else 'wb')
+            download['file'].seek(message['offset'])
+            download['file'].truncate()
+            download['next'] = message['offset']
+            download['end'] = message['offset'] + message['length']
+            download['size'] = message['size']
+            download['sha256'] = message.get('sha256')
+            download['codec'] = message.get('compression')
+        elif download['file'] is None or message['offset'] != download['next']:
+            # Behind a bad chunk that is being asked for again
+            return
+        elif (data := chunk_data(message, download['codec'])) is None:
+            download['retries'] += 1
+            self.send_json({"type": "FILE_CANCEL", "stream": stream})
+            del self.downloads[stream]
+            if download['retries'] > MAX_CHUNK_RETRIES:
+                download['file'].close()
+                text = f"Downloading {download['filename']} failed: data keeps arriving corrupted"
+                self.root.after(0, lambda: self.display_system_message(text))
+                return
+            self.request_download(download)
+            return
+        else:
+            download['file'].write(data)
+            download['next'] += len(data)
+            download['retries'] = 0
+        
+        received, length = download['next'], download['end']
+        if download['next'] >= download['end']:
+            download['file'].close()
+            del self.downloads[stream]
+            text = self.finish_download(download)
+        elif data and received * 10 // length != (received - len(data)) * 10 // length:
+            text = f"Downloading {download['filename']}: {received * 100 // length}%"
+        else:
+            return
+        self.root.after(0, lambda: self.display_system_message(text))
+    
+    def finish_download(self, download):
+        # Whole files are checked against the content hash the server sent
+        if download['sha256'] and download['end'] == download['size']:
+            if file_digest(download['path']) != download['sha256']:
+                return f"Downloaded {download['filename']}, but it does not match its checksum"
+        return f"Downloaded {download['filename']} successfully"
+    
+    def recv_message(self):
+        # Block until the decoder yields one complete message
+        while True:
+            message = self.decoder.next_message()
+            if message is not None:
+                return message
+            chunk = self.client_socket.recv(8192)
+            if not chunk:
+                raise ConnectionError("Server disconnected")
+            self.decoder.feed(chunk)
+
     def show_emoji_picker(self):
         # Check if emoji picker already exists and is open
         if hasattr(self, 'emoji_picker') and hasattr(self.emoji_picker, 'popup') and self.emoji_picker.popup.winfo_exists():
@@ -316,29 +644,56 @@ class ModernChatClient:
             # Connect to server
             self.client_socket.connect((server_ip, port))
             
-            # Send nickname
-            self.client_socket.sendall(json.dumps({
-                "nickname": nickname
-            }).encode('utf-8'))
+            # Send nickname and ask for length-prefixed framing and
+            # incremental user list updates
+            hello = {
+                "nickname": nickname,
+                "framing": FRAMING,
+                "user_deltas": True,
+                "streams": True,
+                "heartbeat": True,
+                "compression": list(CODECS)
+            }
+            if MESSAGE_ENCODING == "binary":
+                hello["encoding"] = "binary"
+            if self.resume_token and self.resume_server == (server_ip, port, nickname):
+                hello["resume"] = self.resume_token
+                hello["after"] = self.last_seq
+            self.names = None
+            self.client_socket.sendall(json.dumps(hello).encode('utf-8'))
             
-            # Wait for response
-            complete_data = b''
-            while True:
-                chunk = self.client_socket.recv(1024)
-                if not chunk:
-                    raise ConnectionError("No response from server")
-                complete_data += chunk
-                try:
-                    # Try to parse the complete message
-                    response = json.loads(complete_data.decode('utf-8'))
-                    break  # If successful, exit
-                except json.JSONDecodeError:
-                    # Incomplete JSON, continue receiving data
-                    continue
+            # Wait for response; older servers ignore the framing request
+            # and answer with bare JSON
+            chunk = self.client_socket.recv(1024)
+            if not chunk:
+                raise ConnectionError("No response from server")
+            self.framed = is_framed_reply(chunk)
+            self.decoder = make_decoder(self.framed, server_side=False)
+            self.decoder.feed(chunk)
+            response = self.recv_message()
             
             if response.get('type') != 'CONNECTION_SUCCESS':
                 raise ConnectionError(response.get('message', 'Connection rejected'))
             
+            # Without streams, transfers fall back to raw bytes on the socket
+            self.streams = self.framed and bool(response.get('streams'))
+            self.codecs = response.get('compression', []) if self.framed else []
+            self.compressor = MessageCompressor() if MESSAGE_CODEC in self.codecs else None
+            if self.framed and response.get('encoding') == 'binary':
+                # Within what the server accepts from one client
+                self.names = NameTable(MAX_CLIENT_NAMES, MAX_CLIENT_NAME_CHARS)
+            
+            # Resumed, the server puts us back in our rooms and sends what
+            # we missed; otherwise we start over in the default room
+            resumed = bool(response.get('resumed'))
+            self.resume_token = response.get('resume')
+            self.resume_server = (server_ip, port, nickname)
+            if not resumed:
+                self.last_seq = response.get('seq', 0)
+                self.user_list_version = None
+                self.current_room = "general"
+                self.room_combo.set(self.current_room)
+            
             # Remove timeout for regular operation
             self.client_socket.settimeout(None)
             
@@ -348,6 +703,7 @@ class ModernChatClient:
             self.send_btn.config(state=NORMAL)
             self.file_btn.config(state=NORMAL)
             self.mic_btn.config(state=NORMAL)
+            self.room_btn.config(state=NORMAL)
             self.ip_entry.config(state='readonly')
             self.port_entry.config(state='readonly')
             self.nick_entry.config(state='readonly')
@@ -359,7 +715,13 @@ class ModernChatClient:
             )
             self.receive_thread.start()
             
-            self.display_system_message(f"Connected as {nickname}")
+            if resumed:
+                self.display_system_message(f"Reconnected as {nickname}")
+            else:
+                self.display_system_message(f"Connected as {nickname}")
+            if not resumed or response.get('gap'):
+                self.send_json({"type": "HISTORY", "room": self.current_room, "limit": HISTORY_PAGE})
+            self.resume_transfers()
             
         except socket.timeout:
             messagebox.showerror("Error", "Connection timed out")
@@ -372,7 +734,15 @@ class ModernChatClient:
             if hasattr(self, 'client_socket'):
                 self.client_socket.close()
     
-    def disconnect(self):
+    def disconnect(self, lost=False):
+        if not lost and self.disconnect_btn['state'] == NORMAL:
+            # Leaving on purpose: the server can let the others know now
+            # instead of keeping the session open for a resume
+            try:
+                self.send_json({"type": "BYE"})
+            except OSError:
+                pass
+            self.resume_token = None
         try:
             if hasattr(self, 'client_socket') and self.client_socket:
                 try:
@@ -385,6 +755,7 @@ class ModernChatClient:
                     pass
         except:
             pass
+        self.suspend_downloads()
     
     # Reset UI
         self.connect_btn.config(state=NORMAL)
@@ -392,6 +763,7 @@ class ModernChatClient:
         self.send_btn.config(state=DISABLED)
         self.file_btn.config(state=DISABLED)
         self.mic_btn.config(state=DISABLED)
+        self.room_btn.config(state=DISABLED)
         self.ip_entry.config(state='normal')
         self.port_entry.config(state='normal')
         self.nick_entry.config(state='normal')
@@ -459,6 +831,12 @@ class ModernChatClient:
             return
         
         try:
+            if message.startswith("/search "):
+                # Searches our rooms and our own whispers on the server
+                self.send_json({"type": "SEARCH", "query": message[8:]})
+                self.message_entry.delete(0, END)
+                return
+            
             # Convert emoji shortcodes
             message = emoji.emojize(message, language='alias')
             
@@ -479,19 +857,20 @@ class ModernChatClient:
                     "message": message
                 }
             else:
-                # Send public message
+                # Send public message to the current room
                 msg_data = {
                     "type": "TEXT_MESSAGE",
+                    "room": self.current_room,
                     "message": message
                 }
                 # Public messages will be displayed when received back from server
             
-            self.client_socket.sendall(json.dumps(msg_data).encode('utf-8'))
+            self.send_json(msg_data)
             self.message_entry.delete(0, END)
         
         except Exception as e:
             messagebox.showerror("Error", f"Failed to send message: {str(e)}")
-            self.disconnect()
+            self.disconnect(lost=True)
         
     def send_file_dialog(self):
         if not hasattr(self, 'client_socket') or not self.client_socket:
@@ -532,13 +911,21 @@ class ModernChatClient:
             
             if self.whisper_target:
                 msg_data["target"] = self.whisper_target
+            else:
+                msg_data["room"] = self.current_room
             
             # First verify socket is still valid
             if not self.client_socket or self.client_socket.fileno() == -1:
                 messagebox.showerror("Error", "Connection lost before sending")
                 return
+            
+            if self.streams:
+                self.start_upload(filename, msg_data)
+                return
                 
-            self.client_socket.sendall(json.dumps(msg_data).encode('utf-8'))
+            # Lets the server skip the transfer if it already has the content
+            msg_data["sha256"] = file_digest(filename)
+            self.send_json(msg_data)
             
             # Store original timeout
             original_timeout = None
@@ -546,19 +933,11 @@ class ModernChatClient:
                 original_timeout = self.client_socket.gettimeout()
                 
                 # Wait for acknowledgment
-                ack_data = b''
-                while True:
-                    try:
-                        chunk = self.client_socket.recv(1024)
-                        if not chunk:
-                            raise ConnectionError("No response from server")
-                    
-                        ack_data += chunk
-                        ack = json.loads(ack_data.decode('utf-8'))
-                        break
-                    except json.JSONDecodeError:
-                        continue
-                        
+                ack = self.recv_message()
+                
+                if ack.get('status') == 'exists':
+                    self.display_system_message(f"File {basename} sent successfully")
+                    return
                 if ack.get('status') != 'ready':
                     raise ConnectionError(ack.get('message', 'Server not ready'))
                 
@@ -607,35 +986,29 @@ class ModernChatClient:
         if not save_path:
             return
         
+        if self.streams:
+            self.start_download(filename, save_path)
+            return
+        
         try:
             # Show downloading message
             self.display_system_message(f"Downloading {filename}...")
             
             # Request file
-            self.client_socket.sendall(json.dumps({
+            self.send_json({
                 "type": "FILE_REQUEST",
                 "filename": filename
-            }).encode('utf-8'))
+            })
             
             # Get file info with timeout
             self.client_socket.settimeout(5.0)
-            file_data = b''
-            while True:
-                chunk = self.client_socket.recv(1024)
-                if not chunk:
-                    raise ConnectionError("Server disconnected")
-                    
-                file_data += chunk
-                try:
-                    file_info = json.loads(file_data.decode('utf-8'))
-                    break
-                except json.JSONDecodeError:
-                    continue
+            file_info = self.recv_message()
                     
             if file_info.get('type') != 'FILE_START':
                 raise ConnectionError("Invalid response from server")
             
-            filesize = file_info['size']
+            # Older servers always send the whole file and no length
+            filesize = file_info.get('length', file_info['size'])
             received = 0
             
             # Reset timeout for file transfer
@@ -644,7 +1017,8 @@ class ModernChatClient:
             # Receive file data with progress updates
             with open(save_path, 'wb') as f:
                 while received < filesize:
-                    data = self.client_socket.recv(min(8192, filesize - received))
+                    size = min(8192, filesize - received)
+                    data = self.decoder.take_raw(size) or self.client_socket.recv(size)
                     if not data:
                         raise ConnectionError("Transfer incomplete")
                     f.write(data)
@@ -922,150 +1296,162 @@ class ModernChatClient:
 
     
     def update_user_list(self, users):
+        self.online_users = sorted(users)
         self.user_listbox.delete(0, END)
-        for user in sorted(users):
-            # Highlight whisper target with a special prefix
-            if user == self.whisper_target:
-                self.user_listbox.insert(END, f"→ {user}")
-            else:
-                self.user_listbox.insert(END, user)
+        for user in self.online_users:
+            self.user_listbox.insert(END, self.user_label(user))
         
         # Update title with count
         self.user_list_label.config(text=f"ONLINE ({len(users)})")
+    
+    def user_label(self, user):
+        # Highlight whisper target with a special prefix
+        if user == self.whisper_target:
+            return f"→ {user}"
+        return user
+    
+    def add_users(self, users):
+        # Insert in place instead of rebuilding the whole Listbox
+        for user in users:
+            index = bisect.bisect_left(self.online_users, user)
+            self.online_users.insert(index, user)
+            self.user_listbox.insert(index, self.user_label(user))
+        self.user_list_label.config(text=f"ONLINE ({len(self.online_users)})")
+    
+    def remove_users(self, users):
+        for user in users:
+            index = bisect.bisect_left(self.online_users, user)
+            if index < len(self.online_users) and self.online_users[index] == user:
+                del self.online_users[index]
+                self.user_listbox.delete(index)
+        self.user_list_label.config(text=f"ONLINE ({len(self.online_users)})")
+    
+    def apply_user_delta(self, message):
+        version = message.get('version')
+        if self.user_list_version is None or version <= self.user_list_version:
+            # Snapshot still on its way, or it already included this change
+            return
+        if version != self.user_list_version + 1:
+            # Missed an update: throw away local state and ask for a snapshot
+            self.user_list_version = None
+            self.send_json({"type": "USER_LIST_REQUEST", "room": self.current_room})
+            return
+        self.user_list_version = version
         
+        if message['type'] == 'USER_JOINED':
+            for user in message['users']:
+                self.clients[user] = {"nickname": user}
+            self.root.after(0, lambda u=message['users']: self.add_users(u))
+        else:
+            for user in message['users']:
+                self.clients.pop(user, None)
+            self.root.after(0, lambda u=message['users']: self.remove_users(u))
+        
+    def process_message(self, message):
+        if message['type'] == 'PING':
+            # The server drops connections that stop answering
+            self.send_json({"type": "PONG"})
+            return
+        if 'stream' in message and message['type'] in ('FILE_ACK', 'FILE_START', 'DATA'):
+            self.process_stream_message(message)
+            return
+        if message['type'] == 'ROOM_LIST':
+            names = [room['name'] for room in message.get('rooms', [])]
+            if self.current_room not in names:
+                names.append(self.current_room)
+            self.root.after(0, lambda n=names: self.room_combo.config(values=n))
+            return
+        if not self.in_current_room(message):
+            # Still in flight from a room we just left
+            return
+        
+        if message['type'] == 'SEARCH':
+            lines = [f"{len(message['results'])} results for \"{message['query']}\""]
+            if 'error' in message:
+                lines = [message['error']]
+            for found in message['results']:
+                text = found.get('message') or found.get('filename', '')
+                where = found.get('room') or f"whisper to {found.get('target')}"
+                lines.append(f"[{found.get('time')}] {found.get('sender')} ({where}): {text}")
+            self.root.after(0, lambda t="\n".join(lines): self.display_system_message(t))
+            return
+        if message['type'] == 'HISTORY':
+            # What was said before we came in, oldest first
+            earlier = message.get('messages', [])
+            if earlier:
+                self.root.after(0, lambda n=len(earlier): self.display_system_message(
+                    f"Last {n} messages in {message.get('room', self.current_room)}"
+                ))
+            for entry in earlier:
+                self.process_message(entry)
+            return
+        if message['type'] == 'TEXT_MESSAGE':
+            is_me = (message['sender'] == self.nick_entry.get())
+            self.root.after(0, lambda m=message, me=is_me: self.display_chat_bubble(
+                m['sender'],
+                m['message'],
+                is_me=me,
+                time=m.get('time')
+            ))
+        elif message['type'] == 'WHISPER':
+            is_me = (message['sender'] == self.nick_entry.get())
+            self.root.after(0, lambda m=message, me=is_me: self.display_chat_bubble(
+                m['sender'],
+                m['message'],
+                is_me=me,
+                is_whisper=True,
+                time=m.get('time')
+            ))
+        elif message['type'] == 'FILE_AVAILABLE':
+            is_me = (message['sender'] == self.nick_entry.get())
+            self.root.after(0, lambda m=message, me=is_me: self.display_file_message(
+                m['filename'],
+                {
+                    "size": m['size'],
+                    "sender": m['sender'],
+                    "private": m.get('private', False),
+                    "time": m.get('time'),
+                    "is_image": any(m['filename'].lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']),
+                    "type": "Image" if any(m['filename'].lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']) else "Document",
+                    "name": m['filename']
+                }
+            ))
+        elif message['type'] == 'SYSTEM_MESSAGE':
+            self.root.after(0, lambda m=message: self.display_system_message(
+                m['message']
+            ))
+        elif message['type'] == 'USER_LIST':
+            if isinstance(message.get('users'), list):
+                # Store client list for user interaction
+                self.clients = {user: {"nickname": user} for user in message['users']}
+                self.user_list_version = message.get('version')
+                self.root.after(0, lambda m=message: self.update_user_list(
+                    m['users']
+                ))
+        elif message['type'] in ('USER_JOINED', 'USER_LEFT'):
+            self.apply_user_delta(message)
+
     def receive_messages(self):
-        buffer_size = 8192
+        buffer_size = 65536
         self.clients = {}  # Initialize clients dictionary
-        accumulated_data = b''
         
         while True:
             try:
+                # Drain every complete message the decoder holds (including
+                # anything that arrived with the handshake), then read more
+                for message in self.decoder.messages():
+                    if 'seq' in message:
+                        self.last_seq = max(self.last_seq, message['seq'])
+                    self.process_message(message)
+                
                 chunk = self.client_socket.recv(buffer_size)
                 if not chunk:
                     raise ConnectionError("Server disconnected")
-                
-                accumulated_data += chunk
-                
-                # Try to extract complete JSON messages
-                while accumulated_data:
-                    try:
-                        # Try to decode the JSON
-                        message = json.loads(accumulated_data.decode('utf-8'))
-                        accumulated_data = b''  # Clear the buffer after successful parse
-                        
-                        # Process the message
-                        if message['type'] == 'TEXT_MESSAGE':
-                            is_me = (message['sender'] == self.nick_entry.get())
-                            self.root.after(0, lambda m=message, me=is_me: self.display_chat_bubble(
-                                m['sender'],
-                                m['message'],
-                                is_me=me,
-                                time=m.get('time')
-                            ))
-                        elif message['type'] == 'WHISPER':
-                            is_me = (message['sender'] == self.nick_entry.get())
-                            self.root.after(0, lambda m=message, me=is_me: self.display_chat_bubble(
-                                m['sender'],
-                                m['message'],
-                                is_me=me,
-                                is_whisper=True,
-                                time=m.get('time')
-                            ))
-                        elif message['type'] == 'FILE_AVAILABLE':
-                            is_me = (message['sender'] == self.nick_entry.get())
-                            self.root.after(0, lambda m=message, me=is_me: self.display_file_message(
-                                m['filename'],
-                                {
-                                    "size": m['size'],
-                                    "sender": m['sender'],
-                                    "private": m.get('private', False),
-                                    "time": m.get('time'),
-                                    "is_image": any(m['filename'].lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']),
-                                    "type": "Image" if any(m['filename'].lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']) else "Document",
-                                    "name": m['filename']
-                                }
-                            ))
-                        elif message['type'] == 'SYSTEM_MESSAGE':
-                            self.root.after(0, lambda m=message: self.display_system_message(
-                                m['message']
-                            ))
-                        elif message['type'] == 'USER_LIST':
-                            if isinstance(message.get('users'), list):
-                                # Store client list for user interaction
-                                self.clients = {user: {"nickname": user} for user in message['users']}
-                                self.root.after(0, lambda m=message: self.update_user_list(
-                                    m['users']
-                                ))
-                        break  # Exit the while loop after processing a complete message
-                        
-                    except json.JSONDecodeError:
-                        # If we can't decode yet, there might be more data coming
-                        # Check if we have multiple messages concatenated
-                        try:
-                            # Find the end of the first JSON object
-                            pos = accumulated_data.find(b'}') + 1
-                            if pos > 0:
-                                first_message = accumulated_data[:pos]
-                                remaining_data = accumulated_data[pos:]
-                                
-                                message = json.loads(first_message.decode('utf-8'))
-                                accumulated_data = remaining_data
-                                
-                                # Process the message (same logic as above)
-                                # Duplicate the message processing logic here
-                                if message['type'] == 'TEXT_MESSAGE':
-                                    is_me = (message['sender'] == self.nick_entry.get())
-                                    self.root.after(0, lambda m=message, me=is_me: self.display_chat_bubble(
-                                        m['sender'],
-                                        m['message'],
-                                        is_me=me,
-                                        time=m.get('time')
-                                    ))
-                                elif message['type'] == 'WHISPER':
-                                    is_me = (message['sender'] == self.nick_entry.get())
-                                    self.root.after(0, lambda m=message, me=is_me: self.display_chat_bubble(
-                                        m['sender'],
-                                        m['message'],
-                                        is_me=me,
-                                        is_whisper=True,
-                                        time=m.get('time')
-                                    ))
-                                elif message['type'] == 'FILE_AVAILABLE':
-                                    is_me = (message['sender'] == self.nick_entry.get())
-                                    self.root.after(0, lambda m=message, me=is_me: self.display_file_message(
-                                        m['filename'],
-                                        {
-                                            "size": m['size'],
-                                            "sender": m['sender'],
-                                            "private": m.get('private', False),
-                                            "time": m.get('time'),
-                                            "is_image": any(m['filename'].lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']),
-                                            "type": "Image" if any(m['filename'].lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']) else "Document",
-                                            "name": m['filename']
-                                        }
-                                    ))
-                                elif message['type'] == 'SYSTEM_MESSAGE':
-                                    self.root.after(0, lambda m=message: self.display_system_message(
-                                        m['message']
-                                    ))
-                                elif message['type'] == 'USER_LIST':
-                                    if isinstance(message.get('users'), list):
-                                        # Store client list for user interaction
-                                        self.clients = {user: {"nickname": user} for user in message['users']}
-                                        self.root.after(0, lambda m=message: self.update_user_list(
-                                            m['users']
-                                        ))
-                                continue  # Continue processing remaining data
-                            else:
-                                # No complete message yet
-                                break
-                        except (json.JSONDecodeError, ValueError):
-                            # If still can't parse, wait for more data
-                            break
+                self.decoder.feed(chunk)
             
             except (ConnectionError, socket.error) as e:
                 print(f"Connection error: {e}")
-                self.root.after(0, self.disconnect)
+                self.root.after(0, lambda: self.disconnect(lost=True))
                 break
             except Exception as e:
                 print(f"Error in receive loop: {str(e)}")
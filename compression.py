@@ -0,0 +1,131 @@
+import lzma
+import os
+import threading
+import time
+import zlib
+
+# Optional compression, negotiated in the nickname handshake: the client
+# lists the codecs it has ("compression": ["zlib", "lzma"]) and the welcome
+# message answers with the ones both sides will use.
+#
+# Message stream: with "zlib" agreed, each side runs one compressor per
+# connection for its JSON frames. A writer batch of frames goes in, is
+# sync-flushed and goes out as a single frame with COMPRESSED_FLAG (see
+# protocol.py). The compressor's window carries over from batch to batch, so
+# the keys, nicknames and room names every message repeats cost a few bits
+# each. lzma cannot flush mid-stream and is only used for file bodies.
+#
+# File bodies: FILE_METADATA and FILE_REQUEST may name a codec for the
+# transfer. Every data chunk is then compressed on its own, so ranges, resume
+# and the per-chunk checksums (of the uncompressed bytes) work exactly as
+# before, and a chunk that does not get smaller is sent as it is. Files whose
+# type is already compressed are never compressed again.
+
+CODECS = ("zlib", "lzma")
+MESSAGE_CODEC = "zlib"
+
+COMPRESSED_SUFFIXES = {
+    '.7z', '.aac', '.avi', '.bz2', '.docx', '.flac', '.gif', '.gz', '.heic', '.jpeg',
+    '.jpg', '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.ogg', '.opus', '.png', '.pptx',
+    '.rar', '.tgz', '.webm', '.webp', '.xlsx', '.xz', '.zip', '.zst'
+}
+
+
+class CompressionStats:
+    # Bytes in and out and the CPU time spent, over every connection
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.cpu_seconds = 0.0
+
+    def add(self, raw, compressed, started):
+        with self.lock:
+            self.raw_bytes += raw
+            self.compressed_bytes += compressed
+            self.cpu_seconds += time.thread_time() - started
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "raw_bytes": self.raw_bytes,
+                "compressed_bytes": self.compressed_bytes,
+                "cpu_seconds": round(self.cpu_seconds, 3)
+            }
+
+
+stats = CompressionStats()
+
+
+def negotiate(offered):
+    # The codecs out of what the peer offered that we support too
+    if not isinstance(offered, list):
+        return []
+    return [codec for codec in CODECS if codec in offered]
+
+
+def worth_compressing(filename):
+    return os.path.splitext(filename)[1].lower() not in COMPRESSED_SUFFIXES
+
+
+class MessageCompressor:
+    def __init__(self):
+        self.zlib = zlib.compressobj()
+
+    def compress(self, segments):
+        # One sync-flushed piece of the stream holding all of segments
+        started = time.thread_time()
+        parts = [self.zlib.compress(segment) for segment in segments]
+        parts.append(self.zlib.flush(zlib.Z_SYNC_FLUSH))
+        data = b''.join(parts)
+        stats.add(sum(len(segment) for segment in segments), len(data), started)
+        return data
+
+
+class MessageDecompressor:
+    def __init__(self):
+        self.zlib = zlib.decompressobj()
+
+    def decompress(self, data, limit):
+        # A small frame must not be able to inflate into gigabytes
+        started = time.thread_time()
+        try:
+            output = self.zlib.decompress(data, limit)
+        except zlib.error as e:
+            raise ValueError(f"Bad compressed frame: {e}")
+        if self.zlib.unconsumed_tail:
+            raise ValueError(f"Compressed frame inflates past {limit} bytes")
+        stats.add(len(output), len(data), started)
+        return output
+
+
+def compress_chunk(codec, data):
+    # data compressed with codec, or None if that does not make it smaller
+    started = time.thread_time()
+    if codec == "lzma":
+        packed = lzma.compress(data, preset=1)
+    else:
+        packed = zlib.compress(data, 1)
+    stats.add(len(data), min(len(packed), len(data)), started)
+    return packed if len(packed) < len(data) else None
+
+
+def decompress_chunk(codec, data, limit):
+    started = time.thread_time()
+    try:
+        if codec == "lzma":
+            decompressor = lzma.LZMADecompressor()
+            output = decompressor.decompress(data, limit)
+            complete = decompressor.eof
+        elif codec == "zlib":
+            decompressor = zlib.decompressobj()
+            output = decompressor.decompress(data, limit)
+            complete = decompressor.eof
+        else:
+            raise ValueError(f"Unknown codec {codec}")
+    except (lzma.LZMAError, zlib.error) as e:
+        raise ValueError(f"Bad compressed chunk: {e}")
+    if not complete:
+        raise ValueError("Compressed chunk is truncated or too large")
+    stats.add(len(output), len(data), started)
+    return output
@@ -0,0 +1,191 @@
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# Structured event log. Server code calls event_log.log("connection_opened",
+# "Connection from ...", address=...) instead of print(): that only puts a
+# tuple on a queue, so a handler holding a socket never waits on stdout or
+# on disk. A writer thread takes whatever has queued up, writes it as JSON
+# lines, one object per event,
+#
+#     {"ts": "2024-05-01T12:00:00.123456+00:00", "level": "info",
+#      "event": "upload_finished", "message": "...", "nickname": "alice", ...}
+#
+# to the log file, and echoes each event's message to stdout as before. The
+# file is rotated past max_bytes: <name>.1 is the previous one, up to
+# <name>.<backups>.
+#
+# When the writer falls max_pending events behind, the overflow policy
+# decides: drop the new event, drop the oldest queued one, or block the
+# caller until there is room. Dropped events are counted, and the count
+# is logged once the writer catches up.
+
+INFO = "info"
+WARNING = "warning"
+ERROR = "error"
+
+DROP_NEWEST = "drop-newest"
+DROP_OLDEST = "drop-oldest"
+BLOCK = "block"
+OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST, BLOCK)
+
+ROTATE_BYTES = 64 * 1024 * 1024
+BACKUPS = 5
+MAX_PENDING = 100000
+
+
+class EventLog:
+    def __init__(self, echo=True):
+        self.echo = echo
+        self.pending = queue.Queue(MAX_PENDING)
+        self.overflow = DROP_NEWEST
+        self.dropped = 0
+        self.reported = 0
+        # Guards the file and its settings; only configure() competes with
+        # the writer for it
+        self.lock = threading.Lock()
+        self.path = None
+        self.file = None
+        self.size = 0
+        self.max_bytes = ROTATE_BYTES
+        self.backups = BACKUPS
+        self.writer = None
+        # A forked worker has no writer thread, and whatever the parent had
+        # queued is the parent's to write
+        os.register_at_fork(after_in_child=self.forked)
+
+    def forked(self):
+        self.pending = queue.Queue(self.pending.maxsize)
+        self.lock = threading.Lock()
+        self.writer = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def configure(self, path, max_bytes=ROTATE_BYTES, backups=BACKUPS,
+                  max_pending=MAX_PENDING, overflow=DROP_NEWEST):
+        # Log to path from now on (None: stdout only)
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.path = path
+            self.max_bytes = max_bytes
+            self.backups = backups
+            if path is not None:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                self.file = open(path, 'a', encoding='utf-8')
+                self.size = self.file.tell()
+        with self.pending.mutex:
+            self.pending.maxsize = max_pending
+        self.overflow = overflow
+
+    def log(self, event, message=None, level=INFO, **fields):
+        # Never waits, except under the block policy with the writer behind
+        if self.writer is None:
+            self.start()
+        item = (time.time(), level, event, message, fields)
+        try:
+            if self.overflow == BLOCK:
+                self.pending.put(item)
+            else:
+                self.pending.put_nowait(item)
+        except queue.Full:
+            if self.overflow == DROP_OLDEST:
+                try:
+                    self.release(self.pending.get_nowait())
+                    self.pending.put_nowait(item)
+                except (queue.Empty, queue.Full):
+                    pass
+            self.dropped += 1
+
+    def release(self, item):
+        # A queued item taken out unwritten; flush() callers still get woken
+        if isinstance(item, threading.Event):
+            item.set()
+
+    def flush(self, timeout=None):
+        # Waits until everything logged so far is written
+        if self.writer is None:
+            return
+        done = threading.Event()
+        self.pending.put(done)
+        done.wait(timeout)
+
+    def start(self):
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_events, daemon=True)
+                self.writer.start()
+                atexit.register(self.flush, 1.0)
+
+    def write_events(self):
+        while True:
+            batch = [self.pending.get()]
+            while True:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            if self.dropped != self.reported:
+                lost = self.dropped - self.reported
+                self.reported = self.dropped
+                batch.append((time.time(), WARNING, "log_overflow",
+                              f"Event log is behind, {lost} events dropped",
+                              {"dropped": lost, "dropped_total": self.reported}))
+            done = [item for item in batch if isinstance(item, threading.Event)]
+            events = [item for item in batch if not isinstance(item, threading.Event)]
+            try:
+                self.write(events)
+            except (OSError, ValueError) as e:
+                sys.stderr.write(f"Event log write error: {str(e)}\n")
+            for item in done:
+                item.set()
+
+    def write(self, events):
+        lines = []
+        console = []
+        for stamp, level, event, message, fields in events:
+            record = {
+                "ts": datetime.fromtimestamp(stamp, timezone.utc).isoformat(),
+                "level": level,
+                "event": event
+            }
+            if message is not None:
+                record["message"] = message
+                console.append(message + "\n")
+            record.update(fields)
+            lines.append(json.dumps(record, default=str) + "\n")
+        with self.lock:
+            if self.file is not None:
+                data = "".join(lines)
+                self.file.write(data)
+                self.file.flush()
+                self.size += len(data)
+                if self.max_bytes and self.size >= self.max_bytes:
+                    self.rotate()
+        if self.echo and console:
+            sys.stdout.write("".join(console))
+            sys.stdout.flush()
+
+    def rotate(self):
+        # Caller holds the lock
+        self.file.close()
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{n}"):
+                os.replace(f"{self.path}.{n}", f"{self.path}.{n + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.size = 0
+
+
+# The log every part of the server writes to; the server configures its file
+event_log = EventLog()
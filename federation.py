@@ -0,0 +1,504 @@
+import hashlib
+import hmac
+import json
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+from protocol import HEADER, FrameDecoder, clamp_range, encode_frame, encode_message
+from eventlog import WARNING, event_log
+
+# Federation: several independent server.py nodes, on one machine or many,
+# acting as one chat. Every node listens on a peer port and dials the peers it
+# was given; links are plain TCP carrying length-prefixed JSON events, the
+# same events workers exchange over their local bus (room messages, whispers,
+# presence, users, new files).
+#
+# The nodes need not be fully meshed. Every event carries (origin, epoch,
+# seq) and the list of nodes it has been through; a node drops events it has
+# already seen and relays the rest to peers that are neither on that list
+# nor known direct neighbours of the origin, so floods always terminate and
+# a full mesh sends each event exactly once per link.
+#
+# Events addressed to particular nodes ("to") go straight down the link to
+# them when there is one. Whispers use this: each node keeps a directory of
+# which nodes have which nicknames connected (built from "user" events) and
+# only sends a whisper to the owners of the target nickname.
+#
+# When a link comes up both sides send a "sync" snapshot of their local
+# users, rooms and files. When it goes down the node tells everyone else
+# ("node_lost"); every node without its own link to the lost one forgets
+# everything it announced and asks for a fresh snapshot, which only arrives
+# if it is still reachable some other way.
+#
+# Files stay on the node they were uploaded to. A FILE_REQUEST for a file
+# held elsewhere opens a separate connection to the holder's peer port and
+# streams the bytes through, so big downloads never hold up the event links.
+#
+# Every node shares a secret (--peer-secret). Both ends of a link prove
+# they know it by signing the other's random nonce, then sign every event
+# with a key derived from both nonces and a running count, so events cannot
+# be forged, altered or replayed. A file fetch answers a challenge the same
+# way. Whatever a peer says about a file, the file is always on that peer:
+# a peer never gets to name a path on this machine.
+
+RECONNECT_DELAY = 2.0
+FETCH_TIMEOUT = 30.0
+
+# How many recent event ids to remember for duplicate suppression
+SEEN_EVENTS = 65536
+NONCE_SIZE = 16
+MAC_SIZE = hashlib.sha256().digest_size
+# What a node keeps of a peer's announcement of a file
+FILE_FIELDS = ('size', 'content', 'sender', 'target', 'time')
+
+
+def parse_address(text, default_host='127.0.0.1'):
+    host, _, port = text.strip().rpartition(':')
+    return (host or default_host, int(port))
+
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Peer closed the connection")
+        data += chunk
+    return bytes(data)
+
+
+def sign(key, *parts):
+    # HMAC-SHA256 over length-prefixed parts, so they cannot run together
+    return hmac.new(key, b"".join(len(part).to_bytes(4, 'big') + part for part in parts),
+                    hashlib.sha256).digest()
+
+
+def canonical(message):
+    return json.dumps(message, sort_keys=True).encode('utf-8')
+
+
+def read_frame(sock):
+    # One length-prefixed JSON frame, reading nothing past its end
+    (length,) = HEADER.unpack(recv_exact(sock, HEADER.size))
+    return json.loads(recv_exact(sock, length).decode('utf-8'))
+
+
+class PeerLink:
+    def __init__(self, sock, address=None):
+        # address is the configured peer address for links we dialled
+        self.socket = sock
+        self.address = address
+        self.outgoing = address is not None
+        self.node = None
+        self.lock = threading.Lock()
+        # Set once the peer has proved it knows the secret
+        self.send_key = None
+        self.receive_key = None
+        self.sent = 0
+        self.received = 0
+
+    def send(self, data):
+        try:
+            with self.lock:
+                self.socket.sendall(data)
+        except OSError:
+            # The reader notices the dead link and cleans up
+            pass
+
+    def authenticated(self, send_key, receive_key):
+        self.send_key = send_key
+        self.receive_key = receive_key
+
+    def send_event(self, payload):
+        # Signed with the number of events sent before it on this link
+        try:
+            with self.lock:
+                mac = sign(self.send_key, self.sent.to_bytes(8, 'big'), payload)
+                self.sent += 1
+                self.socket.sendall(encode_frame(mac + payload))
+        except OSError:
+            pass
+
+    def open_event(self, frame):
+        mac, payload = frame[:MAC_SIZE], frame[MAC_SIZE:]
+        expected = sign(self.receive_key, self.received.to_bytes(8, 'big'), payload)
+        if not hmac.compare_digest(mac, expected):
+            raise ConnectionError("Event failed authentication")
+        self.received += 1
+        return json.loads(payload.decode('utf-8'))
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+class RemoteFile:
+    # File-like reader over a fetch connection to the node holding a file,
+    # on behalf of nickname
+    def __init__(self, address, filename, offset, length, nickname, secret):
+        self.socket = socket.create_connection(address, timeout=FETCH_TIMEOUT)
+        self.stream = self.socket.makefile('rb')
+        try:
+            request = {"fetch": filename, "offset": offset, "length": length,
+                       "nickname": nickname}
+            self.socket.sendall(encode_message(request, True))
+            challenge = bytes.fromhex(read_frame(self.socket)['challenge'])
+            proof = sign(secret, b"fetch", challenge, canonical(request))
+            self.socket.sendall(encode_message({"proof": proof.hex()}, True))
+            reply = read_frame(self.socket)
+            if 'error' in reply:
+                raise FileNotFoundError(reply['error'])
+            self.remaining = int(reply['size'])
+        except BaseException:
+            self.close()
+            raise
+
+    def read(self, size):
+        if self.remaining <= 0:
+            return b''
+        data = self.stream.read(min(size, self.remaining))
+        if not data:
+            raise ConnectionError("Remote file transfer interrupted")
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.stream.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Federation:
+    # Plays the same role as workers.EventBusClient: the server publishes its
+    # events here and gets everyone else's through dispatch_bus_event
+    def __init__(self, server, node_id, host, peer_port, secret, peers=()):
+        self.server = server
+        self.node_id = node_id
+        self.peer_port = peer_port
+        self.secret = secret
+        # Tells this run's events apart from those of a restarted node
+        self.epoch = os.urandom(4).hex()
+        self.seq = count(1)
+
+        self.lock = threading.Lock()
+        # Events from all links reach the server one at a time, as they do
+        # from the single worker bus
+        self.dispatch_lock = threading.Lock()
+        self.links = {}
+        self.addresses = {}
+        self.neighbours = {}
+        self.dialed = {}
+        self.seen = OrderedDict()
+        self.running = True
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, peer_port))
+        self.listener.listen()
+        event_log.log("node_started", f"Node {node_id} accepting peers on {host}:{peer_port}",
+                      node=node_id, host=host, port=peer_port)
+        threading.Thread(target=self.accept_peers, daemon=True).start()
+        for peer in peers:
+            threading.Thread(target=self.dial, args=(peer,), daemon=True).start()
+
+    def accept_peers(self):
+        while self.running:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handle_incoming, args=(sock,), daemon=True).start()
+
+    def handle_incoming(self, sock):
+        # The first frame says whether this is a peer link or a file fetch
+        try:
+            sock.settimeout(5.0)
+            first = read_frame(sock)
+            if 'fetch' in first:
+                first = self.authenticate_fetch(sock, first)
+            sock.settimeout(None)
+        except (OSError, ValueError, KeyError) as e:
+            event_log.log("peer_error", f"Peer handshake error: {str(e)}", WARNING, error=str(e))
+            sock.close()
+            return
+        if 'fetch' in first:
+            self.serve_fetch(sock, first)
+        else:
+            self.run_link(PeerLink(sock), first)
+
+    def authenticate_fetch(self, sock, request):
+        # The fetcher signs a fresh challenge together with its request
+        challenge = os.urandom(NONCE_SIZE)
+        sock.sendall(encode_message({"challenge": challenge.hex()}, True))
+        proof = bytes.fromhex(read_frame(sock)['proof'])
+        if not hmac.compare_digest(proof, self.sign(b"fetch", challenge, canonical(request))):
+            sock.sendall(encode_message({"error": "Not authenticated"}, True))
+            raise ConnectionError("File fetch failed authentication")
+        return request
+
+    def dial(self, address):
+        while self.running:
+            node = self.dialed.get(address)
+            if node is None or node not in self.links:
+                try:
+                    sock = socket.create_connection(address, timeout=5.0)
+                    sock.settimeout(None)
+                    self.run_link(PeerLink(sock, address))
+                except OSError:
+                    pass
+            time.sleep(RECONNECT_DELAY)
+
+    def sign(self, *parts):
+        return sign(self.secret, *parts)
+
+    def hello(self, nonce):
+        return encode_message({"node": self.node_id, "port": self.peer_port, "nonce": nonce.hex()},
+                              True)
+
+    def run_link(self, link, first=None):
+        # Handshake, then read events until the link drops
+        nonce = os.urandom(NONCE_SIZE)
+        link.send(self.hello(nonce))
+        decoder = FrameDecoder()
+        try:
+            if first is None:
+                first = self.read_hello(link, decoder)
+            link.node = first['node']
+            if not isinstance(link.node, str) or link.node == self.node_id:
+                link.close()
+                return
+            self.authenticate(link, decoder, nonce, bytes.fromhex(first['nonce']))
+            address = (link.socket.getpeername()[0], first['port'])
+            if link.outgoing:
+                self.dialed[link.address] = link.node
+            if not self.add_link(link, address):
+                link.close()
+                return
+            self.link_up(link.node)
+
+            while True:
+                data = link.socket.recv(65536)
+                if not data:
+                    break
+                decoder.feed(data)
+                for frame in iter(decoder.next_frame, None):
+                    self.receive(link, link.open_event(frame))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            event_log.log("peer_error", f"Peer link error: {str(e)}", WARNING, node=link.node,
+                          error=str(e))
+        finally:
+            link.close()
+            if link.node is not None and self.remove_link(link):
+                self.link_down(link.node)
+
+    def authenticate(self, link, decoder, nonce, peer_nonce):
+        # Each side signs both nonces and its own node id; a link whose peer
+        # does not know the secret never gets an event. The dialling side
+        # proves itself first, so connecting is no way to get a signature.
+        proof = self.sign(b"link", peer_nonce, nonce, self.node_id.encode('utf-8'))
+        if link.outgoing:
+            link.send(encode_message({"proof": proof.hex()}, True))
+        peer_proof = bytes.fromhex(self.read_hello(link, decoder)['proof'])
+        expected = self.sign(b"link", nonce, peer_nonce, link.node.encode('utf-8'))
+        if not hmac.compare_digest(peer_proof, expected):
+            event_log.log("peer_rejected", f"Node {link.node} failed authentication", WARNING,
+                          node=link.node, address=link.socket.getpeername())
+            raise ConnectionError("Peer failed authentication")
+        if not link.outgoing:
+            link.send(encode_message({"proof": proof.hex()}, True))
+        link.authenticated(self.sign(b"events", nonce, peer_nonce),
+                           self.sign(b"events", peer_nonce, nonce))
+
+    def read_hello(self, link, decoder):
+        while True:
+            hello = decoder.next_message()
+            if hello is not None:
+                return hello
+            data = link.socket.recv(4096)
+            if not data:
+                raise ConnectionError("Peer closed the connection")
+            decoder.feed(data)
+
+    def add_link(self, link, address):
+        # If both sides dialled each other, keep the link dialled by the
+        # smaller node id; both ends agree on which one that is
+        with self.lock:
+            existing = self.links.get(link.node)
+            if existing is not None:
+                dialer = self.node_id if link.outgoing else link.node
+                if dialer != min(self.node_id, link.node):
+                    return False
+                existing.close()
+            self.links[link.node] = link
+            self.addresses[link.node] = address
+            return True
+
+    def remove_link(self, link):
+        with self.lock:
+            if self.links.get(link.node) is not link:
+                return False
+            del self.links[link.node]
+            return True
+
+    def link_up(self, node):
+        event_log.log("peer_linked", f"Linked to node {node}", node=node)
+        self.publish_links()
+        self.publish(dict(self.server.local_state(), kind="sync", to=[node]))
+
+    def link_down(self, node):
+        event_log.log("peer_lost", f"Lost link to node {node}", WARNING, node=node)
+        self.publish_links()
+        self.publish({"kind": "node_lost", "node": node})
+        self.forget(node)
+
+    def forget(self, node):
+        self.dispatch({"kind": "peer_lost", "origin": node})
+        self.publish({"kind": "sync_request", "to": [node]})
+
+    def publish_links(self):
+        # Peer addresses go along so nodes further away can fetch files
+        with self.lock:
+            peers = {node: list(self.addresses[node]) for node in self.links}
+        self.publish({"kind": "links", "peers": peers})
+
+    def publish(self, event):
+        event.update(origin=self.node_id, epoch=self.epoch, seq=next(self.seq), via=[])
+        self.remember(event)
+        self.forward(event)
+
+    def remember(self, event):
+        # Returns False for an event that has been seen before
+        key = (event['origin'], event['epoch'], event['seq'])
+        with self.lock:
+            if key in self.seen:
+                return False
+            self.seen[key] = True
+            if len(self.seen) > SEEN_EVENTS:
+                self.seen.popitem(last=False)
+            return True
+
+    def forward(self, event):
+        event['via'] = event['via'] + [self.node_id]
+        payload = json.dumps(event).encode('utf-8')
+        targets = event.get('to')
+        with self.lock:
+            links = dict(self.links)
+            origin_peers = self.neighbours.get(event['origin'], ())
+        if targets:
+            targets = [node for node in targets if node != self.node_id]
+            if not targets:
+                return
+            if all(node in links for node in targets):
+                for node in targets:
+                    links[node].send_event(payload)
+                return
+        for node, link in links.items():
+            if node in event['via'] or node == event['origin']:
+                continue
+            if event['origin'] != self.node_id and node in origin_peers:
+                # The origin sent it to them itself
+                continue
+            link.send_event(payload)
+
+    def receive(self, link, event):
+        if event['origin'] == self.node_id or not self.remember(event):
+            return
+        targets = event.get('to')
+        if not targets or self.node_id in targets:
+            kind = event.get('kind')
+            if kind == 'links':
+                with self.lock:
+                    self.neighbours[event['origin']] = event['peers']
+            elif kind == 'node_lost':
+                if event['node'] != self.node_id and event['node'] not in self.links:
+                    self.forget(event['node'])
+            elif kind == 'sync_request':
+                self.publish(dict(self.server.local_state(), kind="sync", to=[event['origin']]))
+            else:
+                self.dispatch(self.checked(event))
+        self.forward(event)
+
+    def checked(self, event):
+        # A copy of event for the server in which every file is on its origin
+        # node, with no local path
+        kind = event.get('kind')
+        if kind == 'file':
+            event = dict(event, file=peer_file(event['file'], event['origin']))
+        elif kind == 'sync':
+            event = dict(event, files={name: peer_file(info, event['origin'])
+                                       for name, info in event['files'].items()})
+        return event
+
+    def dispatch(self, event):
+        with self.dispatch_lock:
+            self.server.dispatch_bus_event(event)
+
+    def open_remote_file(self, node, filename, offset=0, length=None, nickname=None):
+        with self.lock:
+            address = self.addresses.get(node) if node in self.links else None
+            for peers in self.neighbours.values():
+                if address is None and node in peers:
+                    address = tuple(peers[node])
+        if address is None:
+            raise ConnectionError(f"No route to node {node}")
+        return RemoteFile(address, filename, offset, length, nickname, self.secret)
+
+    def serve_fetch(self, sock, request):
+        # For a peer that authenticated; the file must be one the user it
+        # fetches for could download here
+        filename = request['fetch']
+        try:
+            try:
+                offset = int(request.get('offset', 0))
+                length = request.get('length')
+                length = None if length is None else int(length)
+                info = self.server.files.get(filename)
+            except (TypeError, ValueError):
+                sock.sendall(encode_message({"error": "Bad fetch request"}, True))
+                return
+            if (info is None or self.server.is_remote(info)
+                    or not self.server.can_download(request.get('nickname'), info)):
+                sock.sendall(encode_message({"error": f"{filename} is not stored here"}, True))
+                return
+            with open(info['path'], 'rb') as f:
+                offset, length = clamp_range(os.fstat(f.fileno()).st_size, offset, length)
+                sock.sendall(encode_message({"size": length}, True))
+                sock.sendfile(f, offset, length)
+        except OSError as e:
+            event_log.log("fetch_error", f"File fetch error: {str(e)}", WARNING, error=str(e))
+        finally:
+            sock.close()
+
+    def close(self):
+        self.running = False
+        self.listener.close()
+        with self.lock:
+            links = list(self.links.values())
+        for link in links:
+            link.close()
+
+
+def peer_file(info, origin):
+    file = {field: info[field] for field in FILE_FIELDS if field in info}
+    file['node'] = origin
+    return file
+
+
+def federate(server, args):
+    node_id = args.node_id or f"{socket.gethostname()}:{args.port}"
+    peers = [parse_address(peer) for peer in args.peers.split(',') if peer.strip()]
+    server.node_id = node_id
+    server.bus = Federation(server, node_id, args.host, args.peer_port,
+                            args.peer_secret.encode('utf-8'), peers)
+    return server.bus
@@ -0,0 +1,199 @@
+import hashlib
+import os
+import time
+import uuid
+import zlib
+from array import array
+from protocol import STREAM_CHUNK
+
+# Content-addressed storage for uploaded files. Every distinct content is
+# stored once, as blobs/<sha256>, and every filename that refers to it holds
+# its own hard link links/<sha256>-<token> to the same inode. The link count
+# is the reference count: releasing a name removes its link, and the blob
+# goes when nothing but the blob itself is left. Keeping the count in the
+# file system means sibling worker processes sharing server_files agree on
+# it without talking to each other.
+#
+# Uploads are written to tmp/ and hashed as they stream in; commit() links
+# the finished file in under its digest, or drops it if the content was
+# already there. An upload started with a transfer id keeps its partial file
+# as tmp/<transfer> when the connection drops, so the client can carry on
+# from where it stopped; partial files nobody came back for are swept after
+# PARTIAL_TTL.
+#
+# The list of shared files lives in the server's memory, so links left by
+# an earlier run refer to names nobody can see any more: the first process
+# of a run (the parent, with workers) clears them with clear_links(), and
+# the blobs they were keeping go with them.
+#
+# Each blob also gets blobs/<sha256>.crc: the CRC-32 of every STREAM_CHUNK
+# of it, so checksummed data frames can be sent with sendfile() without
+# reading the file.
+
+HASH = 'sha256'
+PARTIAL_TTL = 24 * 3600
+
+
+def is_content_id(text):
+    return isinstance(text, str) and len(text) == 64 and all(c in '0123456789abcdef' for c in text)
+
+
+def is_transfer_id(text):
+    return (isinstance(text, str) and 16 <= len(text) <= 64
+            and all(c in '0123456789abcdef' for c in text))
+
+
+class Upload:
+    # A file being received: written to a temporary file and hashed on the way
+    def __init__(self, store, transfer=None):
+        self.store = store
+        self.transfer = transfer
+        self.temp_path = os.path.join(store.tmp_dir, transfer or uuid.uuid4().hex)
+        self.digest = hashlib.new(HASH)
+        self.checksums = array('I')
+        self.crc = 0
+        self.chunk_fill = 0
+        self.size = 0
+        if transfer is not None and os.path.exists(self.temp_path):
+            # Resuming: rebuild the running hashes from what is already here
+            with open(self.temp_path, 'rb') as f:
+                while True:
+                    data = f.read(STREAM_CHUNK)
+                    if not data:
+                        break
+                    self.update(data)
+            self.file = open(self.temp_path, 'ab')
+        else:
+            self.file = open(self.temp_path, 'wb')
+        # What this attempt has to receive is timed for transfer speed
+        self.started = time.monotonic()
+        self.resumed_size = self.size
+
+    def update(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        while data:
+            part = data[:STREAM_CHUNK - self.chunk_fill]
+            self.crc = zlib.crc32(part, self.crc)
+            self.chunk_fill += len(part)
+            if self.chunk_fill == STREAM_CHUNK:
+                self.checksums.append(self.crc)
+                self.crc = 0
+                self.chunk_fill = 0
+            data = data[len(part):]
+
+    def write(self, data):
+        self.file.write(data)
+        self.update(data)
+
+    def commit(self):
+        # Returns (content_id, path of a new reference to it)
+        self.file.close()
+        if self.chunk_fill:
+            self.checksums.append(self.crc)
+        content_id = self.digest.hexdigest()
+        path = self.store.link_path(content_id)
+        blob = self.store.blob_path(content_id)
+        try:
+            os.link(self.temp_path, blob)
+            with open(blob + '.crc', 'wb') as f:
+                self.checksums.tofile(f)
+        except FileExistsError:
+            # Known content: refer to the stored copy and drop ours
+            os.link(blob, path)
+        else:
+            os.link(self.temp_path, path)
+        os.remove(self.temp_path)
+        return content_id, path
+
+    def suspend(self):
+        # Keep the partial file for a later resume, if there can be one
+        if self.transfer is None:
+            self.discard()
+        else:
+            self.file.close()
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+
+class FileStore:
+    def __init__(self, root):
+        self.blob_dir = os.path.join(root, 'blobs')
+        self.links_dir = os.path.join(root, 'links')
+        self.tmp_dir = os.path.join(root, 'tmp')
+        for directory in (self.blob_dir, self.links_dir, self.tmp_dir):
+            os.makedirs(directory, exist_ok=True)
+        self.sweep_partials()
+
+    def sweep_partials(self):
+        cutoff = time.time() - PARTIAL_TTL
+        for entry in os.scandir(self.tmp_dir):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def clear_links(self):
+        # Only safe before any process of this run takes references
+        for entry in os.scandir(self.links_dir):
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+        for entry in os.scandir(self.blob_dir):
+            try:
+                if entry.name.endswith('.crc'):
+                    if not os.path.exists(entry.path[:-len('.crc')]):
+                        os.remove(entry.path)
+                elif entry.stat().st_nlink == 1:
+                    os.remove(entry.path)
+                    os.remove(entry.path + '.crc')
+            except OSError:
+                pass
+
+    def blob_path(self, content_id):
+        return os.path.join(self.blob_dir, content_id)
+
+    def link_path(self, content_id):
+        return os.path.join(self.links_dir, f"{content_id}-{uuid.uuid4().hex[:12]}")
+
+    def begin(self, transfer=None):
+        # Uploads with a valid transfer id can be resumed after a disconnect
+        return Upload(self, transfer if is_transfer_id(transfer) else None)
+
+    def checksums(self, content_id):
+        # Per-chunk CRC-32s of a blob, or None for blobs stored without them
+        table = array('I')
+        try:
+            with open(self.blob_path(content_id) + '.crc', 'rb') as f:
+                table.frombytes(f.read())
+        except (OSError, TypeError):
+            return None
+        return table
+
+    def reference(self, content_id):
+        # A new reference to content we already have, or None
+        if not is_content_id(content_id):
+            return None
+        path = self.link_path(content_id)
+        try:
+            os.link(self.blob_path(content_id), path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def release(self, content_id, path):
+        try:
+            os.remove(path)
+            blob = self.blob_path(content_id)
+            if os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+                os.remove(blob + '.crc')
+        except FileNotFoundError:
+            pass
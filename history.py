@@ -0,0 +1,459 @@
+import bisect
+import json
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from array import array
+from eventlog import ERROR, WARNING, event_log
+
+# Persistent chat history: an append-only log of the messages the server
+# delivered (room messages, whispers, file announcements), numbered with a
+# sequence number that only ever grows.
+#
+# The log is a directory of segments, <first seq>.log, each a run of records
+#
+#     [payload length][CRC-32 of the payload][JSON payload]
+#
+# and next to it <first seq>.idx, the offset index: one (seq, position, key)
+# entry per audience the record belongs to. A room message has the key of
+# its room, a whisper or private file one key per participant, so a page of
+# one room's history is a bisect and a walk over that room's postings instead
+# of a scan of the log. The index is held in memory per segment and records
+# are read through mmap, so serving HISTORY costs no syscalls per message.
+#
+# Appends never happen on the caller's thread: record() only queues the
+# message, numbered by the server, for the writer thread, which writes in
+# batches and then makes the batch visible to readers. When the active segment is past
+# SEGMENT_BYTES it is sealed and a new one started. Sealed segments are
+# compacted in the background: records that no audience keeps any more
+# (each keeps its newest KEEP_PER_KEY) are dropped, and small neighbours are
+# merged into one segment. Past MAX_HISTORY_BYTES the oldest segments go.
+
+RECORD = struct.Struct('!II')
+INDEX = struct.Struct('!QQI')
+
+SEGMENT_BYTES = 16 * 1024 * 1024
+MAX_HISTORY_BYTES = 1024 * 1024 * 1024
+KEEP_PER_KEY = 10000
+# Messages waiting for the writer; past this new ones are not recorded
+MAX_PENDING = 100000
+PAGE_LIMIT = 100
+
+
+def room_key(room):
+    return "#" + room
+
+
+def user_key(nickname):
+    return "@" + nickname
+
+
+def key_hash(key):
+    return zlib.crc32(key.encode('utf-8'))
+
+
+class Segment:
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base
+        self.size = 0
+        self.count = 0
+        self.live = 0
+        self.last = base - 1
+        # key hash -> (seqs, positions), both in log order
+        self.postings = {}
+        self.map = None
+
+    def add(self, seq, position, key):
+        seqs, positions = self.postings.get(key) or self.postings.setdefault(
+            key, (array('Q'), array('Q')))
+        seqs.append(seq)
+        positions.append(position)
+
+    def records(self):
+        # (seq, position, payload) of every intact record, in order
+        with open(self.path + '.log', 'rb') as f:
+            data = f.read()
+        position = 0
+        while position + RECORD.size <= len(data):
+            length, crc = RECORD.unpack_from(data, position)
+            payload = data[position + RECORD.size:position + RECORD.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            yield json.loads(payload)['seq'], position, payload
+            position += RECORD.size + length
+
+    def load(self, trusted_index):
+        # Postings from the .idx file, or rebuilt from the log itself when
+        # the index may be behind (the active segment after a crash) or does
+        # not match the log (a compaction cut short)
+        self.size = os.path.getsize(self.path + '.log')
+        if trusted_index and self.load_index():
+            return
+        self.postings = {}
+        self.count = 0
+        end = 0
+        with open(self.path + '.idx', 'wb') as index:
+            for seq, position, payload in self.records():
+                for key in json.loads(payload)['keys']:
+                    self.add(seq, position, key_hash(key))
+                    index.write(INDEX.pack(seq, position, key_hash(key)))
+                self.count += 1
+                self.last = seq
+                end = position + RECORD.size + len(payload)
+        if end < self.size:
+            # A record cut short by a crash; the next append goes after it
+            os.truncate(self.path + '.log', end)
+            self.size = end
+
+    def load_index(self):
+        try:
+            with open(self.path + '.idx', 'rb') as f:
+                data = f.read()
+        except OSError:
+            return False
+        if not data or len(data) % INDEX.size:
+            return False
+        positions = set()
+        for seq, position, key in INDEX.iter_unpack(data):
+            self.add(seq, position, key)
+            positions.add(position)
+            self.last = max(self.last, seq)
+        self.count = len(positions)
+        # The newest entry has to point at that very record
+        seq, position, _ = INDEX.unpack_from(data, len(data) - INDEX.size)
+        try:
+            return position < self.size and self.read(self.view(self.size), position)['seq'] == seq
+        except (ValueError, KeyError, struct.error):
+            return False
+
+    def view(self, end):
+        # A mapping covering at least the first end bytes
+        if self.map is None or len(self.map) < end:
+            with open(self.path + '.log', 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def read(self, view, position):
+        length, _ = RECORD.unpack_from(view, position)
+        start = position + RECORD.size
+        return json.loads(view[start:start + length])
+
+    def live_positions(self, cutoff):
+        # Records at least one of their audiences still keeps
+        live = set()
+        for key, (seqs, positions) in self.postings.items():
+            live.update(positions[bisect.bisect_left(seqs, cutoff.get(key, 0)):])
+        return live
+
+    def remove(self):
+        for suffix in ('.log', '.idx'):
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
+
+
+class HistoryLog:
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, max_bytes=MAX_HISTORY_BYTES,
+                 keep_per_key=KEEP_PER_KEY):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.keep_per_key = keep_per_key
+        os.makedirs(directory, exist_ok=True)
+
+        # lock guards the segment list and the postings; readers hold it only
+        # to pick out positions, never while reading records
+        self.lock = threading.Lock()
+        self.segments = self.open_segments()
+        if not self.segments:
+            self.segments.append(self.new_segment(1))
+        self.seq = self.segments[-1].last
+        active = self.segments[-1]
+        self.log_file = open(active.path + '.log', 'ab')
+        self.index_file = open(active.path + '.idx', 'ab')
+
+        self.pending = queue.Queue(MAX_PENDING)
+        self.dropped = 0
+        # Called on the writer thread with each batch once it is readable,
+        # as (seq, time, keys, message) tuples, and after each compaction with
+        # the oldest seq kept per key hash and overall
+        self.on_append = None
+        self.on_compact = None
+        self.compacting = threading.Event()
+        threading.Thread(target=self.write_records, daemon=True).start()
+
+    def open_segments(self):
+        bases = sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                       if name.endswith('.log') and name[:-4].isdigit())
+        segments = []
+        for n, base in enumerate(bases):
+            segment = Segment(self.segment_path(base), base)
+            if segments and base <= segments[-1].last:
+                # Left behind by a merge that was cut short; its records
+                # are in the merged segment already
+                segment.remove()
+                continue
+            segment.load(trusted_index=n < len(bases) - 1)
+            segments.append(segment)
+        return segments
+
+    def segment_path(self, base):
+        return os.path.join(self.directory, f"{base:020d}")
+
+    def new_segment(self, base):
+        segment = Segment(self.segment_path(base), base)
+        open(segment.path + '.log', 'wb').close()
+        open(segment.path + '.idx', 'wb').close()
+        return segment
+
+    def record(self, message, keys, seq):
+        # Queues message for the writer and never waits on disk. Callers
+        # number messages past self.seq and record them in that order.
+        self.seq = seq
+        try:
+            self.pending.put_nowait((seq, keys, message))
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 10000 == 1:
+                event_log.log("history_overflow",
+                              f"History writer is behind, {self.dropped} messages not recorded",
+                              WARNING, dropped=self.dropped)
+
+    def write_records(self):
+        while True:
+            batch = [self.pending.get()]
+            while True:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.append(batch)
+            except (OSError, ValueError) as e:
+                event_log.log("history_error", f"History write error: {str(e)}", ERROR, error=str(e))
+
+    def append(self, batch):
+        active = self.segments[-1]
+        entries = []
+        position = active.size
+        at = time.time()
+        for seq, keys, message in batch:
+            payload = json.dumps({"seq": seq, "at": at, "keys": keys,
+                                  "message": message}).encode('utf-8')
+            self.log_file.write(RECORD.pack(len(payload), zlib.crc32(payload)))
+            self.log_file.write(payload)
+            for key in keys:
+                entries.append((seq, position, key_hash(key)))
+                self.index_file.write(INDEX.pack(seq, position, key_hash(key)))
+            position += RECORD.size + len(payload)
+        self.log_file.flush()
+        self.index_file.flush()
+
+        # Only now can readers see the batch
+        with self.lock:
+            for entry in entries:
+                active.add(*entry)
+            active.size = position
+            active.count += len(batch)
+            active.last = batch[-1][0]
+        if self.on_append is not None:
+            self.on_append([(seq, at, keys, message) for seq, keys, message in batch])
+        if position >= self.segment_bytes:
+            self.roll(batch[-1][0] + 1)
+
+    def roll(self, base):
+        self.log_file.close()
+        self.index_file.close()
+        segment = self.new_segment(base)
+        self.log_file = open(segment.path + '.log', 'ab')
+        self.index_file = open(segment.path + '.idx', 'ab')
+        with self.lock:
+            self.segments.append(segment)
+        if not self.compacting.is_set():
+            self.compacting.set()
+            threading.Thread(target=self.compact, daemon=True).start()
+
+    def page(self, keys, before=None, limit=PAGE_LIMIT, floors=None):
+        # Up to limit messages for any of keys with seq below before, newest
+        # first, each with its "seq". floors: key -> seq that key's history
+        # is limited to after
+        floors = floors or {}
+        keys = set(keys)
+        hashes = {key_hash(key) for key in keys}
+        low = min(floors.get(key, 0) for key in keys) if keys else 0
+        if before is None:
+            before = self.seq + 1
+        found = []
+        with self.lock:
+            segments = list(self.segments)
+        for segment in reversed(segments):
+            if segment.last <= low:
+                break
+            upper = min(before, segment.last + 1)
+            while upper > segment.base:
+                with self.lock:
+                    # The newest few positions below upper for each key
+                    candidates = {}
+                    for key in hashes:
+                        seqs, positions = segment.postings.get(key, ((), ()))
+                        end = bisect.bisect_left(seqs, upper)
+                        start = bisect.bisect_right(seqs, low)
+                        for n in range(end - 1, max(end - limit, start) - 1, -1):
+                            candidates[seqs[n]] = positions[n]
+                    size = segment.size
+                if not candidates:
+                    break
+                view = segment.view(size)
+                for seq in sorted(candidates, reverse=True):
+                    record = segment.read(view, candidates[seq])
+                    # Key hashes can collide; the record knows its real keys
+                    if not any(key in keys and seq > floors.get(key, 0) for key in record['keys']):
+                        continue
+                    found.append(dict(record['message'], seq=seq))
+                    if len(found) == limit:
+                        return found
+                upper = min(candidates)
+        return found
+
+    def fetch(self, seq, key):
+        # The message numbered seq if it is in key's history, else None
+        with self.lock:
+            segments = list(self.segments)
+            at = bisect.bisect_right([segment.base for segment in segments], seq) - 1
+            if at < 0:
+                return None
+            segment = segments[at]
+            seqs, positions = segment.postings.get(key_hash(key), ((), ()))
+            n = bisect.bisect_left(seqs, seq)
+            if n == len(seqs) or seqs[n] != seq:
+                return None
+            position = positions[n]
+            size = segment.size
+        record = segment.read(segment.view(size), position)
+        if key not in record['keys']:
+            return None
+        return dict(record['message'], seq=seq)
+
+    def scan(self):
+        # (seq, time, keys, message) of everything in the log, oldest first
+        with self.lock:
+            segments = list(self.segments)
+        for segment in segments:
+            try:
+                records = list(segment.records())
+            except FileNotFoundError:
+                # Merged into an earlier segment by compaction meanwhile
+                continue
+            for seq, _, payload in records:
+                record = json.loads(payload)
+                yield seq, record.get('at', 0), record['keys'], record['message']
+
+    def compact(self):
+        try:
+            self.compact_segments()
+        except (OSError, ValueError) as e:
+            event_log.log("history_error", f"History compaction error: {str(e)}", ERROR,
+                          error=str(e))
+        finally:
+            self.compacting.clear()
+
+    def cutoffs(self, segments):
+        # Per key hash, the oldest seq that key still keeps
+        counts = {}
+        cutoff = {}
+        for segment in reversed(segments):
+            for key, (seqs, _) in segment.postings.items():
+                kept = counts.get(key, 0)
+                if kept >= self.keep_per_key:
+                    continue
+                take = min(len(seqs), self.keep_per_key - kept)
+                counts[key] = kept + take
+                cutoff[key] = seqs[len(seqs) - take]
+        return cutoff
+
+    def compact_segments(self):
+        with self.lock:
+            segments = list(self.segments)
+        sealed = segments[:-1]
+
+        # Oldest segments go first once the log is over its size cap
+        total = sum(segment.size for segment in segments)
+        while sealed and total > self.max_bytes:
+            victim = sealed.pop(0)
+            total -= victim.size
+            with self.lock:
+                self.segments.remove(victim)
+            victim.remove()
+
+        # Runs of neighbours whose live records fit in one segment are
+        # merged; a lone segment is rewritten once half of it is dead
+        with self.lock:
+            cutoff = self.cutoffs(segments)
+            groups = []
+            for segment in sealed:
+                live = len(segment.live_positions(cutoff))
+                estimate = segment.size * live // max(segment.count, 1)
+                if groups and groups[-1][1] + estimate <= self.segment_bytes:
+                    groups[-1][0].append(segment)
+                    groups[-1][1] += estimate
+                else:
+                    groups.append([[segment], estimate])
+                segment.live = live
+        for group, estimate in groups:
+            if len(group) > 1 or group[0].live * 2 < group[0].count:
+                self.rewrite(group, cutoff)
+        if self.on_compact is not None:
+            with self.lock:
+                floor = self.segments[0].base
+            self.on_compact(cutoff, floor)
+
+    def rewrite(self, group, cutoff):
+        # One new segment holding the live records of group, under the
+        # first segment's name; readers keep their old mapping until done
+        first = group[0]
+        merged = Segment(first.path, first.base)
+        temp = first.path + '.compact'
+        with open(temp + '.log', 'wb') as log, open(temp + '.idx', 'wb') as index:
+            position = 0
+            for segment in group:
+                with self.lock:
+                    live = segment.live_positions(cutoff)
+                for seq, old_position, payload in segment.records():
+                    if old_position not in live:
+                        continue
+                    log.write(RECORD.pack(len(payload), zlib.crc32(payload)))
+                    log.write(payload)
+                    for key in json.loads(payload)['keys']:
+                        index.write(INDEX.pack(seq, position, key_hash(key)))
+                        merged.add(seq, position, key_hash(key))
+                    merged.count += 1
+                    position += RECORD.size + len(payload)
+        merged.size = position
+        merged.last = group[-1].last
+        for segment in group:
+            # Readers still on the old segments must keep the old contents
+            if segment.size:
+                segment.view(segment.size)
+        if not merged.count:
+            # Nothing left worth keeping
+            with self.lock:
+                at = self.segments.index(first)
+                del self.segments[at:at + len(group)]
+            for segment in group + [Segment(temp, first.base)]:
+                segment.remove()
+            return
+        # The log goes first: an index that does not match its log is
+        # rebuilt on the next start
+        os.replace(temp + '.log', first.path + '.log')
+        os.replace(temp + '.idx', first.path + '.idx')
+        with self.lock:
+            at = self.segments.index(first)
+            self.segments[at:at + len(group)] = [merged]
+        for segment in group[1:]:
+            segment.remove()
@@ -0,0 +1,471 @@
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+from protocol import FRAMING, STREAM_CHUNK, encode_data, encode_message, make_decoder
+
+# Headless load generator: thousands of simulated clients speaking the real
+# protocol (framed JSON, streams for file transfers) against a server.py it
+# starts on a free local port, or against one already running (--connect).
+# Clients are spread over --rooms rooms and over --processes processes, each
+# running its share on one asyncio loop. Every client does operations at
+# random (Poisson) intervals, --rate per second over all of them, picked by
+# the --mix weights:
+#
+#     text      a TEXT_MESSAGE to its room
+#     whisper   a WHISPER to a random other client
+#     upload    a FILE_METADATA and --file-size bytes as DATA frames
+#     download  a FILE_REQUEST for a file uploaded earlier
+#
+# Messages carry the monotonic time they were sent, so every delivery gives
+# one end-to-end latency sample (all processes share the clock). Samples go
+# in log buckets 1% wide, which merge across processes and give p50, p99
+# and p999 to within 1%. The report covers --duration seconds after
+# --warmup and is also written to --output as JSON.
+#
+#     python loadgen.py --clients 2000 --rooms 20 --rate 1000 --duration 30
+#     python loadgen.py --mix text=60,whisper=20,upload=10,download=10 --mode asyncio
+
+MIX = {"text": 80, "whisper": 15, "upload": 3, "download": 2}
+SEED_FILE = "loadgen-seed.bin"
+# Latency buckets: each 1% wider than the one before, from 1 us
+BUCKET_BASE = 1.01
+# Clients connecting at once, per process
+CONNECT_CONCURRENCY = 64
+
+
+class Latencies:
+    def __init__(self, buckets=None):
+        self.buckets = Counter(buckets or {})
+
+    def add(self, seconds):
+        self.buckets[int(math.log(max(seconds * 1e6, 1.0), BUCKET_BASE))] += 1
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+
+    def count(self):
+        return sum(self.buckets.values())
+
+    def quantile(self, q):
+        # Upper edge of the bucket holding the q-quantile, in milliseconds
+        count = self.count()
+        if not count:
+            return None
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= q * count:
+                return round(BUCKET_BASE ** (bucket + 1) / 1000, 3)
+
+    def summary(self):
+        return {"samples": self.count(), "p50_ms": self.quantile(0.5),
+                "p99_ms": self.quantile(0.99), "p999_ms": self.quantile(0.999)}
+
+
+class Share:
+    # What one process measures
+    def __init__(self):
+        self.sent = Counter()
+        self.delivered = Counter()
+        self.errors = Counter()
+        self.latency = {"text": Latencies(), "whisper": Latencies()}
+        self.transfers = Counter()
+        self.transfer_bytes = Counter()
+        self.transfer_seconds = Counter()
+        self.connected = 0
+        self.connect_seconds = 0.0
+
+    def to_dict(self):
+        return {
+            "sent": dict(self.sent),
+            "delivered": dict(self.delivered),
+            "errors": dict(self.errors),
+            "latency": {kind: dict(lat.buckets) for kind, lat in self.latency.items()},
+            "transfers": dict(self.transfers),
+            "transfer_bytes": dict(self.transfer_bytes),
+            "transfer_seconds": dict(self.transfer_seconds),
+            "connected": self.connected,
+            "connect_seconds": self.connect_seconds,
+        }
+
+
+class SimClient:
+    def __init__(self, generator, index):
+        self.generator = generator
+        self.nickname = f"lg{index}"
+        self.room = f"load{index % generator.args.rooms}"
+        self.decoder = make_decoder(True, server_side=False)
+        self.writer = None
+        self.streams = 0
+        # Uploads' FILE_ACKs and downloads' progress, by stream id
+        self.acks = {}
+        self.downloads = {}
+
+    async def connect(self):
+        args = self.generator.args
+        reader, self.writer = await asyncio.open_connection(args.host, args.port)
+        hello = {"nickname": self.nickname, "framing": FRAMING, "streams": True,
+                 "heartbeat": True}
+        self.writer.write(json.dumps(hello).encode('utf-8'))
+        welcome = None
+        while welcome is None:
+            data = await reader.read(65536)
+            if not data:
+                raise ConnectionError("Closed during the handshake")
+            self.decoder.feed(data)
+            welcome = next(self.decoder.messages(), None)
+        if welcome.get('type') != 'CONNECTION_SUCCESS':
+            raise ConnectionError(welcome.get('message', 'Connection rejected'))
+        self.send({"type": "JOIN", "room": self.room})
+        self.reader = asyncio.create_task(self.read_loop(reader))
+
+    def send(self, message):
+        self.writer.write(encode_message(message, True))
+
+    async def read_loop(self, reader):
+        try:
+            while True:
+                for message in self.decoder.messages():
+                    self.received(message)
+                data = await reader.read(65536)
+                if not data:
+                    break
+                self.decoder.feed(data)
+        except (ConnectionError, ValueError):
+            pass
+        if self.generator.running:
+            self.generator.share.errors["disconnected"] += 1
+
+    def received(self, message):
+        generator = self.generator
+        kind = message['type']
+        if kind in ('TEXT_MESSAGE', 'WHISPER'):
+            text = message.get('message', '')
+            if text.startswith('lg '):
+                key = 'text' if kind == 'TEXT_MESSAGE' else 'whisper'
+                if generator.measuring():
+                    generator.share.delivered[key] += 1
+                    generator.share.latency[key].add(
+                        (time.monotonic_ns() - int(text.split(' ', 2)[1])) / 1e9)
+        elif kind == 'PING':
+            self.send({"type": "PONG"})
+        elif kind == 'FILE_AVAILABLE':
+            generator.files.add(message['filename'])
+        elif kind == 'FILE_ACK' and message.get('stream') in self.acks:
+            self.acks[message['stream']].put_nowait(message)
+        elif kind == 'FILE_START' and message.get('stream') in self.downloads:
+            self.downloads[message['stream']][1] = message['length']
+            self.download_progress(message['stream'], 0)
+        elif kind == 'DATA' and message['stream'] in self.downloads:
+            self.download_progress(message['stream'], len(message['data']))
+
+    def download_progress(self, stream, size):
+        download = self.downloads[stream]
+        download[0] += size
+        if download[1] is not None and download[0] >= download[1] and not download[2].done():
+            download[2].set_result(download[0])
+
+    async def run(self, until):
+        generator = self.generator
+        args = generator.args
+        rate = args.rate / args.clients
+        kinds, weights = zip(*generator.mix.items())
+        while True:
+            await asyncio.sleep(random.expovariate(rate))
+            if time.monotonic() >= until or self.writer.is_closing():
+                return
+            kind = random.choices(kinds, weights)[0]
+            measuring = generator.measuring()
+            if measuring:
+                generator.share.sent[kind] += 1
+            try:
+                if kind == 'text':
+                    self.send({"type": "TEXT_MESSAGE", "room": self.room,
+                               "message": generator.text()})
+                elif kind == 'whisper':
+                    target = f"lg{random.randrange(args.clients)}"
+                    self.send({"type": "WHISPER", "target": target, "message": generator.text()})
+                elif kind == 'upload':
+                    await self.timed(kind, self.upload(f"{self.nickname}.bin"), measuring)
+                else:
+                    await self.timed(kind, self.download(random.choice(sorted(generator.files))),
+                                     measuring)
+            except (ConnectionError, asyncio.TimeoutError) as e:
+                generator.share.errors[f"{kind}: {type(e).__name__}"] += 1
+
+    async def timed(self, kind, transfer, measuring):
+        started = time.monotonic()
+        size = await asyncio.wait_for(transfer, self.generator.args.transfer_timeout)
+        if measuring:
+            self.generator.share.transfers[kind] += 1
+            self.generator.share.transfer_bytes[kind] += size
+            self.generator.share.transfer_seconds[kind] += time.monotonic() - started
+
+    def new_stream(self):
+        self.streams += 1
+        return self.streams
+
+    async def upload(self, filename):
+        body = self.generator.body
+        stream = self.new_stream()
+        acks = self.acks[stream] = asyncio.Queue()
+        try:
+            self.send({"type": "FILE_METADATA", "filename": filename, "size": len(body),
+                       "room": self.room, "stream": stream})
+            ack = await acks.get()
+            if ack.get('status') == 'exists':
+                return 0
+            if ack.get('status') != 'ready':
+                raise ConnectionError(ack.get('message', 'Upload refused'))
+            for offset in range(ack.get('offset', 0), len(body), STREAM_CHUNK):
+                self.writer.write(encode_data(stream, offset, body[offset:offset + STREAM_CHUNK]))
+                await self.writer.drain()
+            ack = await acks.get()
+            if ack.get('status') != 'done':
+                raise ConnectionError(ack.get('message', 'Upload failed'))
+            return len(body)
+        finally:
+            del self.acks[stream]
+
+    async def download(self, filename):
+        stream = self.new_stream()
+        future = asyncio.get_running_loop().create_future()
+        self.downloads[stream] = [0, None, future]
+        try:
+            self.send({"type": "FILE_REQUEST", "filename": filename, "stream": stream})
+            return await future
+        finally:
+            del self.downloads[stream]
+
+
+class Generator:
+    # One process's clients
+    def __init__(self, args, indexes):
+        self.args = args
+        self.indexes = indexes
+        # When the load starts, the same moment in every process
+        self.start_at = math.inf
+        self.mix = {kind: weight for kind, weight in parse_mix(args.mix).items() if weight > 0}
+        self.share = Share()
+        self.files = {SEED_FILE}
+        self.body = os.urandom(args.file_size)
+        self.padding = "x" * args.message_size
+        self.running = True
+
+    def measuring(self):
+        now = time.monotonic()
+        begin = self.start_at + self.args.warmup
+        return begin <= now < begin + self.args.duration
+
+    def text(self):
+        return f"lg {time.monotonic_ns()} {self.padding}"
+
+    async def run(self, barrier):
+        clients = [SimClient(self, index) for index in self.indexes]
+        gate = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+        async def connect(client):
+            async with gate:
+                try:
+                    await client.connect()
+                    return client
+                except OSError as e:
+                    self.share.errors[f"connect: {type(e).__name__}"] += 1
+
+        started = time.monotonic()
+        connected = [c for c in await asyncio.gather(*(connect(c) for c in clients)) if c]
+        self.share.connected = len(connected)
+        self.share.connect_seconds = time.monotonic() - started
+        # Every process starts the load once all their clients are connected
+        await asyncio.to_thread(barrier.wait)
+        self.start_at = time.monotonic()
+        until = self.start_at + self.args.warmup + self.args.duration
+        await asyncio.gather(*(client.run(until) for client in connected))
+        # Let deliveries still in flight arrive, then hang up
+        await asyncio.sleep(self.args.drain)
+        self.running = False
+        for client in connected:
+            client.writer.close()
+        return self.share.to_dict()
+
+
+def run_share(args, indexes, barrier, results):
+    results.put(asyncio.run(Generator(args, indexes).run(barrier)))
+
+
+def parse_mix(text):
+    mix = dict.fromkeys(MIX, 0)
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind.strip() not in mix:
+            raise ValueError(f"unknown operation {kind!r}; use {', '.join(MIX)}")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def raise_file_limit(wanted):
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_server(args):
+    args.host, args.port = '127.0.0.1', free_port()
+    command = [sys.executable, 'server.py', '--port', str(args.port), '--mode', args.mode]
+    command += args.server_args.split()
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise SystemExit("The server did not start")
+
+
+def seed(args):
+    # One file every download can ask for from the start
+    async def upload():
+        generator = Generator(args, [])
+        client = SimClient(generator, args.clients)
+        client.nickname = "lg-seed"
+        await client.connect()
+        await client.upload(SEED_FILE)
+        client.writer.close()
+    asyncio.run(upload())
+
+
+def report(args, shares):
+    total = Share()
+    latency = {kind: Latencies() for kind in total.latency}
+    for share in shares:
+        total.sent.update(share['sent'])
+        total.delivered.update(share['delivered'])
+        total.errors.update(share['errors'])
+        total.transfers.update(share['transfers'])
+        total.transfer_bytes.update(share['transfer_bytes'])
+        total.transfer_seconds.update(share['transfer_seconds'])
+        total.connected += share['connected']
+        total.connect_seconds = max(total.connect_seconds, share['connect_seconds'])
+        for kind, buckets in share['latency'].items():
+            latency[kind].merge(Latencies({int(b): n for b, n in buckets.items()}))
+    transfers = {}
+    for kind in ('upload', 'download'):
+        transfers[kind] = {
+            "transfers": total.transfers[kind],
+            "bytes": total.transfer_bytes[kind],
+            "mb_per_second": round(total.transfer_bytes[kind] / args.duration / 1e6, 3),
+            "mb_per_second_per_transfer": round(total.transfer_bytes[kind] / 1e6 /
+                                                total.transfer_seconds[kind], 3)
+                                          if total.transfer_seconds[kind] else None,
+        }
+    return {
+        "config": {name: getattr(args, name) for name in (
+            "clients", "rooms", "rate", "mix", "duration", "warmup", "message_size",
+            "file_size", "processes", "mode", "server_args", "connect")},
+        "connected": total.connected,
+        "connect_seconds": round(total.connect_seconds, 2),
+        "sent_per_second": {kind: round(n / args.duration, 1) for kind, n in total.sent.items()},
+        "messages_per_second": round((total.sent['text'] + total.sent['whisper']) / args.duration, 1),
+        "deliveries_per_second": round(sum(total.delivered.values()) / args.duration, 1),
+        "latency": {kind: lat.summary() for kind, lat in latency.items()},
+        "transfers": transfers,
+        "errors": dict(total.errors),
+    }
+
+
+def print_report(result):
+    print(f"Connected {result['connected']} clients in {result['connect_seconds']}s")
+    print(f"Sent per second: {result['sent_per_second']}")
+    print(f"Messages/s {result['messages_per_second']}, "
+          f"deliveries/s {result['deliveries_per_second']}")
+    for kind, lat in result['latency'].items():
+        print(f"{kind:>8} latency: p50 {lat['p50_ms']} ms, p99 {lat['p99_ms']} ms, "
+              f"p999 {lat['p999_ms']} ms ({lat['samples']} deliveries)")
+    for kind, transfer in result['transfers'].items():
+        print(f"{kind:>8}s: {transfer['transfers']} done, {transfer['mb_per_second']} MB/s total, "
+              f"{transfer['mb_per_second_per_transfer']} MB/s each")
+    if result['errors']:
+        print(f"Errors: {result['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the chat server")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=500, help="operations per second, all clients together")
+    parser.add_argument('--mix', default=",".join(f"{k}={v}" for k, v in MIX.items()),
+                        help="relative weights of text, whisper, upload and download")
+    parser.add_argument('--duration', type=float, default=20, help="seconds measured")
+    parser.add_argument('--warmup', type=float, default=3, help="seconds of load before measuring")
+    parser.add_argument('--drain', type=float, default=2, help="seconds to wait for stragglers")
+    parser.add_argument('--message-size', type=int, default=40, help="padding per text message")
+    parser.add_argument('--file-size', type=int, default=256 * 1024)
+    parser.add_argument('--transfer-timeout', type=float, default=30)
+    parser.add_argument('--processes', type=int, default=max(1, min(4, os.cpu_count() or 1)))
+    parser.add_argument('--connect', help="host:port of a running server instead of starting one")
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded',
+                        help="mode of the server started here")
+    parser.add_argument('--server-args', default='', help="more options for the server started here")
+    parser.add_argument('--output', default='loadgen-result.json')
+    args = parser.parse_args()
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(f"--mix: {e}")
+
+    raise_file_limit(args.clients + 256)
+    server = None
+    if args.connect:
+        args.host, _, port = args.connect.rpartition(':')
+        args.port = int(port)
+    else:
+        server = start_server(args)
+    try:
+        seed(args)
+        processes = max(1, min(args.processes, args.clients))
+        barrier = multiprocessing.Barrier(processes)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=run_share, args=(
+                       args, list(range(n, args.clients, processes)), barrier, results))
+                   for n in range(processes)]
+        for worker in workers:
+            worker.start()
+        shares = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        result = report(args, shares)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    print_report(result)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
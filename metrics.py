@@ -0,0 +1,208 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# In-process counters and histograms for one server, cheap enough to leave
+# on: an update is a dict increment (plus a bisect for histograms) under
+# the registry's lock. Gauges such as open connections or queue depths are
+# not kept up to date at all; they are read from the server when someone
+# asks. Everything can be read as a dict (the STATS reply to admins) or in
+# the Prometheus text format, served on a local port (--metrics-port).
+
+# Seconds, for handler time and fan-out
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Bytes per second, for whole transfers
+THROUGHPUT_BUCKETS = (1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+
+
+class Counter:
+    def __init__(self, registry, name, help, label):
+        self.lock = registry.lock
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, label=None, amount=1):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def snapshot(self):
+        # Caller holds the lock
+        return dict(self.values) if self.label else self.values.get(None, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        values = self.values if self.values or self.label else {None: 0}
+        for label, value in sorted(values.items(), key=sort_key):
+            lines.append(f"{self.name}{labels(self.label, label)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, registry, name, help, label, buckets):
+        self.lock = registry.lock
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        # label: [count per bucket (the last one past every bound), sum]
+        self.values = {}
+
+    def observe(self, value, label=None):
+        n = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label)
+            if entry is None:
+                entry = self.values[label] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][n] += 1
+            entry[1] += value
+
+    def summary(self, counts, total):
+        count = sum(counts)
+        return {
+            "count": count,
+            "sum": round(total, 6),
+            "p50": self.quantile(counts, count, 0.5),
+            "p99": self.quantile(counts, count, 0.99),
+        }
+
+    def quantile(self, counts, count, q):
+        # Upper bound of the bucket holding the q-quantile; None past the top
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, n in zip(self.buckets, counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        # Caller holds the lock
+        if not self.label:
+            entry = self.values.get(None)
+            return self.summary(*entry) if entry else self.summary([0], 0.0)
+        return {label: self.summary(*entry) for label, entry in self.values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label, (counts, total) in sorted(self.values.items(), key=sort_key):
+            seen = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                seen += n
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{labels(self.label, label, le)} {seen}")
+            lines.append(f"{self.name}_sum{labels(self.label, label)} {total}")
+            lines.append(f"{self.name}_count{labels(self.label, label)} {seen}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.gauges = []
+
+    def counter(self, name, help, label=None):
+        metric = Counter(self, name, help, label)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        metric = Histogram(self, name, help, label, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, read, label=None):
+        # read() returns the value, or with a label a dict of label: value
+        self.gauges.append((name, help, read, label))
+
+    def snapshot(self):
+        with self.lock:
+            values = {metric.name: metric.snapshot() for metric in self.metrics}
+        for name, _, read, _ in self.gauges:
+            values[name] = read()
+        return values
+
+    def render(self):
+        with self.lock:
+            lines = [line for metric in self.metrics for line in metric.render()]
+        for name, help, read, label in self.gauges:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+            values = read() if label else {None: read()}
+            lines += [f"{name}{labels(label, key)} {value}" for key, value in values.items()]
+        return "\n".join(lines) + "\n"
+
+
+class ServerMetrics(Registry):
+    # Everything a ChatServer counts
+    def __init__(self):
+        super().__init__()
+        self.connections = self.counter(
+            "chat_connections_total", "Connections accepted")
+        self.messages_in = self.counter(
+            "chat_messages_received_total", "Messages received from clients, by type", "type")
+        self.messages_out = self.counter(
+            "chat_messages_queued_total", "Messages queued for clients, by type", "type")
+        self.bytes_in = self.counter(
+            "chat_received_bytes_total", "Bytes read from client sockets")
+        self.bytes_out = self.counter(
+            "chat_sent_bytes_total", "Bytes written to client sockets, file data included")
+        self.uploads = self.counter(
+            "chat_uploads_total", "Files uploaded")
+        self.upload_bytes = self.counter(
+            "chat_upload_bytes_total", "Bytes of uploaded files")
+        self.downloads = self.counter(
+            "chat_downloads_total", "File ranges requested")
+        self.download_bytes = self.counter(
+            "chat_download_bytes_total", "Bytes of requested file ranges")
+        self.upload_throughput = self.histogram(
+            "chat_upload_throughput_bytes_per_second", "Upload speed, per file",
+            buckets=THROUGHPUT_BUCKETS)
+        self.fanout = self.histogram(
+            "chat_fanout_seconds", "Time to queue one event for all of its recipients")
+        self.handler = self.histogram(
+            "chat_handler_seconds", "Time spent handling one client message, by type", "type")
+
+
+def labels(name, value, le=None):
+    pairs = []
+    if name:
+        pairs.append(f'{name}="{escape(value)}"')
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def sort_key(item):
+    return str(item[0])
+
+
+def serve_metrics(registry, host, port):
+    # Prometheus text format on http://host:port/metrics, in its own threads
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -0,0 +1,502 @@
+import asyncio
+import mmap
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from compression import compress_chunk
+from protocol import MAX_FRAME_SIZE, STREAM_CHUNK, data_header, encode_compressed
+
+# Per-connection outbound queues. Handlers never write to a client socket
+# directly any more: they append encoded bytes to the client's queue and a
+# dedicated writer (thread or task) drains it, so one client with a full TCP
+# window only ever slows itself down.
+#
+# When a queue goes over its high-water marks the slow-consumer policy decides
+# what happens:
+#   drop-oldest        discard the oldest droppable messages
+#   drop-non-critical  discard only SYSTEM_MESSAGE / USER_LIST style messages
+#   disconnect         evict the client straight away
+# If shedding cannot bring the queue back under the limits the client is
+# evicted in every policy.
+#
+# Queue entries are tuples of buffers ("segments") shared between every
+# recipient of an event, e.g. (frame header, JSON payload). Writers wait a
+# short coalescing window after the first entry arrives and then push
+# everything queued with a single vectored write.
+#
+# File downloads are queued as FileRange segments instead of bytes: the
+# writer hands them to sendfile() at their place in the stream, so file
+# contents never pass through Python or sit in the queue.
+#
+# For clients using streams (see protocol.py) file data does not go in the
+# main queue at all. Each stream has its own bulk queue; a writer batch is
+# everything in the main queue plus one STREAM_CHUNK from the next stream in
+# round-robin order, so chat always goes first and concurrent downloads
+# share the link. FileRange chunks are cut on STREAM_CHUNK boundaries of the
+# file so their checksums can come from the store's table.
+#
+# Legacy (unframed) clients parse one JSON object per recv(), so their
+# queues never coalesce: each entry is written on its own, as the server
+# always used to. After the welcome they get WELCOME_GAP to themselves,
+# since a client that reads more than the welcome can never connect.
+#
+# With message compression agreed (see compression.py) the writer batch's
+# messages go through the connection's compressor as one frame; raw file
+# bytes and data frames stay outside it. Streams of compressed downloads
+# have their chunks read and compressed here instead of using sendfile().
+
+DROP_OLDEST = "drop-oldest"
+DROP_NON_CRITICAL = "drop-non-critical"
+DISCONNECT = "disconnect"
+POLICIES = (DROP_OLDEST, DROP_NON_CRITICAL, DISCONNECT)
+
+DEFAULT_MAX_BYTES = 1024 * 1024
+DEFAULT_MAX_MESSAGES = 1000
+DEFAULT_COALESCE_WINDOW = 0.002
+
+# Stop waiting for more events once this much is ready to go
+COALESCE_BYTES = 64 * 1024
+
+# Pause after a legacy client's welcome before writing anything else
+WELCOME_GAP = 0.05
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# Never dropped: losing these would desynchronise the stream (raw file bytes
+# are queued with message_type None and are pinned as well; INTERN entries
+# define names later binary messages refer to; an unanswered PING gets a
+# live client dropped)
+PINNED_TYPES = {"CONNECTION_SUCCESS", "FILE_ACK", "FILE_START", "INTERN", "PING"}
+
+# Informational messages a client can live without under pressure
+NON_CRITICAL_TYPES = {"SYSTEM_MESSAGE", "USER_LIST"}
+
+
+class OutboundQueue:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_messages=DEFAULT_MAX_MESSAGES, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.policy = policy
+        self.items = deque()
+        self.queued_bytes = 0
+        self.bulk = OrderedDict()
+        self.bulk_bytes = 0
+        self.cancelled = set()
+        self.stream_codecs = {}
+        self.compressor = None
+        self.coalesce = True
+        self.paused_until = 0.0
+        self.dropped = 0
+        self.closed = False
+
+    def over_limit(self):
+        return self.queued_bytes > self.max_bytes or len(self.items) > self.max_messages
+
+    def has_room(self):
+        # Bulk writers (file downloads) wait for the queue to fall to half
+        # the byte limit before adding more
+        return self.queued_bytes + self.bulk_bytes <= self.max_bytes // 2
+
+    def droppable(self, message_type):
+        if message_type is None or message_type in PINNED_TYPES:
+            return False
+        if self.policy == DROP_NON_CRITICAL:
+            return message_type in NON_CRITICAL_TYPES
+        return True
+
+    def shed(self):
+        if self.policy == DISCONNECT:
+            return False
+        # Messages set aside as undroppable still count against the limit
+        kept = deque()
+        while self.items and (self.queued_bytes > self.max_bytes
+                              or len(self.items) + len(kept) > self.max_messages):
+            segments, size, message_type = self.items.popleft()
+            if self.droppable(message_type):
+                self.queued_bytes -= size
+                self.dropped += 1
+            else:
+                kept.append((segments, size, message_type))
+        kept.extend(self.items)
+        self.items = kept
+        return not self.over_limit()
+
+    def push(self, segments, message_type):
+        # File ranges are read from disk by the writer and take no queue memory
+        size = sum(len(segment) for segment in segments if not isinstance(segment, FileRange))
+        self.items.append((segments, size, message_type))
+        self.queued_bytes += size
+
+    def append(self, segments, message_type):
+        # Returns False when the consumer is too slow and must be evicted
+        if self.closed:
+            return False
+        self.push(segments, message_type)
+        if self.over_limit() and not self.shed():
+            return False
+        return True
+
+    def push_stream(self, stream, data, offset=0):
+        # data is a FileRange, read at send time, or bytes found at offset in
+        # the file being sent
+        if stream in self.cancelled:
+            return
+        if not isinstance(data, FileRange):
+            data = (offset, data)
+            self.bulk_bytes += len(data[1])
+        self.bulk.setdefault(stream, deque()).append(data)
+
+    def set_stream_codec(self, stream, codec):
+        # Compress this stream's chunks from now on, or stop with None
+        if codec is None:
+            self.stream_codecs.pop(stream, None)
+        else:
+            self.stream_codecs[stream] = codec
+
+    def cancel_stream(self, stream):
+        # The receiver gave up on the stream; drop whatever is still queued
+        self.cancelled.add(stream)
+        self.stream_codecs.pop(stream, None)
+        for item in self.bulk.pop(stream, ()):
+            if not isinstance(item, FileRange):
+                self.bulk_bytes -= len(item[1])
+
+    def take_chunk(self):
+        # The next chunk of the stream at the front, which then goes to the
+        # back, as (stream, offset, data, source range or None, codec) for
+        # pack_chunk()
+        stream, pending = self.bulk.popitem(last=False)
+        item = pending[0]
+        if isinstance(item, FileRange):
+            piece = item.split(STREAM_CHUNK - item.offset % STREAM_CHUNK)
+            if not item.length:
+                pending.popleft()
+            chunk = (stream, piece.offset, piece, item)
+        else:
+            offset, piece = pending.popleft()
+            self.bulk_bytes -= len(piece)
+            chunk = (stream, offset, piece, None)
+        if pending:
+            self.bulk[stream] = pending
+        return chunk + (self.stream_codecs.get(stream),)
+
+    def pack_chunk(self, stream, offset, piece, source, codec):
+        # Header and data of a taken chunk. This may read the file, checksum
+        # and compress, so it runs without the queue's lock
+        if source is not None:
+            length = piece.length
+            if codec is None:
+                crc = source.checksum(piece)
+            else:
+                piece = piece.read()
+                crc = zlib.crc32(piece)
+        else:
+            length, crc = len(piece), zlib.crc32(piece)
+        packed = compress_chunk(codec, piece) if codec else None
+        if packed is not None:
+            return [data_header(stream, offset, len(packed), crc, True), packed]
+        return [data_header(stream, offset, length, crc), piece]
+
+    def compress(self, segments):
+        # Messages as compressed frames, none inflating past the frame limit
+        frames, run, size = [], [], 0
+        for segment in segments:
+            run.append(segment)
+            size += len(segment)
+            if size >= MAX_FRAME_SIZE // 2:
+                frames.append(encode_compressed(self.compressor.compress(run)))
+                run, size = [], 0
+        if run:
+            frames.append(encode_compressed(self.compressor.compress(run)))
+        return frames
+
+    def take_all(self):
+        # Detaches everything queued plus the next stream chunk; the caller
+        # turns that into a batch with build_batch() after letting go of the
+        # queue, as that is where the compressing and disk reads happen
+        if self.coalesce:
+            items = self.items
+            self.items = deque()
+            self.queued_bytes = 0
+        else:
+            items = [self.items.popleft()] if self.items else []
+            self.queued_bytes -= sum(size for _, size, _ in items)
+            if items and items[0][2] == "CONNECTION_SUCCESS":
+                self.paused_until = time.monotonic() + WELCOME_GAP
+        chunk = self.take_chunk() if self.bulk else None
+        return items, chunk
+
+    def build_batch(self, items, chunk):
+        # Only ever called by the queue's single writer, which is also the
+        # only user of the compressor
+        if self.compressor is None:
+            batch = [segment for segments, _, _ in items for segment in segments]
+        else:
+            batch, run = [], []
+            for segments, _, message_type in items:
+                if message_type is None:
+                    # Raw file bytes go out as they are, between the messages
+                    batch += self.compress(run) + list(segments)
+                    run = []
+                else:
+                    run.extend(segments)
+            batch += self.compress(run)
+        if chunk is not None:
+            batch += self.pack_chunk(*chunk)
+        return batch
+
+
+class ThreadedOutboundQueue(OutboundQueue):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.condition = threading.Condition()
+
+    def put(self, segments, message_type):
+        with self.condition:
+            accepted = self.append(segments, message_type)
+            self.condition.notify_all()
+            return accepted
+
+    def put_bulk(self, data):
+        # Blocks the calling (requesting client's) thread instead of applying
+        # the slow consumer policy
+        with self.condition:
+            while not self.closed and not self.has_room():
+                self.condition.wait()
+            if self.closed:
+                return False
+            self.push((data,), None)
+            self.condition.notify_all()
+            return True
+
+    def put_stream(self, stream, data, offset):
+        # Like put_bulk, for a stream's data frames
+        with self.condition:
+            while not self.closed and not self.has_room():
+                self.condition.wait()
+            if self.closed or stream in self.cancelled:
+                return False
+            self.push_stream(stream, data, offset)
+            self.condition.notify_all()
+            return True
+
+    def cancel(self, stream):
+        with self.condition:
+            self.cancel_stream(stream)
+            self.condition.notify_all()
+
+    def put_range(self, stream, file_range):
+        # File ranges take no queue memory, so this never waits
+        with self.condition:
+            if self.closed:
+                return False
+            self.push_stream(stream, file_range)
+            self.condition.notify_all()
+            return True
+
+    def get_batch(self, coalesce_window=0):
+        # Everything queued so far, or [] once closed. With a coalescing
+        # window, keep collecting for that long after the first entry
+        # (unless stream data is waiting anyway).
+        with self.condition:
+            while not self.items and not self.bulk and not self.closed:
+                self.condition.wait()
+            while not self.closed and self.paused_until > time.monotonic():
+                self.condition.wait(self.paused_until - time.monotonic())
+            if coalesce_window and self.coalesce and not self.bulk:
+                deadline = time.monotonic() + coalesce_window
+                while not self.closed and self.queued_bytes < COALESCE_BYTES:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+            if self.closed:
+                return []
+            taken = self.take_all()
+            self.condition.notify_all()
+        return self.build_batch(*taken)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class AsyncOutboundQueue(OutboundQueue):
+    # Only ever touched from the event loop thread, so no locking is needed
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.readable = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def put(self, segments, message_type):
+        accepted = self.append(segments, message_type)
+        self.readable.set()
+        if not self.has_room():
+            self.writable.clear()
+        return accepted
+
+    async def put_bulk(self, data):
+        while not self.closed and not self.has_room():
+            self.writable.clear()
+            await self.writable.wait()
+        if self.closed:
+            return False
+        self.push((data,), None)
+        self.readable.set()
+        return True
+
+    async def put_stream(self, stream, data, offset):
+        while not self.closed and not self.has_room():
+            self.writable.clear()
+            await self.writable.wait()
+        if self.closed or stream in self.cancelled:
+            return False
+        self.push_stream(stream, data, offset)
+        self.readable.set()
+        return True
+
+    def cancel(self, stream):
+        self.cancel_stream(stream)
+        self.writable.set()
+
+    def put_range(self, stream, file_range):
+        if self.closed:
+            return False
+        self.push_stream(stream, file_range)
+        self.readable.set()
+        return True
+
+    async def get_batch(self, coalesce_window=0):
+        while not self.items and not self.bulk and not self.closed:
+            self.readable.clear()
+            await self.readable.wait()
+        if self.paused_until > time.monotonic():
+            await asyncio.sleep(self.paused_until - time.monotonic())
+        if coalesce_window and self.coalesce and not self.bulk and self.queued_bytes < COALESCE_BYTES:
+            await asyncio.sleep(coalesce_window)
+        if self.closed:
+            return []
+        size = self.queued_bytes
+        items, chunk = self.take_all()
+        self.writable.set()
+        if chunk is not None or (self.compressor is not None and size >= COALESCE_BYTES):
+            # File reads and big compression jobs would stall the event loop
+            return await asyncio.to_thread(self.build_batch, items, chunk)
+        return self.build_batch(items, chunk)
+
+    def close(self):
+        self.closed = True
+        self.readable.set()
+        self.writable.set()
+
+
+class FileRange:
+    __slots__ = ('path', 'offset', 'length', 'checksums', 'size')
+
+    def __init__(self, path, offset, length, checksums=None, size=None):
+        # checksums: per-STREAM_CHUNK CRC-32s of the whole file, size bytes long
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.checksums = checksums
+        self.size = size
+
+    def split(self, size):
+        # Detach and return the first size bytes of this range
+        piece = FileRange(self.path, self.offset, min(size, self.length))
+        self.offset += piece.length
+        self.length -= piece.length
+        return piece
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.length)
+
+    def checksum(self, piece):
+        # CRC-32 of a piece of this file: from the table when the piece is a
+        # whole chunk, otherwise (range edges) read and computed
+        index, misaligned = divmod(piece.offset, STREAM_CHUNK)
+        if (self.checksums is not None and not misaligned and index < len(self.checksums)
+                and piece.offset + piece.length == min(piece.offset + STREAM_CHUNK, self.size)):
+            return self.checksums[index]
+        return zlib.crc32(piece.read())
+
+    def send(self, sock):
+        if not self.length:
+            return
+        with open(self.path, 'rb') as f:
+            if hasattr(os, 'sendfile'):
+                sent = sock.sendfile(f, self.offset, self.length)
+            else:
+                # No sendfile(): send straight out of the page cache instead
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    with memoryview(mapped) as view:
+                        with view[self.offset:self.offset + self.length] as part:
+                            sock.sendall(part)
+                            sent = len(part)
+        if sent != self.length:
+            # The receiver is waiting for exactly length bytes
+            raise ConnectionError(f"{self.path} changed during download")
+
+    async def send_async(self, loop, transport):
+        if not self.length:
+            return
+        with open(self.path, 'rb') as f:
+            sent = await loop.sendfile(transport, f, self.offset, self.length)
+        if sent != self.length:
+            raise ConnectionError(f"{self.path} changed during download")
+
+
+def batch_bytes(segments):
+    # What a writer batch puts on the wire, file ranges included
+    return sum(segment.length if isinstance(segment, FileRange) else len(segment)
+               for segment in segments)
+
+
+def send_segments(sock, segments):
+    # A writer batch: runs of buffers go out with send_buffers, file ranges
+    # with sendfile()
+    pending = []
+    for segment in segments:
+        if isinstance(segment, FileRange):
+            if pending:
+                send_buffers(sock, pending)
+                pending = []
+            segment.send(sock)
+        else:
+            pending.append(segment)
+    if pending:
+        send_buffers(sock, pending)
+
+
+def send_buffers(sock, buffers):
+    # Vectored equivalent of sock.sendall(b''.join(buffers)): no joined copy,
+    # one sendmsg() per IOV_MAX buffers, resuming after partial writes
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(buffers))
+        return
+    views = [memoryview(buffer) for buffer in buffers]
+    index = 0
+    while index < len(views):
+        sent = sock.sendmsg(views[index:index + IOV_MAX])
+        while sent:
+            length = len(views[index])
+            if sent >= length:
+                sent -= length
+                index += 1
+            else:
+                views[index] = views[index][sent:]
+                sent = 0
+        # Skip empty buffers so the loop always terminates
+        while index < len(views) and not len(views[index]):
+            index += 1
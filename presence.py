@@ -0,0 +1,77 @@
+import threading
+from collections import Counter
+
+# Who is in a room, as published to its members. Joins and leaves are
+# collected for a short window and then published together: one USER_LEFT
+# and/or one USER_JOINED event carrying every nickname, each with the next
+# version number, plus one combined SYSTEM_MESSAGE. A client that sees a
+# version gap asks for a full USER_LIST snapshot instead of trusting its
+# local copy.
+#
+# Changes are netted per nickname, so a client that drops and reconnects
+# inside one window produces no events at all.
+
+class PresenceTracker:
+    def __init__(self, room):
+        self.room = room
+        self.lock = threading.Lock()
+        self.version = 0
+        self.users = Counter()
+        self.pending = Counter()
+
+    def record(self, nickname, change):
+        # Returns True if this is the first change of a new window
+        with self.lock:
+            first = not self.pending
+            self.pending[nickname] += change
+            if not self.pending[nickname]:
+                del self.pending[nickname]
+            return first
+
+    def flush(self):
+        # Publish pending changes; returns (events, joined, left)
+        with self.lock:
+            joined = sorted(Counter({n: c for n, c in self.pending.items() if c > 0}).elements())
+            left = sorted(Counter({n: -c for n, c in self.pending.items() if c < 0}).elements())
+            self.pending.clear()
+
+            events = []
+            if left:
+                self.users.subtract(left)
+                self.users += Counter()  # drop zero counts
+                self.version += 1
+                events.append({"type": "USER_LEFT", "room": self.room, "users": left,
+                               "version": self.version})
+            if joined:
+                self.users.update(joined)
+                self.version += 1
+                events.append({"type": "USER_JOINED", "room": self.room, "users": joined,
+                               "version": self.version})
+            return events, joined, left
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "type": "USER_LIST",
+                "room": self.room,
+                "users": sorted(self.users.elements()),
+                "version": self.version
+            }
+
+    def count(self):
+        with self.lock:
+            return sum(self.users.values())
+
+    def is_idle(self):
+        # Nobody published and nothing pending: the room can be forgotten
+        with self.lock:
+            return not self.users and not self.pending
+
+
+def describe_change(nicknames, verb):
+    # "alice joined the chat", "alice and bob left the chat", "37 users joined the chat"
+    if len(nicknames) == 1:
+        return f"{nicknames[0]} {verb} the chat"
+    if len(nicknames) <= 3:
+        return f"{', '.join(nicknames[:-1])} and {nicknames[-1]} {verb} the chat"
+    return f"{len(nicknames)} users {verb} the chat"
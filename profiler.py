@@ -0,0 +1,244 @@
+import argparse
+import heapq
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from protocol import FRAMING, encode_message, make_decoder
+
+# On-demand profiling of a running server. An admin sends
+# {"type": "PROFILE", "seconds": N}; for the next N seconds
+#
+#   - a sampling thread records the stack of every thread (and, with the
+#     asyncio server, the await stack of every task) SAMPLE_INTERVAL apart,
+#   - every handled message is timed by type, and the SLOWEST slowest
+#     invocations are kept,
+#
+# and then everything is written to server_files/diagnostics: a summary
+# (profile-*.txt) and the stacks in the folded format flame graph tools
+# read (profile-*.folded, one "frame;frame;frame count" line per stack).
+#
+# Nothing of this exists while no profile runs: the server holds no
+# Profiler, and its handler loops only check for one.
+#
+#     python profiler.py --port 5555 --seconds 30 [--admin-token TOKEN]
+
+SAMPLE_INTERVAL = 0.005
+# Sampling slows down rather than take more than this share of the time
+# (walking a thousand handler threads' stacks is not free)
+SAMPLE_BUDGET = 0.05
+MAX_SECONDS = 300
+DEFAULT_SECONDS = 10
+SLOWEST = 25
+TOP = 40
+
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def await_stack(coro):
+    # The coroutines a task is in, outermost first, each at the line it
+    # waits on
+    stack = []
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return stack
+
+
+def thread_role(name):
+    # "Thread-12 (handle_client)" -> "handle_client", so that all handler
+    # threads add up to one tree
+    match = re.fullmatch(r"Thread-\d+ \((.*)\)", name)
+    return match.group(1) if match else name
+
+
+class Profiler:
+    def __init__(self, seconds, directory, tasks=None):
+        # tasks() returns the asyncio tasks to sample, if any
+        self.seconds = seconds
+        self.directory = directory
+        self.tasks = tasks
+        self.lock = threading.Lock()
+        self.stacks = Counter()
+        self.task_stacks = Counter()
+        self.samples = 0
+        # message type: [count, total seconds, max seconds]
+        self.handlers = {}
+        self.slowest = []
+        self.handled_count = 0
+
+    def handled(self, message_type, nickname, seconds):
+        with self.lock:
+            entry = self.handlers.get(message_type)
+            if entry is None:
+                entry = self.handlers[message_type] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            self.handled_count += 1
+            item = (seconds, self.handled_count, message_type, nickname, time.time())
+            if len(self.slowest) < SLOWEST:
+                heapq.heappush(self.slowest, item)
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def run(self):
+        # Samples for self.seconds; write() saves the results
+        self.started = time.time()
+        deadline = time.monotonic() + self.seconds
+        interval = SAMPLE_INTERVAL
+        while time.monotonic() < deadline:
+            began = time.perf_counter()
+            self.sample()
+            cost = time.perf_counter() - began
+            interval = max(SAMPLE_INTERVAL, cost / SAMPLE_BUDGET)
+            time.sleep(interval)
+        self.finished = time.time()
+
+    def sample(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread_role(thread.name) for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread {ident}"))
+            self.stacks[tuple(reversed(stack))] += 1
+        if self.tasks is not None:
+            try:
+                tasks = list(self.tasks())
+            except RuntimeError:
+                tasks = []
+            for task in tasks:
+                stack = await_stack(task.get_coro())
+                if stack:
+                    self.task_stacks[tuple(stack)] += 1
+        self.samples += 1
+
+    def write(self):
+        # Returns the paths of the files written
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, "profile-" +
+                            datetime.fromtimestamp(self.started).strftime("%Y%m%d-%H%M%S") +
+                            f"-{os.getpid()}")
+        paths = [base + ".txt", base + ".folded"]
+        write_folded(paths[1], self.stacks)
+        if self.task_stacks:
+            paths.append(base + "-tasks.folded")
+            write_folded(paths[2], self.task_stacks)
+        with open(paths[0], 'w') as f:
+            f.write("\n".join(self.summary()) + "\n")
+        return paths
+
+    def summary(self):
+        elapsed = self.finished - self.started
+        lines = [
+            f"Profile of pid {os.getpid()}, "
+            f"{datetime.fromtimestamp(self.started):%Y-%m-%d %H:%M:%S} for {elapsed:.1f} s",
+            f"{self.samples} samples, {sum(self.stacks.values())} thread stacks, "
+            f"{sum(self.task_stacks.values())} task stacks",
+            "",
+            "Message handlers by type",
+            f"{'type':<20}{'count':>10}{'total s':>12}{'mean ms':>12}{'max ms':>12}",
+        ]
+        with self.lock:
+            handlers = sorted(self.handlers.items(), key=lambda item: -item[1][1])
+            slowest = sorted(self.slowest, reverse=True)
+        for message_type, (count, total, longest) in handlers:
+            lines.append(f"{message_type:<20}{count:>10}{total:>12.3f}"
+                         f"{total / count * 1000:>12.3f}{longest * 1000:>12.3f}")
+        lines += ["", "Slowest handler invocations",
+                  f"{'time':<26}{'type':<20}{'ms':>10}  nickname"]
+        for seconds, _, message_type, nickname, stamp in slowest:
+            lines.append(f"{datetime.fromtimestamp(stamp).isoformat(' ', 'milliseconds'):<26}"
+                         f"{message_type:<20}{seconds * 1000:>10.3f}  {nickname}")
+        lines += top_functions("Threads", self.stacks)
+        if self.task_stacks:
+            lines += top_functions("Tasks (where they wait)", self.task_stacks)
+        return lines
+
+
+def top_functions(title, stacks):
+    # Functions by samples on top of the stack (self), then anywhere in it
+    own = Counter()
+    anywhere = Counter()
+    total = sum(stacks.values()) or 1
+    for stack, count in stacks.items():
+        own[stack[-1]] += count
+        for label in set(stack):
+            anywhere[label] += count
+    lines = ["", f"{title}: top functions by own samples",
+             f"{'self %':>8}{'total %':>9}  function"]
+    ranked = sorted(anywhere, key=lambda label: (own[label], anywhere[label]), reverse=True)
+    for label in ranked[:TOP]:
+        lines.append(f"{own[label] / total:>8.1%}{anywhere[label] / total:>9.1%}  {label}")
+    return lines
+
+
+def write_folded(path, stacks):
+    with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write(";".join(label.replace(';', ',') for label in stack) + f" {count}\n")
+
+
+def request_profile(host, port, seconds, admin_token=None):
+    # Asks a running server for a profile and waits for it; returns the reply
+    sock = socket.create_connection((host, port))
+    hello = {"nickname": f"profiler-{os.getpid()}", "framing": FRAMING}
+    if admin_token is not None:
+        hello["admin"] = admin_token
+    sock.sendall(json.dumps(hello).encode('utf-8'))
+    sock.sendall(encode_message({"type": "PROFILE", "seconds": seconds}, True))
+    decoder = make_decoder(True, server_side=False)
+    try:
+        while True:
+            for message in decoder.messages():
+                if message['type'] == 'PING':
+                    sock.sendall(encode_message({"type": "PONG"}, True))
+                elif message['type'] == 'PROFILE':
+                    if message.get('status') == 'started':
+                        print(f"Profiling for {message['seconds']} seconds...")
+                    else:
+                        return message
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            decoder.feed(data)
+    finally:
+        try:
+            sock.sendall(encode_message({"type": "BYE"}, True))
+        except OSError:
+            pass
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile a running chat server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--seconds', type=float, default=DEFAULT_SECONDS)
+    parser.add_argument('--admin-token', help="the server's --admin-token, if it has one")
+    args = parser.parse_args()
+    reply = request_profile(args.host, args.port, args.seconds, args.admin_token)
+    if reply.get('status') != 'done':
+        sys.exit(f"Profiling failed: {reply.get('message')}")
+    for path in reply['files']:
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+import codecs
+import json
+import struct
+import zlib
+from binary import MAX_CLIENT_NAME_CHARS, MAX_CLIENT_NAMES, BinaryDecoder, encode as encode_binary
+from compression import MessageDecompressor, compress_chunk, decompress_chunk
+
+# Wire protocol helpers shared by server.py, async_server.py and client.py.
+#
+# Legacy clients send bare JSON objects and the receiver has to guess where one
+# ends and the next begins. Clients that announce "framing" in the nickname
+# handshake instead get every JSON message as
+#
+#     [4-byte big-endian payload length][payload]
+#
+# Raw file bytes (after FILE_ACK / FILE_START) are still sent unframed, so the
+# decoders can hand buffered bytes back out through take_raw().
+#
+# Framed clients that also announce "streams" move file bytes into data
+# frames instead, so transfers interleave with chat on the one connection:
+#
+#     [4-byte length | DATA_FLAG][4-byte stream id][8-byte file offset]
+#     [4-byte CRC-32 of data][data]
+#
+# Stream ids are picked by the client and carried in FILE_METADATA /
+# FILE_REQUEST; the decoders turn data frames into {"type": "DATA", "stream",
+# "offset", "crc", "data"} messages so they are dispatched like everything
+# else. The offset and checksum let the receiver confirm every chunk and
+# resume from the last good one.
+#
+# COMPRESSED_FLAG in the length word marks compression (see compression.py).
+# On a data frame it means the data is compressed with the transfer's codec
+# (the CRC is still that of the original bytes), which the decoders report as
+# "compressed": True. On its own it marks a frame holding the next piece of
+# the connection's zlib message stream; the decoder inflates it and returns
+# the frames inside as if they had arrived directly.
+#
+# BINARY_FLAG marks a message in the compact binary encoding (binary.py)
+# instead of JSON, for connections that chose it in the handshake.
+
+FRAMING = "length-prefixed"
+HEADER = struct.Struct('!I')
+DATA_HEADER = struct.Struct('!IQI')
+DATA_FLAG = 0x80000000
+COMPRESSED_FLAG = 0x40000000
+BINARY_FLAG = 0x20000000
+FLAGS = DATA_FLAG | COMPRESSED_FLAG | BINARY_FLAG
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# File data is cut into frames of at most this much so a chat message never
+# waits behind more than one chunk
+STREAM_CHUNK = 64 * 1024
+
+
+class ProtocolError(ConnectionError):
+    pass
+
+
+def encode_frame(payload):
+    return HEADER.pack(len(payload)) + payload
+
+
+def data_header(stream, offset, length, crc, compressed=False):
+    flags = DATA_FLAG | (COMPRESSED_FLAG if compressed else 0)
+    return HEADER.pack(flags | (DATA_HEADER.size + length)) + DATA_HEADER.pack(stream, offset, crc)
+
+
+def encode_data(stream, offset, data, codec=None):
+    crc = zlib.crc32(data)
+    packed = compress_chunk(codec, data) if codec else None
+    if packed is not None:
+        return data_header(stream, offset, len(packed), crc, True) + packed
+    return data_header(stream, offset, len(data), crc) + data
+
+
+def encode_compressed(payload):
+    # A piece of the message stream from a compression.MessageCompressor
+    return HEADER.pack(COMPRESSED_FLAG | len(payload)) + payload
+
+
+def chunk_data(message, codec=None, limit=STREAM_CHUNK):
+    # The original bytes of a data frame, or None if they do not match its
+    # checksum
+    data = message['data']
+    if message.get('compressed'):
+        try:
+            data = decompress_chunk(codec, data, limit)
+        except ValueError:
+            return None
+    return data if zlib.crc32(data) == message['crc'] else None
+
+
+def encode_message(message, framed=False):
+    payload = json.dumps(message).encode('utf-8')
+    if framed:
+        return encode_frame(payload)
+    return payload
+
+
+def encode_binary_message(message, table):
+    # Frames for message in the binary encoding, INTERN definitions for
+    # names this sender has not used before first; JSON if it has no schema
+    known = len(table.names)
+    encoded = encode_binary(message, table)
+    if encoded is None:
+        return encode_message(message, True)
+    frames = [binary_frame(table.definition(number)) for number in sorted(set(encoded[1]))
+              if number >= known]
+    frames.append(binary_frame(encoded[0]))
+    return b''.join(frames)
+
+
+def binary_frame(payload):
+    return HEADER.pack(BINARY_FLAG | len(payload)) + payload
+
+
+class EncodedEvent:
+    # Fan-out form of a message: serialised once and shared by every
+    # recipient. Framed clients get (header, payload) as two buffers of a
+    # vectored write, legacy clients just the payload, so nothing is copied
+    # per recipient.
+    __slots__ = ('message', 'payload', 'header', 'binary')
+
+    def __init__(self, message):
+        self.message = message
+        self.payload = json.dumps(message).encode('utf-8')
+        self.header = HEADER.pack(len(self.payload))
+        self.binary = None
+
+    def segments(self, framed):
+        if framed:
+            return (self.header, self.payload)
+        return (self.payload,)
+
+    def binary_segments(self, table):
+        # (segments, interned name ids used) in the binary encoding, also
+        # encoded only once; (None, ()) for types without a schema
+        if self.binary is None:
+            encoded = encode_binary(self.message, table)
+            if encoded is None:
+                self.binary = (None, ())
+            else:
+                payload, used = encoded
+                self.binary = ((HEADER.pack(BINARY_FLAG | len(payload)), payload), used)
+        return self.binary
+
+
+def parse_handshake(data):
+    # The nickname handshake is always a bare JSON object so old servers can
+    # read it; anything the client pipelined after it is returned as leftover.
+    text = data.decode('utf-8', 'surrogateescape')
+    hello, end = json.JSONDecoder().raw_decode(text)
+    return hello, text[end:].encode('utf-8', 'surrogateescape')
+
+
+def requested_ranges(message):
+    # A FILE_REQUEST asks for the whole file, for one offset/length range or
+    # for a list of [offset, length] ranges; a missing length means "to the
+    # end". Each range is answered with its own FILE_START and bytes.
+    if message.get('ranges'):
+        return [(int(offset), None if length is None else int(length))
+                for offset, length in message['ranges']]
+    length = message.get('length')
+    return [(int(message.get('offset', 0)), None if length is None else int(length))]
+
+
+def clamp_range(size, offset, length):
+    offset = min(max(offset, 0), size)
+    if length is None:
+        return offset, size - offset
+    return offset, min(max(length, 0), size - offset)
+
+
+def is_framed_reply(data):
+    # A legacy reply starts with '{'; a frame header only would for payloads
+    # of about 1 GB or more, which MAX_FRAME_SIZE rules out.
+    return bool(data) and data[:1] != b'{'
+
+
+class FrameDecoder:
+    # Streaming decoder for length-prefixed frames. Bytes are appended to one
+    # buffer and consumed through a read offset, so every byte is looked at
+    # once no matter how many recv() calls a message is split across.
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, server_side=False):
+        self.buffer = bytearray()
+        self.offset = 0
+        self.max_frame_size = max_frame_size
+        # Frames inflated out of the compressed message stream, once the
+        # peer starts one
+        self.inflater = None
+        self.inflated = None
+        # The server caps what a client may intern and sees each INTERN
+        # definition as an {"type": "INTERN"} message, so that it is rate
+        # limited and counted like any other
+        self.server_side = server_side
+        if server_side:
+            self.binary = BinaryDecoder(MAX_CLIENT_NAMES, MAX_CLIENT_NAME_CHARS)
+        else:
+            self.binary = BinaryDecoder()
+
+    def feed(self, data):
+        if self.offset and self.offset >= len(self.buffer) // 2:
+            # Compact once the consumed prefix dominates the buffer
+            del self.buffer[:self.offset]
+            self.offset = 0
+        self.buffer += data
+
+    def buffered(self):
+        return len(self.buffer) - self.offset
+
+    def read_frame(self):
+        # (flags, payload) for the next complete frame, or None
+        while True:
+            if self.inflated is not None:
+                frame = self.inflated.read_frame()
+                if frame is not None:
+                    return frame
+            frame = self.read_wire_frame()
+            if frame is None or frame[0] != COMPRESSED_FLAG:
+                return frame
+            if self.inflater is None:
+                self.inflater = MessageDecompressor()
+                self.inflated = FrameDecoder(self.max_frame_size)
+            try:
+                self.inflated.feed(self.inflater.decompress(frame[1], self.max_frame_size))
+            except ValueError as e:
+                raise ProtocolError(str(e))
+
+    def read_wire_frame(self):
+        if self.buffered() < HEADER.size:
+            return None
+        (length,) = HEADER.unpack_from(self.buffer, self.offset)
+        flags = length & FLAGS
+        length &= ~FLAGS
+        if length > self.max_frame_size:
+            raise ProtocolError(f"Frame of {length} bytes exceeds limit")
+        start = self.offset + HEADER.size
+        if len(self.buffer) - start < length:
+            return None
+        self.offset = start + length
+        return flags, bytes(self.buffer[start:self.offset])
+
+    def next_frame(self):
+        frame = self.read_frame()
+        if frame is None:
+            return None
+        return frame[1]
+
+    def next_message(self):
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return None
+            flags, payload = frame
+            if flags & DATA_FLAG:
+                stream, offset, crc = DATA_HEADER.unpack_from(payload)
+                return {"type": "DATA", "stream": stream, "offset": offset, "crc": crc,
+                        "data": payload[DATA_HEADER.size:],
+                        "compressed": bool(flags & COMPRESSED_FLAG)}
+            if not flags & BINARY_FLAG:
+                return json.loads(payload.decode('utf-8'))
+            try:
+                message = self.binary.decode(payload)
+            except ValueError as e:
+                raise ProtocolError(str(e))
+            if message is not None:
+                return message
+            if self.server_side:
+                return {"type": "INTERN"}
+
+    def messages(self):
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+            yield message
+
+    def take_raw(self, size):
+        # Hand back up to size already-buffered bytes that are not frames
+        # (e.g. the start of a file body that arrived with its metadata)
+        end = min(self.offset + size, len(self.buffer))
+        data = bytes(self.buffer[self.offset:end])
+        self.offset = end
+        return data
+
+
+class LegacyDecoder:
+    # Server-side decoder for clients that did not ask for framing: exactly
+    # the old behaviour of one json.loads per recv(), dropping chunks that do
+    # not parse on their own.
+    def __init__(self):
+        self.pending = b''
+
+    def feed(self, data):
+        self.pending += data
+
+    def buffered(self):
+        return len(self.pending)
+
+    def next_message(self):
+        if not self.pending:
+            return None
+        data, self.pending = self.pending, b''
+        try:
+            return json.loads(data.decode('utf-8'))
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return self.next_message()
+
+    def messages(self):
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+            yield message
+
+    def take_raw(self, size):
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+class JSONStreamDecoder:
+    # Client-side fallback for talking to servers without framing support.
+    # Uses raw_decode to find real object boundaries, so nested objects and
+    # several messages per recv() no longer break the stream. Undecodable
+    # bytes are kept as surrogates so take_raw() can return them unchanged.
+    def __init__(self):
+        self.text = ''
+        self.utf8 = codecs.getincrementaldecoder('utf-8')('surrogateescape')
+        self.decoder = json.JSONDecoder()
+
+    def feed(self, data):
+        self.text += self.utf8.decode(data)
+
+    def buffered(self):
+        return len(self.text)
+
+    def next_message(self):
+        text = self.text.lstrip()
+        if not text:
+            self.text = ''
+            return None
+        try:
+            message, end = self.decoder.raw_decode(text)
+        except json.JSONDecodeError:
+            self.text = text
+            return None
+        self.text = text[end:]
+        return message
+
+    def messages(self):
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+            yield message
+
+    def take_raw(self, size):
+        data = self.text.encode('utf-8', 'surrogateescape') + self.utf8.getstate()[0]
+        self.utf8.reset()
+        self.text = ''
+        if len(data) > size:
+            self.feed(data[size:])
+        return data[:size]
+
+
+def make_decoder(framed, server_side=True):
+    if framed:
+        return FrameDecoder(server_side=server_side)
+    return LegacyDecoder() if server_side else JSONStreamDecoder()
@@ -0,0 +1,110 @@
+import time
+
+# Per-connection flood protection. Every connection has a token bucket per
+# kind of traffic: all of its messages together, and separately its room
+# messages, whispers, upload announcements and uploaded file bytes. A bucket
+# holds up to `burst` tokens and refills at `rate` per second; a message
+# costs one token of each bucket it counts against, file data one token per
+# byte.
+#
+# A message the buckets cannot pay for yet is held back until they can, as
+# long as that takes at most max_delay seconds. Meanwhile the connection's
+# handler reads nothing more, so the sender's TCP window fills up and it
+# slows down instead of the room. A message that would have to wait longer
+# is rejected and the sender told so. File bytes are only ever delayed;
+# dropping part of an upload would just make the client send it again.
+#
+# Buckets belong to the connection's handler (thread or coroutine), the only
+# caller, so they need no lock.
+
+# kind: (rate per second, burst); a rate of 0 means no limit
+DEFAULT_LIMITS = {
+    "messages": (50, 100),
+    "text": (5, 20),
+    "whisper": (5, 20),
+    "file_metadata": (1, 10),
+    "file_bytes": (0, 0),
+}
+MAX_DELAY = 1.0
+# A flood of rejected messages gets one notice per this many seconds
+NOTICE_INTERVAL = 1.0
+
+KINDS = {
+    "TEXT_MESSAGE": "text",
+    "WHISPER": "whisper",
+    "FILE_METADATA": "file_metadata",
+}
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def wait(self, amount):
+        # Seconds until amount tokens are there
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount):
+        # May leave the bucket in debt; the caller waits that off first
+        self.tokens -= amount
+
+
+class RateLimiter:
+    def __init__(self, limits, max_delay=MAX_DELAY):
+        self.buckets = {kind: TokenBucket(rate, max(burst, 1))
+                        for kind, (rate, burst) in limits.items() if rate > 0}
+        self.max_delay = max_delay
+        self.noticed = None
+
+    def admit(self, message):
+        # Seconds to hold message back before handling it, or None to drop it
+        if message['type'] == 'DATA':
+            return self.charge([("file_bytes", len(message['data']))], None)
+        charges = [("messages", 1)]
+        if message['type'] in KINDS:
+            charges.append((KINDS[message['type']], 1))
+        return self.charge(charges, self.max_delay)
+
+    def file_bytes(self, size):
+        # Seconds to wait before reading more of a raw upload
+        return self.charge([("file_bytes", size)], None)
+
+    def notice(self):
+        # True if the client should be told about a rejection now
+        now = time.monotonic()
+        if self.noticed is not None and now - self.noticed < NOTICE_INTERVAL:
+            return False
+        self.noticed = now
+        return True
+
+    def charge(self, charges, max_delay):
+        buckets = [(self.buckets[kind], amount) for kind, amount in charges if kind in self.buckets]
+        wait = max((bucket.wait(amount) for bucket, amount in buckets), default=0.0)
+        if max_delay is not None and wait > max_delay:
+            return None
+        for bucket, amount in buckets:
+            bucket.take(amount)
+        return wait
+
+
+def parse_limits(specs):
+    # ["text=2", "file_bytes=1048576/4194304"] -> DEFAULT_LIMITS with those
+    # replaced; the burst defaults to one second's worth
+    limits = dict(DEFAULT_LIMITS)
+    for spec in specs:
+        kind, _, value = spec.partition('=')
+        if kind not in limits or not value:
+            raise ValueError(f"expected KIND=RATE[/BURST] with KIND one of {', '.join(limits)}: {spec}")
+        rate, _, burst = value.partition('/')
+        rate = float(rate)
+        burst = float(burst) if burst else rate
+        if rate < 0 or burst < 0:
+            raise ValueError(f"negative rate limit: {spec}")
+        limits[kind] = (rate, burst)
+    return limits
@@ -0,0 +1,103 @@
+import threading
+
+DEFAULT_ROOM = "general"
+MAX_ROOM_NAME = 32
+
+class ClientRegistry:
+    # Connected clients, shared by every handler and writer. Mutations take a
+    # lock and rebuild an immutable snapshot (copy-on-write), so fan-out just
+    # iterates the current snapshot without locking or copying anything.
+    # The nickname index makes whisper routing a dict lookup instead of a scan.
+    # Rooms keep their own subscriber snapshots the same way, so a room
+    # broadcast costs O(room size) rather than O(server size).
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_client = {}
+        self.by_nickname = {}
+        self.snapshot = ()
+        self.rooms = {}
+
+    def add(self, client, info):
+        with self.lock:
+            self.by_client[client] = info
+            # Several connections may share a nickname; keep them in join order
+            nickname = info['nickname']
+            self.by_nickname[nickname] = self.by_nickname.get(nickname, ()) + (client,)
+            self.snapshot = tuple(self.by_client.items())
+
+    def remove(self, client):
+        # Returns the client's info, or None if someone else removed it first
+        with self.lock:
+            info = self.by_client.pop(client, None)
+            if info is None:
+                return None
+            nickname = info['nickname']
+            same_name = tuple(c for c in self.by_nickname.get(nickname, ()) if c is not client)
+            if same_name:
+                self.by_nickname[nickname] = same_name
+            else:
+                self.by_nickname.pop(nickname, None)
+            self.snapshot = tuple(self.by_client.items())
+            for room in info.get('rooms', ()):
+                self.drop_member(room, client)
+            return info
+
+    def get(self, client, default=None):
+        return self.by_client.get(client, default)
+
+    def __getitem__(self, client):
+        return self.by_client[client]
+
+    def __contains__(self, client):
+        return client in self.by_client
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    def items(self):
+        return self.snapshot
+
+    def lookup(self, nickname):
+        # All connections using a nickname (usually zero or one)
+        return self.by_nickname.get(nickname, ())
+
+    def nicknames(self):
+        return [info['nickname'] for _, info in self.snapshot]
+
+    def join_room(self, client, room):
+        # Returns False if the client is gone or already in the room
+        with self.lock:
+            info = self.by_client.get(client)
+            if info is None or room in info['rooms']:
+                return False
+            info['rooms'].add(room)
+            self.rooms[room] = self.rooms.get(room, ()) + ((client, info),)
+            return True
+
+    def leave_room(self, client, room):
+        with self.lock:
+            info = self.by_client.get(client)
+            if info is None or room not in info['rooms']:
+                return False
+            info['rooms'].discard(room)
+            self.drop_member(room, client)
+            return True
+
+    def drop_member(self, room, client):
+        # Caller holds the lock; empty rooms disappear
+        members = tuple(m for m in self.rooms.get(room, ()) if m[0] is not client)
+        if members:
+            self.rooms[room] = members
+        else:
+            self.rooms.pop(room, None)
+
+    def members(self, room):
+        return self.rooms.get(room, ())
+
+    def room_sizes(self):
+        return {room: len(members) for room, members in list(self.rooms.items())}
+
+
+def clean_room_name(name):
+    name = " ".join(str(name or "").split())[:MAX_ROOM_NAME]
+    return name or DEFAULT_ROOM
@@ -0,0 +1,68 @@
+import time
+from collections import deque
+
+# Recent events per audience, for clients that reconnect with a resume token
+# (see ChatServer.register_client). Every chat event gets the next sequence
+# number and goes into the ring of each audience it was sent to: a room
+# ("#general") or a user's own whispers and private files ("@alice"). A
+# client that comes back asks for everything after the last seq it saw and
+# gets just the events of its rooms and its whispers since then, from the
+# same encoded buffers that went out live.
+#
+# A ring keeps at most `size` events and nothing older than `window`
+# seconds; what it lets go is remembered as the newest seq it no longer has,
+# so since() can tell a complete gap from one it cannot fill.
+
+RING_SIZE = 1000
+# Sweep idle rings after this many events
+PRUNE_EVERY = 4096
+
+
+class ReplayBuffer:
+    def __init__(self, window, size=RING_SIZE):
+        self.window = window
+        self.size = size
+        self.rings = {}
+        self.evicted = {}
+        self.added = 0
+
+    def add(self, seq, keys, event, message_type):
+        # Callers add in seq order
+        now = time.monotonic()
+        for key in keys:
+            ring = self.rings.get(key)
+            if ring is None:
+                ring = self.rings[key] = deque()
+            if len(ring) == self.size:
+                self.evicted[key] = ring.popleft()[0]
+            ring.append((seq, now, event, message_type))
+        self.added += 1
+        if self.added % PRUNE_EVERY == 0:
+            self.prune(now)
+
+    def prune(self, now):
+        cutoff = now - self.window
+        for key in list(self.rings):
+            ring = self.rings[key]
+            while ring and ring[0][1] < cutoff:
+                self.evicted[key] = ring.popleft()[0]
+            if not ring:
+                del self.rings[key]
+        # Whatever went by age is older than any session that can still
+        # resume, so an audience with nothing left needs no gap marker
+        for key in list(self.evicted):
+            if key not in self.rings:
+                del self.evicted[key]
+
+    def since(self, keys, after):
+        # (seq, time, event, message_type) of every event for keys after seq
+        # `after`, in order, or None if some of them are gone already
+        events = {}
+        for key in keys:
+            if self.evicted.get(key, 0) > after:
+                return None
+            for entry in reversed(self.rings.get(key, ())):
+                if entry[0] <= after:
+                    break
+                events[entry[0]] = entry
+        return [events[seq] for seq in sorted(events)]
@@ -0,0 +1,219 @@
+import bisect
+import heapq
+import re
+import threading
+import time
+from array import array
+from operator import itemgetter
+from history import key_hash
+from eventlog import ERROR, event_log
+
+# Full-text search over the message history (see history.py). The index is
+# inverted: every token of a message body or file name maps to the ascending
+# list of sequence numbers of the messages holding it, and so do the
+# audiences a message went to (rooms, the two ends of a whisper) and its
+# sender. A query intersects those lists: it walks the shortest side from
+# the newest end, either the rarest term or the searcher's audiences merged
+# into one, and probes the others with bisect, so it touches a few entries
+# per hit instead of every message. Messages are read back from the log
+# after the index lock is released.
+#
+# Updates never run on the broadcast path: the history writer thread hands
+# over each batch after writing it, and that thread does the tokenising. On
+# start the index is rebuilt from the log in the background; batches that
+# arrive meanwhile wait until it is done.
+#
+# Only ids live here; the messages themselves are read back from the log.
+# When the log is compacted the index drops what the log no longer has.
+
+TOKEN = re.compile(r'[^\W_]+')
+MIN_TOKEN = 2
+MAX_TOKEN = 32
+RESULT_LIMIT = 50
+# Search terms per query
+MAX_TERMS = 8
+
+
+def tokens(text):
+    return {token for token in TOKEN.findall(text.lower()) if MIN_TOKEN <= len(token) <= MAX_TOKEN}
+
+
+def searchable_text(message):
+    if message.get('type') == 'FILE_AVAILABLE':
+        return message.get('filename', '')
+    if message.get('type') in ('TEXT_MESSAGE', 'WHISPER'):
+        return message.get('message', '')
+    return ''
+
+
+class SearchIndex:
+    def __init__(self, history):
+        self.history = history
+        self.lock = threading.Lock()
+        self.terms = {}
+        self.audiences = {}
+        self.senders = {}
+        # When each message was written, for time-range filters
+        self.seqs = array('Q')
+        self.times = array('d')
+        self.ready = False
+        self.waiting = []
+        history.on_append = self.add_batch
+        history.on_compact = self.prune
+        threading.Thread(target=self.rebuild, daemon=True).start()
+
+    def rebuild(self):
+        started = time.monotonic()
+        count = 0
+        try:
+            for record in self.history.scan():
+                with self.lock:
+                    self.add(*record)
+                count += 1
+        except (OSError, ValueError) as e:
+            event_log.log("search_error", f"Search index rebuild error: {str(e)}", ERROR, error=str(e))
+        with self.lock:
+            last = self.seqs[-1] if self.seqs else 0
+            for record in self.waiting:
+                if record[0] > last:
+                    self.add(*record)
+            self.waiting = []
+            self.ready = True
+        if count:
+            elapsed = time.monotonic() - started
+            event_log.log("search_indexed", f"Indexed {count} messages for search in {elapsed:.1f}s",
+                          messages=count, seconds=round(elapsed, 3))
+
+    def add_batch(self, records):
+        # Called by the history writer, in seq order
+        with self.lock:
+            if not self.ready:
+                self.waiting.extend(records)
+                return
+            for record in records:
+                self.add(*record)
+
+    def add(self, seq, at, keys, message):
+        # Caller holds the lock
+        if self.times:
+            at = max(at, self.times[-1])
+        self.seqs.append(seq)
+        self.times.append(at)
+        for token in tokens(searchable_text(message)):
+            self.posting(self.terms, token).append(seq)
+        for key in keys:
+            self.posting(self.audiences, key).append(seq)
+        sender = message.get('sender')
+        if isinstance(sender, str):
+            self.posting(self.senders, sender).append(seq)
+
+    def posting(self, table, key):
+        postings = table.get(key)
+        if postings is None:
+            postings = table[key] = array('Q')
+        return postings
+
+    def seq_bound(self, at):
+        # The first seq written at or after time at
+        n = bisect.bisect_left(self.times, at)
+        return self.seqs[n] if n < len(self.seqs) else (self.seqs[-1] + 1 if self.seqs else 0)
+
+    def search(self, query, keys, sender=None, since=None, until=None, before=None,
+               limit=RESULT_LIMIT, floors=None):
+        # (messages, cursor): newest first, the messages that hold every term
+        # of query, went to one of the audiences in keys (after its seq in
+        # floors, if any), match the filters and are numbered below before.
+        # The cursor is the before of the next page, or None after the last
+        # one.
+        floors = floors or {}
+        terms = sorted(tokens(query))[:MAX_TERMS]
+        with self.lock:
+            lists = [self.terms.get(term, ()) for term in terms]
+            if sender is not None:
+                lists.append(self.senders.get(sender, ()))
+            audiences = [(key, self.audiences[key]) for key in keys if key in self.audiences]
+            if not lists or not audiences or not all(lists):
+                return [], None
+            lists.sort(key=len)
+            high = before if before is not None else lists[0][-1] + 1
+            if until is not None:
+                high = min(high, self.seq_bound(until))
+            low = self.seq_bound(since) if since is not None else 0
+            hits = self.candidates(lists, audiences, floors, low, high, limit)
+        # The log has its own lock; the writer can carry on meanwhile
+        results = []
+        for seq, key in hits:
+            # None if compaction got to it first
+            message = self.history.fetch(seq, key)
+            if message is not None:
+                results.append(message)
+        return results, hits[-1][0] if len(hits) == limit else None
+
+    def candidates(self, lists, audiences, floors, low, high, limit):
+        # Up to limit (seq, audience key) pairs in [low, high), newest first,
+        # that are in every list and in one of the audiences. Caller holds
+        # the lock. Whichever side has fewer entries in range is walked and
+        # the other probed: the rarest term, or all the audiences merged.
+        ranges = [(key, postings, bisect.bisect_left(postings, max(low, floors.get(key, 0) + 1)),
+                   bisect.bisect_left(postings, high))
+                  for key, postings in audiences]
+        ranges = [r for r in ranges if r[2] < r[3]]
+        driver = lists[0]
+        stop = bisect.bisect_left(driver, low)
+        n = bisect.bisect_left(driver, high)
+        hits = []
+        if n - stop <= sum(end - start for _, _, start, end in ranges):
+            others = lists[1:]
+            while n > stop and len(hits) < limit:
+                n -= 1
+                seq = driver[n]
+                if not all(contains(postings, seq) for postings in others):
+                    continue
+                for key, postings, start, end in ranges:
+                    if contains(postings, seq, start, end):
+                        hits.append((seq, key))
+                        break
+            return hits
+        merged = heapq.merge(*(((postings[i], key) for i in range(end - 1, start - 1, -1))
+                               for key, postings, start, end in ranges),
+                             key=itemgetter(0), reverse=True)
+        last = None
+        for seq, key in merged:
+            # A message can reach several of the audiences
+            if seq == last:
+                continue
+            last = seq
+            if all(contains(postings, seq) for postings in lists):
+                hits.append((seq, key))
+                if len(hits) == limit:
+                    break
+        return hits
+
+    def prune(self, cutoff, floor):
+        # After a history compaction: cutoff is the oldest seq each audience
+        # (by key hash) still has, floor the oldest seq left at all. Term and
+        # sender lists keep entries past an audience's cutoff until the
+        # floor passes them; the audience check already hides them.
+        with self.lock:
+            for key, postings in list(self.audiences.items()):
+                drop_below(postings, max(cutoff.get(key_hash(key), 0), floor))
+                if not postings:
+                    del self.audiences[key]
+            for table in (self.terms, self.senders):
+                for key, postings in list(table.items()):
+                    drop_below(postings, floor)
+                    if not postings:
+                        del table[key]
+            n = bisect.bisect_left(self.seqs, floor)
+            del self.seqs[:n]
+            del self.times[:n]
+
+
+def drop_below(postings, seq):
+    del postings[:bisect.bisect_left(postings, seq)]
+
+
+def contains(postings, seq, start=0, end=None):
+    end = len(postings) if end is None else end
+    n = bisect.bisect_left(postings, seq, start, end)
+    return n < end and postings[n] == seq
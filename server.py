@@ -1,31 +1,219 @@
 import socket
 import threading
-import json
 import os
+import time
+import asyncio
+import argparse
+import hmac
+import itertools
+import uuid
+from collections import Counter, OrderedDict
 from datetime import datetime
+from protocol import (FRAMING, STREAM_CHUNK, EncodedEvent, binary_frame, chunk_data, clamp_range,
+                      make_decoder, parse_handshake, requested_ranges)
+from outbound import (DEFAULT_COALESCE_WINDOW, DEFAULT_MAX_BYTES, DEFAULT_MAX_MESSAGES,
+                      DROP_OLDEST, POLICIES, FileRange, ThreadedOutboundQueue, batch_bytes,
+                      send_segments)
+from registry import DEFAULT_ROOM, ClientRegistry, clean_room_name
+from presence import PresenceTracker, describe_change
+from filestore import FileStore
+from compression import MESSAGE_CODEC, MessageCompressor, negotiate, worth_compressing
+from compression import stats as compression_stats
+from binary import NameTable
+from history import KEEP_PER_KEY, PAGE_LIMIT, HistoryLog, room_key, user_key
+from replay import ReplayBuffer
+from search import RESULT_LIMIT, SearchIndex, tokens
+from ratelimit import DEFAULT_LIMITS, MAX_DELAY, RateLimiter, parse_limits
+from timerwheel import TimerWheel
+from metrics import ServerMetrics, serve_metrics
+from profiler import DEFAULT_SECONDS, MAX_SECONDS, Profiler
+from eventlog import (BACKUPS, DROP_NEWEST, ERROR, MAX_PENDING, OVERFLOW_POLICIES, ROTATE_BYTES,
+                      WARNING, event_log)
+
+DEFAULT_MAX_FILES = 1000
+# Seconds a dropped connection can be resumed for; its user stays in its
+# rooms until then
+RESUME_GRACE = 30.0
+# Seconds a new connection has to send its hello
+HANDSHAKE_TIMEOUT = 5.0
+# Clients that take part in heartbeats are pinged after this many quiet
+# seconds and dropped if they stay quiet for PING_TIMEOUT more. Older
+# clients cannot answer a PING, and may be quiet readers, so their sockets
+# get TCP keepalive on the same schedule instead: the kernel probes them
+# and a half-open connection ends in a recv error.
+PING_INTERVAL = 30.0
+PING_TIMEOUT = 15.0
+# Message types clients send; anything else is counted as "other"
+CLIENT_MESSAGE_TYPES = {
+    'TEXT_MESSAGE', 'WHISPER', 'FILE_METADATA', 'DATA', 'FILE_CANCEL', 'FILE_REQUEST', 'STATS',
+    'PING', 'PONG', 'BYE', 'HISTORY', 'SEARCH', 'USER_LIST_REQUEST', 'JOIN', 'LEAVE', 'ROOM_LIST',
+    'PROFILE', 'INTERN'
+}
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=5555):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((host, port))
-        self.server_socket.listen(5)
-        
-        self.clients = {}
+    def __init__(self, host='0.0.0.0', port=5555, max_queue_bytes=DEFAULT_MAX_BYTES,
+                 max_queue_messages=DEFAULT_MAX_MESSAGES, slow_consumer_policy=DROP_OLDEST,
+                 coalesce_window=DEFAULT_COALESCE_WINDOW, presence_window=0.25, reuse_port=False,
+                 max_files=DEFAULT_MAX_FILES, history_name=None, history_keep=KEEP_PER_KEY,
+                 resume_grace=RESUME_GRACE, rate_limits=DEFAULT_LIMITS, rate_limit_delay=MAX_DELAY,
+                 ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT, admin_token=None,
+                 log_max_bytes=ROTATE_BYTES, log_backups=BACKUPS, log_queue=MAX_PENDING,
+                 log_overflow=DROP_NEWEST):
+        self.clients = ClientRegistry()
         self.files = {}
         self.file_dir = "server_files"
         os.makedirs(self.file_dir, exist_ok=True)
         
-        print(f"Server started on {host}:{port}")
+        # Listen before naming anything after the port: with port 0 the log
+        # and history go under the port the system picked, not a shared "0"
+        self.reuse_port = reuse_port
+        self.server_socket = self.listen(host, port)
+        port = self.server_socket.getsockname()[1]
+        self.host = host
+        self.port = port
+        
+        # Connections, transfers and errors go to a JSON-lines event log
+        # (see eventlog.py), written off the handler threads; every process
+        # has its own file
+        log_path = None
+        if log_max_bytes > 0:
+            log_path = os.path.join(self.file_dir, 'logs', f"{history_name or port}.jsonl")
+        event_log.configure(log_path, log_max_bytes, log_backups, log_queue, log_overflow)
+        
+        # Uploads are stored by content (see filestore.py). file_refs holds
+        # the names this process uploaded, oldest first, with the store
+        # reference each one owns; past max_files the oldest are released.
+        self.store = FileStore(self.file_dir)
+        if not reuse_port:
+            # Workers share the store; their parent clears it for them
+            self.store.clear_links()
+        self.file_refs = OrderedDict()
+        self.max_files = max_files
+        # Resumable stream uploads in progress, by transfer id, so a client
+        # that reconnects can take its partial upload back
+        self.transfers = {}
+        self.transfer_lock = threading.Lock()
+        
+        # Nicknames and room names interned for binary-encoding clients;
+        # one table for all of them so each event is still encoded once
+        self.names = NameTable()
+        
+        # Room messages, whispers and file announcements, kept on disk for
+        # HISTORY requests (see history.py); every process has its own log
+        self.history = None
+        if history_keep > 0:
+            directory = os.path.join(self.file_dir, 'history', history_name or str(port))
+            self.history = HistoryLog(directory, keep_per_key=history_keep)
+        # Full-text search over that history (see search.py)
+        self.search = SearchIndex(self.history) if self.history is not None else None
+        
+        # Every chat event gets the next sequence number and is kept a while
+        # for clients that resume (see replay.py). Numbering and fan-out share
+        # the presence lock, so each queue sees events in seq order and lock
+        # order stays simple when fan-out evicts a client.
+        self.seq = self.history.seq if self.history is not None else 0
+        self.replay = ReplayBuffer(resume_grace + 60)
+        # Resume tokens: the session's nickname, its rooms while parked and,
+        # while parked, which parking the expiry timer belongs to
+        self.sessions = {}
+        self.resume_grace = resume_grace
+        self.parkings = itertools.count(1)
+        
+        # High-water marks and policy for each client's outbound queue
+        self.max_queue_bytes = max_queue_bytes
+        self.max_queue_messages = max_queue_messages
+        self.slow_consumer_policy = slow_consumer_policy
+        # How long a writer keeps collecting events before one vectored write
+        self.coalesce_window = coalesce_window
+        
+        # Token buckets every connection gets (see ratelimit.py), and how
+        # long a message over them may be held back before it is rejected
+        self.rate_limits = rate_limits
+        self.rate_limit_delay = rate_limit_delay
+        
+        # Handshake deadlines, heartbeats and other delayed work share one
+        # timer wheel (see timerwheel.py) instead of a timeout per socket
+        self.timers = TimerWheel(time.monotonic())
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        
+        # Counters and histograms (see metrics.py), for admins' STATS and
+        # the metrics endpoint; gauges are read off the live state
+        self.metrics = ServerMetrics()
+        self.metrics.gauge("chat_clients", "Connected clients", lambda: len(self.clients))
+        self.metrics.gauge("chat_parked_sessions", "Dropped clients that can still resume",
+                           lambda: sum(1 for s in list(self.sessions.values()) if s['parked']))
+        self.metrics.gauge("chat_outbound_queued_messages", "Messages waiting in client queues",
+                           lambda: self.queue_depths(lambda q: len(q.items)), "stat")
+        self.metrics.gauge("chat_outbound_queued_bytes", "Bytes waiting in client queues",
+                           lambda: self.queue_depths(lambda q: q.queued_bytes + q.bulk_bytes), "stat")
+        # Without a token, admins are the clients on this machine
+        self.admin_token = admin_token
+        # The profile an admin asked for (see profiler.py), while it runs
+        self.profiler = None
+        self.profile_lock = threading.Lock()
+        self.diagnostics_dir = os.path.join(self.file_dir, "diagnostics")
+        
+        # Joins and leaves are published per room in batches, at most once
+        # per window
+        self.presence = {}
+        self.presence_window = presence_window
+        self.presence_lock = threading.RLock()
+        self.sequence_lock = self.presence_lock
+        
+        # Event bus to sibling worker processes (see workers.py) or to other
+        # nodes (see federation.py). Per origin we keep the room presence and
+        # nicknames it announced: the latter is the directory whispers are
+        # routed by, and both are retracted when the origin goes away.
+        # Connect it before start(), or the joins and messages of clients
+        # accepted in between never reach the others.
+        self.bus = None
+        self.node_id = None
+        self.remote_presence = {}
+        self.remote_users = {}
+        
         self.running = True
+    
+    def listen(self, host, port):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # Several worker processes accept on the same port
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((host, port))
+        server_socket.listen(socket.SOMAXCONN)
+        return server_socket
+    
+    def start(self):
+        # Threaded mode: one blocking accept loop plus one thread per client
+        event_log.log("server_started", f"Server started on {self.host}:{self.port}",
+                      host=self.host, port=self.port, mode="threaded", pid=os.getpid())
         self.accept_thread = threading.Thread(target=self.accept_connections, daemon=True)
         self.accept_thread.start()
+        threading.Thread(target=self.run_timers, daemon=True).start()
+    
+    def run_timers(self):
+        # One thread keeps time for every connection
+        while self.running:
+            time.sleep(self.timers.tick)
+            self.fire_timers()
+    
+    def fire_timers(self):
+        for callback in self.timers.advance(time.monotonic()):
+            try:
+                callback()
+            except Exception as e:
+                event_log.log("timer_error", f"Timer error: {str(e)}", ERROR, error=str(e))
+    
+    def set_timer(self, delay, callback):
+        return self.timers.schedule(time.monotonic(), delay, callback)
     
     def accept_connections(self):
         while self.running:
             try:
                 client, address = self.server_socket.accept()
-                print(f"Connection from {address}")
+                event_log.log("connection_opened", f"Connection from {address}", address=address)
+                self.metrics.connections.inc()
                 
                 threading.Thread(
                     target=self.handle_client,
@@ -37,203 +225,1403 @@ class ChatServer:
     
     def handle_client(self, client):
         try:
-            # Get nickname first (with timeout)
-            client.settimeout(5.0)
+            # Get nickname first; a client that does not send it in time is
+            # closed, which ends the recv
+            deadline = self.set_timer(HANDSHAKE_TIMEOUT, lambda: self.close_client(client))
             nickname_data = client.recv(1024)
+            self.timers.cancel(deadline)
             if not nickname_data:
                 raise ConnectionError("No nickname received")
             
-            nickname = json.loads(nickname_data.decode('utf-8')).get('nickname', 'Unknown')
-            self.clients[client] = {"nickname": nickname, "address": client.getpeername()}
-            
-            # Send welcome message
-            client.sendall(json.dumps({
-                "type": "CONNECTION_SUCCESS",
-                "message": f"Welcome, {nickname}!"
-            }).encode('utf-8'))
-
-            # Reset timeout
-            client.settimeout(None)
-            
-            # Broadcast join message
-            self.broadcast({
-                "type": "SYSTEM_MESSAGE",
-                "message": f"{nickname} joined the chat",
-                "time": datetime.now().strftime("%H:%M")
-            })
+            nickname = self.register_client(client, nickname_data, client.getpeername())
+            info = self.clients[client]
+            framed = info['framed']
+            decoder = info['decoder']
             
-            # Send user list
-            self.update_user_list()
+            # Send user list and announce the join
+            self.client_joined(client, nickname)
             
             # Main message loop
+            recv_size = 65536 if framed else 4096
             while True:
                 try:
-                    data = client.recv(4096)
+                    # Handle every complete message already buffered, then read more
+                    for message in decoder.messages():
+                        message_type = self.received(message)
+                        wait = self.throttle(client, message)
+                        if wait is None:
+                            continue
+                        if wait:
+                            # Not reading meanwhile: TCP pushes back on the sender
+                            time.sleep(wait)
+                        started = time.perf_counter()
+                        self.handle_message(client, nickname, message)
+                        elapsed = time.perf_counter() - started
+                        self.metrics.handler.observe(elapsed, message_type)
+                        if self.profiler is not None:
+                            self.profiler.handled(message_type, nickname, elapsed)
+                    
+                    data = client.recv(recv_size)
                     if not data:
                         break
-                    
-                    message = json.loads(data.decode('utf-8'))
-                    self.handle_message(client, nickname, message)
+                    info['last_seen'] = time.monotonic()
+                    self.metrics.bytes_in.inc(amount=len(data))
+                    decoder.feed(data)
                 
-                except json.JSONDecodeError:
-                    continue
                 except ConnectionResetError:
                     break
         
         except Exception as e:
-            print(f"Client error: {str(e)}")
+            self.client_error(client, e)
         finally:
             self.remove_client(client)
     
+    def register_client(self, client, nickname_data, address):
+        hello, leftover = parse_handshake(nickname_data)
+        nickname = hello.get('nickname', 'Unknown')
+        
+        # Clients that announce framing get length-prefixed messages,
+        # everyone else keeps the old one-JSON-per-recv behaviour. Framed
+        # clients may also move file transfers into data frames (streams)
+        # and compress messages and transfers.
+        framed = hello.get('framing') == FRAMING
+        streams = framed and bool(hello.get('streams'))
+        codecs = negotiate(hello.get('compression')) if framed else []
+        binary = framed and hello.get('encoding') == 'binary'
+        # Heartbeats need every upload to arrive as frames, so a PONG never
+        # lands in the middle of raw file bytes
+        heartbeat = streams and bool(hello.get('heartbeat')) and self.ping_interval > 0
+        # Framed clients get a resume token; one that brings back a parked
+        # session gets its rooms back and only the events it missed
+        resumable = framed and self.resume_grace > 0
+        session = self.take_session(hello.get('resume'), nickname) if resumable else None
+        token = session['token'] if session is not None else uuid.uuid4().hex
+        decoder = make_decoder(framed)
+        decoder.feed(leftover)
+        outbound = self.create_outbound(client)
+        if MESSAGE_CODEC in codecs:
+            outbound.compressor = MessageCompressor()
+        # Legacy clients expect each message (the welcome above all) in a
+        # write of its own
+        outbound.coalesce = framed
+        info = {
+            "nickname": nickname,
+            "address": address,
+            "framed": framed,
+            "user_deltas": bool(hello.get('user_deltas')),
+            "rooms": set(),
+            "streams": streams,
+            "uploads": {},
+            "codecs": codecs,
+            "binary": binary,
+            "known_names": set(),
+            "names_lock": threading.Lock(),
+            "session": token if resumable else None,
+            "resumed": session is not None,
+            "decoder": decoder,
+            "limiter": RateLimiter(self.rate_limits, self.rate_limit_delay),
+            "admin": self.is_admin(hello, address),
+            "heartbeat": heartbeat,
+            "last_seen": time.monotonic(),
+            "pinged": 0.0,
+            "timer": None,
+            "connected": time.monotonic(),
+            "outbound": outbound
+        }
+        
+        # Send welcome message
+        welcome = {
+            "type": "CONNECTION_SUCCESS",
+            "message": f"Welcome, {nickname}!"
+        }
+        if framed:
+            welcome["framing"] = FRAMING
+        if streams:
+            welcome["streams"] = True
+        if codecs:
+            welcome["compression"] = codecs
+        if binary:
+            welcome["encoding"] = "binary"
+        if resumable:
+            welcome["resume"] = token
+        if heartbeat:
+            welcome["heartbeat"] = self.ping_interval
+        
+        with self.sequence_lock:
+            # Nothing can be numbered between the welcome and the replay.
+            # Nicknames are not authenticated, so whisper history starts
+            # with the session: an earlier holder's whispers stay theirs.
+            info['whispers_after'] = self.seq if session is None else session['whispers_after']
+            self.clients.add(client, info)
+            if resumable:
+                welcome["seq"] = self.seq
+            if session is None:
+                if resumable:
+                    self.sessions[token] = {"token": token, "nickname": nickname,
+                                            "rooms": set(), "parked": None,
+                                            "whispers_after": self.seq}
+                self.send_to_client(client, welcome)
+            else:
+                self.resume_session(client, info, session, hello.get('after'), welcome)
+        if heartbeat:
+            self.watch(client, info, self.ping_interval)
+        elif self.ping_interval > 0:
+            self.keep_alive(client)
+        event_log.log("client_registered", nickname=nickname, address=address, framed=framed,
+                      streams=streams, binary=binary, compression=codecs, heartbeat=heartbeat,
+                      admin=info['admin'], resumed=session is not None)
+        if session is None:
+            self.publish({"kind": "user", "nickname": nickname, "change": 1})
+        return nickname
+    
+    def is_admin(self, hello, address):
+        if self.admin_token is None:
+            return address[0] in ('127.0.0.1', '::1')
+        token = hello.get('admin')
+        return isinstance(token, str) and hmac.compare_digest(token, self.admin_token)
+    
+    def take_session(self, token, nickname):
+        # The parked session token names, now attached again, or None
+        with self.sequence_lock:
+            session = self.sessions.get(token) if isinstance(token, str) else None
+            if session is None or session['parked'] is None or session['nickname'] != nickname:
+                return None
+            session['parked'] = None
+            return session
+    
+    def keep_alive(self, client):
+        set_keepalive(client, self.ping_interval, self.ping_timeout)
+    
+    def watch(self, client, info, delay):
+        info['timer'] = self.set_timer(delay, lambda: self.check_idle(client, info))
+    
+    def check_idle(self, client, info):
+        # Anything the client sends counts as a sign of life. Quiet for
+        # ping_interval, it gets a PING; still quiet ping_timeout later, it
+        # is taken for dead and dropped (its session can still resume).
+        if self.clients.get(client) is not info:
+            return
+        now = time.monotonic()
+        quiet = now - info['last_seen']
+        if quiet < self.ping_interval:
+            self.watch(client, info, self.ping_interval - quiet)
+        elif info['pinged'] <= info['last_seen']:
+            info['pinged'] = now
+            self.send_to_client(client, {"type": "PING"})
+            self.watch(client, info, self.ping_timeout)
+        else:
+            event_log.log("heartbeat_timeout", f"Disconnecting unresponsive client {info['nickname']}",
+                          WARNING, nickname=info['nickname'], address=info['address'],
+                          quiet=round(quiet, 3))
+            self.remove_client(client)
+    
+    def resume_session(self, client, info, session, after, welcome):
+        # Caller holds sequence_lock. Back into the session's rooms without
+        # any presence traffic, then every event missed since seq `after`.
+        keys = [room_key(room) for room in session['rooms']] + [user_key(info['nickname'])]
+        events = None
+        if type(after) is int and 0 <= after <= self.seq:
+            events = self.replay.since(keys, after)
+        welcome["resumed"] = True
+        if events is None:
+            # Too far behind: the client reloads history and user lists
+            welcome["gap"] = True
+        self.send_to_client(client, welcome)
+        for room in session['rooms']:
+            self.clients.join_room(client, room)
+        for _, _, event, message_type in events or ():
+            if message_type in ('USER_JOINED', 'USER_LEFT') and not info['user_deltas']:
+                continue
+            self.send_event(client, info, event, message_type)
+            self.metrics.messages_out.inc(message_type)
+        if events is None or not info['user_deltas']:
+            for room in session['rooms']:
+                self.send_to_client(client, self.room_presence(room).snapshot())
+    
+    def client_error(self, client, error):
+        info = self.clients.get(client, {})
+        event_log.log("client_error", f"Client error: {str(error)}", WARNING,
+                      nickname=info.get('nickname'), address=info.get('address'), error=str(error))
+    
+    def received(self, message):
+        # Counts a client message; returns its type for the handler timing
+        message_type = message.get('type')
+        if message_type not in CLIENT_MESSAGE_TYPES:
+            message_type = 'other'
+        self.metrics.messages_in.inc(message_type)
+        return message_type
+    
+    def queue_depths(self, depth):
+        depths = [depth(info['outbound']) for _, info in self.clients.items()]
+        return {"max": max(depths, default=0), "sum": sum(depths)}
+    
+    def throttle(self, client, message):
+        # Seconds to hold message back, or None if the client is over its
+        # rate limits and the message was rejected
+        info = self.clients.get(client)
+        if info is None:
+            return 0.0
+        wait = info['limiter'].admit(message)
+        if wait is None:
+            self.rate_limited(client, info, message)
+        return wait
+    
+    def rate_limited(self, client, info, message):
+        text = "You are sending too fast; slow down and try again"
+        if message['type'] == 'FILE_METADATA':
+            # The client is waiting for an answer before it sends the file
+            ack = {"type": "FILE_ACK", "status": "error", "message": text}
+            if 'stream' in message:
+                ack["stream"] = message['stream']
+            self.send_to_client(client, ack)
+        elif info['limiter'].notice():
+            # Logged as often as the client is told, not once per message
+            event_log.log("rate_limited", level=WARNING, nickname=info['nickname'],
+                          address=info['address'], message_type=message['type'])
+            self.send_to_client(client, {
+                "type": "SYSTEM_MESSAGE",
+                "message": text,
+                "rate_limited": message['type'],
+                "time": datetime.now().strftime("%H:%M")
+            })
+    
     def handle_message(self, client, nickname, message):
         if message['type'] == 'TEXT_MESSAGE':
-            self.broadcast({
+            # Only the sender's room hears it; clients without rooms are in
+            # the default room
+            room = clean_room_name(message.get('room'))
+            if room not in self.clients.get(client, {}).get('rooms', ()):
+                self.send_to_client(client, {
+                    "type": "SYSTEM_MESSAGE",
+                    "message": f"Join {room} before sending messages to it",
+                    "time": datetime.now().strftime("%H:%M")
+                })
+                return
+            text_message = {
                 "type": "TEXT_MESSAGE",
+                "room": room,
                 "sender": nickname,
                 "message": message['message'],
                 "time": datetime.now().strftime("%H:%M")
-            })
+            }
+            self.deliver(text_message, [room_key(room)], self.clients.members(room), recorded=True)
+            self.publish({"kind": "room", "room": room, "message": text_message})
         elif message['type'] == 'WHISPER':
-            target = message['target']
-            for cli, data in self.clients.items():
-                if data['nickname'] == target:
-                    cli.sendall(json.dumps({
-                        "type": "WHISPER",
-                        "sender": nickname,
-                        "message": message['message'],
-                        "time": datetime.now().strftime("%H:%M")
-                    }).encode('utf-8'))
+            whisper = {
+                "type": "WHISPER",
+                "sender": nickname,
+                "target": message['target'],
+                "message": message['message'],
+                "time": datetime.now().strftime("%H:%M")
+            }
+            self.deliver_whisper(message['target'], whisper)
+            owners = self.whisper_route(message['target'])
+            if owners:
+                self.publish({"kind": "whisper", "to": owners, "target": message['target'],
+                              "message": whisper})
         elif message['type'] == 'FILE_METADATA':
-            self.handle_file_upload(client, nickname, message)
+            if not self.may_share_in(client, message):
+                return
+            # Content the server already has needs no transfer at all
+            if self.reuse_content(client, nickname, message):
+                return
+            if self.uses_streams(client, message):
+                self.start_upload(client, nickname, message)
+            else:
+                self.handle_file_upload(client, nickname, message)
+        elif message['type'] == 'DATA':
+            self.receive_chunk(client, message)
+        elif message['type'] == 'FILE_CANCEL':
+            if client in self.clients:
+                self.clients[client]['outbound'].cancel(message['stream'])
         elif message['type'] == 'FILE_REQUEST':
-            self.handle_file_download(client, message['filename'])
+            stream = message['stream'] if self.uses_streams(client, message) else None
+            codec = self.download_codec(client, message) if stream is not None else None
+            for offset, length in requested_ranges(message):
+                self.handle_file_download(client, message['filename'], offset, length, stream,
+                                          codec)
+        elif message['type'] == 'STATS':
+            # Compression saves bandwidth at the cost of CPU; show both.
+            # Admins get every other metric too.
+            stats = {
+                "type": "STATS",
+                "compression": compression_stats.snapshot()
+            }
+            if self.clients.get(client, {}).get('admin'):
+                stats["metrics"] = self.metrics.snapshot()
+            self.send_to_client(client, stats)
+        elif message['type'] == 'PROFILE':
+            self.start_profile(client, message)
+        elif message['type'] == 'PING':
+            self.send_to_client(client, {"type": "PONG"})
+        elif message['type'] == 'BYE':
+            # Leaving for good: no need to hold the session open
+            self.end_session(self.clients.get(client))
+        elif message['type'] == 'HISTORY':
+            # Reads the log on this client's own thread, never the broadcast path
+            info = self.clients.get(client)
+            if info is not None:
+                self.send_to_client(client, self.history_page(info, message))
+        elif message['type'] == 'SEARCH':
+            info = self.clients.get(client)
+            if info is not None:
+                self.send_to_client(client, self.search_results(info, message))
+        elif message['type'] == 'USER_LIST_REQUEST':
+            # Client noticed a gap in USER_JOINED/USER_LEFT versions
+            room = clean_room_name(message.get('room'))
+            self.send_to_client(client, self.room_presence(room).snapshot())
+        elif message['type'] == 'JOIN':
+            self.join_room(client, clean_room_name(message.get('room')))
+        elif message['type'] == 'LEAVE':
+            self.leave_room(client, clean_room_name(message.get('room')))
+        elif message['type'] == 'ROOM_LIST':
+            # Published presence covers users on every worker, not just ours
+            with self.presence_lock:
+                trackers = sorted(self.presence.items())
+            self.send_to_client(client, {
+                "type": "ROOM_LIST",
+                "rooms": [{"name": name, "users": tracker.count()}
+                          for name, tracker in trackers if tracker.count()]
+            })
         
+    def start_profile(self, client, message):
+        info = self.clients.get(client)
+        if info is None:
+            return
+        reply = {"type": "PROFILE", "status": "error"}
+        if not info['admin']:
+            reply["message"] = "Only admins can profile the server"
+            self.send_to_client(client, reply)
+            return
+        seconds = message.get('seconds', DEFAULT_SECONDS)
+        if not isinstance(seconds, (int, float)) or seconds <= 0:
+            seconds = DEFAULT_SECONDS
+        seconds = min(seconds, MAX_SECONDS)
+        with self.profile_lock:
+            if self.profiler is not None:
+                reply["message"] = "A profile is already running"
+                self.send_to_client(client, reply)
+                return
+            profiler = self.profiler = Profiler(seconds, self.diagnostics_dir, self.profiled_tasks())
+        event_log.log("profile_started", f"{info['nickname']} started a {seconds} s profile",
+                      nickname=info['nickname'], seconds=seconds)
+        self.send_to_client(client, {"type": "PROFILE", "status": "started", "seconds": seconds})
+        threading.Thread(target=self.run_profile, args=(client, profiler), daemon=True).start()
+    
+    def profiled_tasks(self):
+        # Function returning the asyncio tasks to sample; threads need none
+        return None
+    
+    def run_profile(self, client, profiler):
+        try:
+            profiler.run()
+        finally:
+            self.profiler = None
+        try:
+            files = [os.path.abspath(path) for path in profiler.write()]
+            reply = {"type": "PROFILE", "status": "done", "files": files,
+                     "samples": profiler.samples}
+            event_log.log("profile_written", f"Profile written to {files[0]}", files=files)
+        except OSError as e:
+            reply = {"type": "PROFILE", "status": "error", "message": f"Could not save the profile: {e}"}
+        self.profile_finished(client, reply)
+    
+    def profile_finished(self, client, reply):
+        self.send_to_client(client, reply)
+    
+    def uses_streams(self, client, message):
+        return 'stream' in message and self.clients.get(client, {}).get('streams', False)
+    
+    def transfer_codec(self, client, message):
+        # The codec a FILE_METADATA / FILE_REQUEST asks for, if negotiated
+        codec = message.get('compression')
+        return codec if codec in self.clients.get(client, {}).get('codecs', ()) else None
+    
+    def download_codec(self, client, message):
+        # Files that are compressed already go out as they are
+        if not worth_compressing(message['filename']):
+            return None
+        return self.transfer_codec(client, message)
+    
     def handle_file_upload(self, client, nickname, metadata):
+        upload = None
         try:
-            filename = metadata['filename']
             filesize = int(metadata['size'])
-            target = metadata.get('target')
-
-            # Create safe filename
-            safe_filename = "".join(c for c in filename if c.isalnum() or c in (' ', '.', '_', '-')).rstrip()
-            filepath = os.path.join(self.file_dir, safe_filename)
+            safe_filename = clean_filename(metadata['filename'])
 
             # Send acknowledgment
-            client.sendall(json.dumps({
+            self.send_to_client(client, {
                 "type": "FILE_ACK",
                 "status": "ready",
                 "filename": safe_filename
-            }).encode('utf-8'))
-
-            # Receive file data
-            received = 0
-            with open(filepath, 'wb') as f:
-                while received < filesize:
-                    chunk = client.recv(min(8192, filesize - received))
-                    if not chunk:
-                        raise ConnectionError("Transfer interrupted")
-                    f.write(chunk)
-                    received += len(chunk)
-
-            # Store file info
-            self.files[safe_filename] = {
-                'path': filepath,
-                'size': filesize,
-                'sender': nickname,
-                'time': datetime.now().strftime("%H:%M")
-            }
+            })
+            event_log.log("upload_started", nickname=nickname, filename=safe_filename,
+                          size=filesize, stream=None, offset=0)
 
-            # Notify clients
-            file_message = {
-                "type": "FILE_AVAILABLE",
-                "filename": safe_filename,
-                "size": filesize,
-                "sender": nickname,
-                "private": bool(target),
-                "time": datetime.now().strftime("%H:%M")
-            }
+            # Receive file data, starting with whatever the decoder already buffered
+            decoder = self.clients[client]['decoder']
+            limiter = self.clients[client]['limiter']
+            upload = self.store.begin()
+            while upload.size < filesize:
+                size = min(8192, filesize - upload.size)
+                chunk = decoder.take_raw(size) or client.recv(size)
+                if not chunk:
+                    raise ConnectionError("Transfer interrupted")
+                upload.write(chunk)
+                wait = limiter.file_bytes(len(chunk))
+                if wait:
+                    time.sleep(wait)
 
-            if target:
-                # Send to specific target
-                for cli, data in self.clients.items():
-                    if data['nickname'] == target or data['nickname'] == nickname:
-                        cli.sendall(json.dumps(file_message).encode('utf-8'))
-            else:
-                # Broadcast to all
-                self.broadcast(file_message)
+            self.file_uploaded(nickname, metadata, safe_filename, upload)
 
         except Exception as e:
-            print(f"File transfer error: {str(e)}")
+            if upload is not None:
+                upload.discard()
+            event_log.log("upload_failed", f"File transfer error: {str(e)}", WARNING,
+                          nickname=nickname, filename=metadata.get('filename'), error=str(e))
             try:
-                client.sendall(json.dumps({
+                self.send_to_client(client, {
                     "type": "FILE_ACK",
                     "status": "error",
                     "message": str(e)
-                }).encode('utf-8'))
+                })
             except:
                 pass
 
+    def start_upload(self, client, nickname, metadata):
+        # Stream upload: nothing blocks here, the file arrives as DATA frames
+        # between the client's other messages. With a transfer id the partial
+        # file outlives the connection and the ACK says where to carry on.
+        try:
+            filesize = int(metadata['size'])
+            safe_filename = clean_filename(metadata['filename'])
+            self.take_over_transfer(metadata.get('transfer'))
+            upload_file = self.open_upload(metadata.get('transfer'), filesize)
+        except (OSError, ValueError) as e:
+            self.upload_failed(client, metadata['stream'], e)
+            return
+        self.upload_ready(client, nickname, metadata, safe_filename, filesize, upload_file)
+    
+    def open_upload(self, transfer, filesize):
+        # Resuming reads and hashes the whole partial file again
+        upload_file = self.store.begin(transfer)
+        if upload_file.size > filesize:
+            # Not the file we were sent before; start over
+            upload_file.discard()
+            upload_file = self.store.begin(transfer)
+        return upload_file
+    
+    def upload_ready(self, client, nickname, metadata, safe_filename, filesize, upload_file):
+        stream = metadata['stream']
+        transfer = metadata.get('transfer')
+        info = self.clients.get(client)
+        if info is None:
+            upload_file.suspend()
+            return
+        upload = {
+            "file": upload_file,
+            "filename": safe_filename,
+            "size": filesize,
+            "nickname": nickname,
+            "metadata": metadata,
+            "client": client,
+            "stream": stream,
+            "transfer": upload_file.transfer,
+            "codec": self.transfer_codec(client, metadata),
+            "lock": threading.Lock(),
+            "closed": False,
+            "resend": None
+        }
+        info['uploads'][stream] = upload
+        ack = {
+            "type": "FILE_ACK",
+            "status": "ready",
+            "filename": safe_filename,
+            "stream": stream,
+            "offset": upload_file.size
+        }
+        if upload['transfer'] is not None:
+            with self.transfer_lock:
+                self.transfers[transfer] = upload
+            ack["transfer"] = transfer
+        self.send_to_client(client, ack)
+        event_log.log("upload_started", nickname=nickname, filename=safe_filename, size=filesize,
+                      stream=stream, offset=upload_file.size, transfer=upload['transfer'])
+        if upload_file.size == filesize:
+            self.finish_upload(client, stream)
+    
+    def take_over_transfer(self, transfer):
+        # The transfer may still belong to a connection the server has not
+        # noticed is dead; park its partial file for the new one
+        with self.transfer_lock:
+            upload = self.transfers.pop(transfer, None)
+        if upload is not None:
+            self.clients.get(upload['client'], {}).get('uploads', {}).pop(upload['stream'], None)
+            self.drop_upload(upload, keep=True)
+    
+    def receive_chunk(self, client, message):
+        stream = message['stream']
+        upload = self.clients.get(client, {}).get('uploads', {}).get(stream)
+        if upload is None:
+            # Left over from an upload that already failed or moved
+            return
+        error = None
+        with upload['lock']:
+            if upload['closed']:
+                return
+            received = upload['file'].size
+            data = chunk_data(message, upload['codec'])
+            if message['offset'] != received or data is None:
+                # Ask for everything from the last good byte. Frames already
+                # in flight behind a bad one are ignored, but a bad resent
+                # frame is asked for again.
+                if message['offset'] == received or upload['resend'] != received:
+                    upload['resend'] = received
+                    self.send_to_client(client, {
+                        "type": "FILE_ACK",
+                        "status": "resend",
+                        "stream": stream,
+                        "offset": received
+                    })
+                return
+            if received + len(data) > upload['size']:
+                error = ValueError("More data than announced")
+            else:
+                try:
+                    upload['file'].write(data)
+                except OSError as e:
+                    error = e
+        if error is not None:
+            self.abort_upload(client, stream, error)
+        elif upload['file'].size == upload['size']:
+            self.finish_upload(client, stream)
+    
+    def finish_upload(self, client, stream):
+        upload = self.clients[client]['uploads'].pop(stream, None)
+        if upload is None:
+            return
+        with upload['lock']:
+            if upload['closed']:
+                return
+            upload['closed'] = True
+            self.forget_transfer(upload)
+            try:
+                self.file_uploaded(upload['nickname'], upload['metadata'], upload['filename'],
+                                   upload['file'])
+            except (OSError, ValueError) as e:
+                upload['file'].discard()
+                self.upload_failed(client, stream, e)
+                return
+        self.send_to_client(client, {
+            "type": "FILE_ACK",
+            "status": "done",
+            "filename": upload['filename'],
+            "stream": stream
+        })
+    
+    def abort_upload(self, client, stream, error):
+        upload = self.clients.get(client, {}).get('uploads', {}).pop(stream, None)
+        if upload is not None:
+            self.drop_upload(upload)
+        self.upload_failed(client, stream, error)
+    
+    def drop_upload(self, upload, keep=False):
+        # Close an unfinished stream upload, keeping a resumable partial file
+        # if asked to
+        with upload['lock']:
+            if upload['closed']:
+                return
+            upload['closed'] = True
+            if keep:
+                upload['file'].suspend()
+            else:
+                upload['file'].discard()
+        self.forget_transfer(upload)
+    
+    def forget_transfer(self, upload):
+        with self.transfer_lock:
+            if self.transfers.get(upload['transfer']) is upload:
+                del self.transfers[upload['transfer']]
+    
+    def upload_failed(self, client, stream, error):
+        event_log.log("upload_failed", f"File transfer error: {str(error)}", WARNING,
+                      nickname=self.clients.get(client, {}).get('nickname'), stream=stream,
+                      error=str(error))
+        self.send_to_client(client, {
+            "type": "FILE_ACK",
+            "status": "error",
+            "message": str(error),
+            "stream": stream
+        })
+    
+    def may_share_in(self, client, metadata):
+        # Like TEXT_MESSAGE, a file shared with a room needs the sender in it
+        if metadata.get('target'):
+            return True
+        room = clean_room_name(metadata.get('room'))
+        if room in self.clients.get(client, {}).get('rooms', ()):
+            return True
+        ack = {"type": "FILE_ACK", "status": "error",
+               "message": f"Join {room} before sharing files in it"}
+        if 'stream' in metadata:
+            ack["stream"] = metadata['stream']
+        self.send_to_client(client, ack)
+        return False
+    
+    def reuse_content(self, client, nickname, metadata):
+        # The client sent the hash up front and we already have that
+        # content: register the name without transferring anything
+        path = self.store.reference(metadata.get('sha256'))
+        if path is None:
+            return False
+        size = os.path.getsize(path)
+        if size != int(metadata['size']):
+            self.store.release(metadata['sha256'], path)
+            return False
+        
+        safe_filename = clean_filename(metadata['filename'])
+        ack = {
+            "type": "FILE_ACK",
+            "status": "exists",
+            "filename": safe_filename
+        }
+        if 'stream' in metadata:
+            ack["stream"] = metadata['stream']
+        self.send_to_client(client, ack)
+        event_log.log("upload_reused", nickname=nickname, filename=safe_filename, size=size,
+                      content=metadata['sha256'])
+        self.add_file(nickname, metadata, safe_filename, metadata['sha256'], path, size)
+        return True
+    
+    def file_uploaded(self, nickname, metadata, safe_filename, upload):
+        self.file_committed(nickname, metadata, safe_filename, upload, *upload.commit())
+    
+    def file_committed(self, nickname, metadata, safe_filename, upload, content_id, path):
+        # The upload is in the store; check it and share it
+        if metadata.get('sha256') not in (None, content_id):
+            self.store.release(content_id, path)
+            raise ValueError("Checksum mismatch")
+        received = upload.size - upload.resumed_size
+        elapsed = time.monotonic() - upload.started
+        self.metrics.uploads.inc()
+        self.metrics.upload_bytes.inc(amount=received)
+        if received and elapsed > 0:
+            self.metrics.upload_throughput.observe(received / elapsed)
+        event_log.log("upload_finished", nickname=nickname, filename=safe_filename,
+                      size=upload.size, received=received, seconds=round(elapsed, 3),
+                      content=content_id)
+        self.add_file(nickname, metadata, safe_filename, content_id, path, upload.size)
+    
+    def unique_filename(self, filename, content_id):
+        # Same name and same content is the same file; a different file
+        # under a taken name becomes "name-2.ext" and so on
+        stem, ext = os.path.splitext(filename)
+        candidate, n = filename, 1
+        while candidate in self.files and self.files[candidate].get('content') != content_id:
+            n += 1
+            candidate = f"{stem}-{n}{ext}"
+        return candidate
+    
+    def add_file(self, nickname, metadata, filename, content_id, path, size):
+        # Store file info and tell everyone who should know
+        filename = self.unique_filename(filename, content_id)
+        if filename in self.file_refs:
+            # Already stored under this name; one reference is enough
+            self.store.release(content_id, path)
+            path = self.file_refs.pop(filename)[1]
+        self.file_refs[filename] = (content_id, path)
+        self.files[filename] = {
+            'path': path,
+            'size': size,
+            'content': content_id,
+            'sender': nickname,
+            'target': metadata.get('target') or None,
+            'node': self.node_id,
+            'time': datetime.now().strftime("%H:%M")
+        }
+        self.evict_files()
+        
+        file_message = {
+            "type": "FILE_AVAILABLE",
+            "filename": filename,
+            "size": size,
+            "sender": nickname,
+            "private": bool(metadata.get('target')),
+            "time": datetime.now().strftime("%H:%M")
+        }
+        self.notify_file_available(nickname, metadata, file_message)
+    
+    def evict_files(self):
+        while len(self.file_refs) > self.max_files:
+            filename, (content_id, path) = self.file_refs.popitem(last=False)
+            if self.files.get(filename, {}).get('path') == path:
+                del self.files[filename]
+                self.publish({"kind": "file_removed", "filename": filename, "content": content_id})
+            self.store.release(content_id, path)
+    
+    def deliver_whisper(self, target, whisper):
+        # Both ends of a whisper can page back through it, nobody else
+        recipients = [(cli, self.clients.get(cli)) for cli in self.clients.lookup(target)]
+        self.deliver(whisper, [user_key(target)], recipients,
+                     recorded=[user_key(whisper['sender']), user_key(target)])
+    
+    def deliver(self, message, keys, recipients, recorded=False):
+        # Number a chat event, keep it for resuming clients of the audiences
+        # in keys (and in history if recorded: True for the same keys, or
+        # the history keys) and queue it for recipients
+        with self.sequence_lock:
+            self.seq += 1
+            message['seq'] = self.seq
+            event = EncodedEvent(message)
+            message_type = message['type']
+            self.replay.add(self.seq, keys, event, message_type)
+            if recorded and self.history is not None:
+                self.history.record(message, keys if recorded is True else recorded, self.seq)
+            self.fan_out(event, message_type, recipients)
+    
+    def history_page(self, info, message):
+        # A HISTORY reply: up to limit messages before seq "before", oldest
+        # first, of a room the client is in or of its own whispers and
+        # private files. "before" in the reply asks for the next page.
+        reply = {"type": "HISTORY", "messages": []}
+        if message.get('whispers'):
+            reply["whispers"] = True
+            keys = [user_key(info['nickname'])]
+        else:
+            room = clean_room_name(message.get('room'))
+            reply["room"] = room
+            if room not in info['rooms']:
+                reply["error"] = f"Join {room} to see its history"
+                return reply
+            keys = [room_key(room)]
+        
+        before = message.get('before')
+        if type(before) is not int or before < 1:
+            before = None
+        limit = message.get('limit')
+        if type(limit) is not int or not 0 < limit <= PAGE_LIMIT:
+            limit = PAGE_LIMIT
+        if self.history is not None:
+            reply["messages"] = self.history.page(keys, before, limit, self.history_floors(info))[::-1]
+        if len(reply["messages"]) == limit:
+            reply["before"] = reply["messages"][0]['seq']
+        return reply
+    
+    def history_floors(self, info):
+        # The seq each of the client's audiences has history after
+        return {user_key(info['nickname']): info['whispers_after']}
     
-    def handle_file_download(self, client, filename):
-        if filename not in self.files:
+    def search_results(self, info, message):
+        # A SEARCH reply: messages holding every word of "query", newest
+        # first, from the client's rooms (or just "room") and its own
+        # whispers and private files, optionally only from "sender" and
+        # between "since" and "until" (Unix times)
+        query = message.get('query') if isinstance(message.get('query'), str) else ''
+        reply = {"type": "SEARCH", "query": query, "results": []}
+        if self.search is None:
+            reply["error"] = "Search needs the message history, which is off"
+            return reply
+        if message.get('room') is not None:
+            room = clean_room_name(message['room'])
+            reply["room"] = room
+            if room not in info['rooms']:
+                reply["error"] = f"Join {room} to search it"
+                return reply
+            keys = [room_key(room)]
+        else:
+            keys = [room_key(room) for room in list(info['rooms'])] + [user_key(info['nickname'])]
+        sender = message.get('sender') if isinstance(message.get('sender'), str) else None
+        if not tokens(query) and sender is None:
+            reply["error"] = "Nothing to search for"
+            return reply
+        
+        since, until = (message.get(name) for name in ('since', 'until'))
+        before = message.get('before')
+        limit = message.get('limit')
+        if type(limit) is not int or not 0 < limit <= RESULT_LIMIT:
+            limit = RESULT_LIMIT
+        reply["results"], cursor = self.search.search(
+            query, keys, sender,
+            since if type(since) in (int, float) else None,
+            until if type(until) in (int, float) else None,
+            before if type(before) is int and before > 0 else None,
+            limit, self.history_floors(info))
+        if cursor is not None:
+            reply["before"] = cursor
+        if not self.search.ready:
+            # Still indexing the log from before this start
+            reply["partial"] = True
+        return reply
+    
+    def whisper_route(self, target):
+        # Other workers/nodes with a connection using this nickname
+        return [origin for origin, users in list(self.remote_users.items()) if users[target] > 0]
+    
+    def notify_file_available(self, nickname, metadata, file_message):
+        target = metadata.get('target')
+        room = clean_room_name(metadata.get('room'))
+        self.deliver_file_available(nickname, target, room, file_message)
+        self.publish({
+            "kind": "file",
+            "nickname": nickname,
+            "target": target,
+            "room": room,
+            "file": self.files[file_message['filename']],
+            "message": file_message
+        })
+    
+    def deliver_file_available(self, nickname, target, room, file_message):
+        if target:
+            # Send to the target and a copy back to the sender
+            file_message['target'] = target
+            recipients = self.clients.lookup(target)
+            keys = [user_key(target)]
+            if target != nickname:
+                recipients += self.clients.lookup(nickname)
+                keys.append(user_key(nickname))
+            self.deliver(file_message, keys, [(cli, self.clients.get(cli)) for cli in recipients],
+                         recorded=True)
+        else:
+            # Broadcast to the room it was shared in
+            file_message['room'] = room
+            self.deliver(file_message, [room_key(room)], self.clients.members(room), recorded=True)
+    
+    def can_download(self, nickname, info):
+        # Files shared privately are for their sender and target only
+        target = info.get('target')
+        return not target or nickname in (target, info.get('sender'))
+    
+    def downloadable(self, client, filename):
+        # The file's info, if this client may have it
+        info = self.files.get(filename)
+        if info is None or not self.can_download(self.clients.get(client, {}).get('nickname'), info):
+            return None
+        return info
+    
+    def is_remote(self, info):
+        # Files uploaded to another federated node are streamed from there
+        return info.get('node') not in (None, self.node_id)
+    
+    def file_start(self, filename, offset, length, stream=None, codec=None):
+        # size is the whole file; length bytes starting at offset follow,
+        # raw or as DATA frames of the stream, compressed with codec
+        message = {
+            "type": "FILE_START",
+            "filename": filename,
+            "size": self.files[filename]['size'],
+            "offset": offset,
+            "length": length
+        }
+        if 'content' in self.files[filename]:
+            # Lets the client check the whole file once it has all of it
+            message["sha256"] = self.files[filename]['content']
+        if stream is not None:
+            message["stream"] = stream
+        if codec is not None:
+            message["compression"] = codec
+        return message
+    
+    def file_unavailable(self, client, filename, error):
+        self.download_failed(client, filename, error)
+        self.send_to_client(client, {
+            "type": "SYSTEM_MESSAGE",
+            "message": f"{filename} is not available right now",
+            "time": datetime.now().strftime("%H:%M")
+        })
+    
+    def handle_file_download(self, client, filename, offset=0, length=None, stream=None, codec=None):
+        info = self.downloadable(client, filename)
+        if info is None:
+            return
+        offset, length = clamp_range(info['size'], offset, length)
+        if stream is not None and client in self.clients:
+            self.clients[client]['outbound'].set_stream_codec(stream, codec)
+        self.download_started(client, filename, offset, length, stream)
+        
+        if not self.is_remote(info):
+            if not os.path.exists(info['path']):
+                self.file_unavailable(client, filename, FileNotFoundError(info['path']))
+                return
+            # The range is queued behind the FILE_START and the writer sends
+            # it with sendfile(): in order with the chat messages around it,
+            # or chunk by chunk behind them when the client uses streams
+            self.send_to_client(client, self.file_start(filename, offset, length, stream, codec))
+            if stream is None:
+                self.enqueue(client, (FileRange(info['path'], offset, length),), None)
+            elif client in self.clients:
+                # Data frames carry per-chunk checksums, precomputed by the store
+                file_range = FileRange(info['path'], offset, length,
+                                       self.store.checksums(info.get('content')), info['size'])
+                self.clients[client]['outbound'].put_range(stream, file_range)
             return
         
-        filepath = self.files[filename]['path']
+        try:
+            f = self.bus.open_remote_file(info['node'], filename, offset, length,
+                                          self.clients.get(client, {}).get('nickname'))
+        except (OSError, KeyError) as e:
+            self.file_unavailable(client, filename, e)
+            return
         
         try:
-            # Send file metadata
-            client.sendall(json.dumps({
-                "type": "FILE_START",
-                "filename": filename,
-                "size": self.files[filename]['size']
-            }).encode('utf-8'))
+            self.send_to_client(client, self.file_start(filename, offset, length, stream, codec))
             
-            # Send file data
-            with open(filepath, 'rb') as f:
+            # Files on another node are streamed through the queue; put_bulk
+            # waits for the writer instead of shedding
+            outbound = self.clients[client]['outbound']
+            with f:
                 while True:
-                    data = f.read(8192)
+                    data = f.read(STREAM_CHUNK)
                     if not data:
                         break
-                    client.sendall(data)
+                    if stream is None:
+                        accepted = outbound.put_bulk(data)
+                    else:
+                        accepted = outbound.put_stream(stream, data, offset)
+                    if not accepted:
+                        raise ConnectionError("Client disconnected or cancelled the download")
+                    offset += len(data)
         
         except Exception as e:
-            print(f"File download error: {str(e)}")
+            self.download_failed(client, filename, e)
     
-    def broadcast(self, message):
-        message_json = json.dumps(message)
-        for client in list(self.clients.keys()):
-            try:
-                client.sendall(message_json.encode('utf-8'))
-            except:
-                self.remove_client(client)
+    def download_started(self, client, filename, offset, length, stream):
+        self.metrics.downloads.inc()
+        self.metrics.download_bytes.inc(amount=length)
+        event_log.log("download_started", nickname=self.clients.get(client, {}).get('nickname'),
+                      filename=filename, offset=offset, length=length, stream=stream)
     
-    def update_user_list(self):
-        user_list = {
-            "type": "USER_LIST",
-            "users": [data['nickname'] for data in self.clients.values()]
-        }
-        self.broadcast(user_list)
+    def download_failed(self, client, filename, error):
+        event_log.log("download_failed", f"File download error: {str(error)}", WARNING,
+                      nickname=self.clients.get(client, {}).get('nickname'), filename=filename,
+                      error=str(error))
     
-    def remove_client(self, client):
-        if client in self.clients:
-            nickname = self.clients[client]['nickname']
-            del self.clients[client]
-            client.close()
+    def create_outbound(self, client):
+        outbound = ThreadedOutboundQueue(self.max_queue_bytes, self.max_queue_messages,
+                                         self.slow_consumer_policy)
+        threading.Thread(
+            target=self.client_writer,
+            args=(client, outbound),
+            daemon=True
+        ).start()
+        return outbound
+    
+    def client_writer(self, client, outbound):
+        # The only place that writes to this client's socket
+        try:
+            while True:
+                batch = outbound.get_batch(self.coalesce_window)
+                if not batch:
+                    break
+                send_segments(client, batch)
+                self.metrics.bytes_out.inc(amount=batch_bytes(batch))
+        except OSError:
+            pass
+        finally:
+            self.remove_client(client)
+    
+    def enqueue(self, client, segments, message_type):
+        # Never blocks: slow consumers are shed or evicted by their queue policy
+        info = self.clients.get(client)
+        if info is None:
+            return
+        if not info['outbound'].put(segments, message_type):
+            event_log.log("slow_consumer", f"Disconnecting slow consumer {info['nickname']}",
+                          WARNING, nickname=info['nickname'], address=info['address'],
+                          policy=self.slow_consumer_policy)
+            self.remove_client(client)
+    
+    def send_to_client(self, client, message):
+        self.send_event(client, self.clients.get(client), EncodedEvent(message), message['type'])
+        self.metrics.messages_out.inc(message['type'])
+    
+    def broadcast(self, message, recipients=None):
+        # Serialise once; every queue gets references to the same buffers.
+        # recipients is a sequence of (client, info) pairs, default everyone.
+        if recipients is None:
+            recipients = self.clients.items()
+        self.fan_out(EncodedEvent(message), message['type'], recipients)
+    
+    def fan_out(self, event, message_type, recipients):
+        # Queue event for every recipient; metrics are updated once per event,
+        # not once per recipient
+        started = time.perf_counter()
+        count = 0
+        for client, info in recipients:
+            self.send_event(client, info, event, message_type)
+            count += 1
+        self.metrics.fanout.observe(time.perf_counter() - started)
+        self.metrics.messages_out.inc(message_type, count)
+    
+    def send_event(self, client, info, event, message_type):
+        if info is None:
+            return
+        if info['binary']:
+            segments, used = event.binary_segments(self.names)
+            if segments is not None:
+                # Names this client has not seen yet are defined first, in
+                # their own never-dropped queue entry
+                with info['names_lock']:
+                    new = sorted(set(used) - info['known_names'])
+                    if new:
+                        info['known_names'].update(new)
+                        definitions = tuple(binary_frame(self.names.definition(number))
+                                            for number in new)
+                        self.enqueue(client, definitions, "INTERN")
+                    self.enqueue(client, segments, message_type)
+                return
+        self.enqueue(client, event.segments(info['framed']), message_type)
+    
+    def update_user_list(self, room, recipients=None):
+        self.broadcast(self.room_presence(room).snapshot(), recipients)
+    
+    def room_presence(self, room):
+        with self.presence_lock:
+            tracker = self.presence.get(room)
+            if tracker is None:
+                tracker = self.presence[room] = PresenceTracker(room)
+            return tracker
+    
+    def client_joined(self, client, nickname):
+        # A resumed session is back in its rooms already
+        if not self.clients.get(client, {}).get('resumed'):
+            self.join_room(client, DEFAULT_ROOM)
+    
+    def join_room(self, client, room):
+        if not self.clients.join_room(client, room):
+            return
+        # The newcomer gets a full snapshot of the room right away; the other
+        # members hear about it in the next presence batch
+        info = self.clients.get(client)
+        if info is not None:
+            self.send_to_client(client, self.room_presence(room).snapshot())
+            self.local_presence_changed(room, info['nickname'], 1)
+    
+    def leave_room(self, client, room):
+        info = self.clients.get(client)
+        if info is not None and self.clients.leave_room(client, room):
+            self.local_presence_changed(room, info['nickname'], -1)
+    
+    def local_presence_changed(self, room, nickname, change):
+        # A join or leave by one of our own clients; siblings learn about it too
+        self.presence_changed(room, nickname, change)
+        self.publish({"kind": "presence", "room": room, "nickname": nickname, "change": change})
+    
+    def presence_changed(self, room, nickname, change):
+        with self.presence_lock:
+            first = self.room_presence(room).record(nickname, change)
+        if self.presence_window <= 0:
+            self.flush_presence(room)
+        elif first:
+            self.set_timer(self.presence_window, lambda: self.flush_presence(room))
+    
+    def flush_presence(self, room):
+        # Serialised so batches reach every queue in version order
+        with self.presence_lock:
+            tracker = self.presence.get(room)
+            if tracker is None:
+                return
+            events, joined, left = tracker.flush()
+            if tracker.is_idle():
+                del self.presence[room]
+            if not events:
+                return
             
-            self.broadcast({
-                "type": "SYSTEM_MESSAGE",
-                "message": f"{nickname} left the chat",
-                "time": datetime.now().strftime("%H:%M")
-            })
-            self.update_user_list()
+            members = self.clients.members(room)
+            now = datetime.now().strftime("%H:%M")
+            for nicknames, verb in ((joined, "joined"), (left, "left")):
+                if nicknames:
+                    self.deliver({
+                        "type": "SYSTEM_MESSAGE",
+                        "room": room,
+                        "message": describe_change(nicknames, verb),
+                        "time": now
+                    }, [room_key(room)], members)
+            
+            # Delta-aware clients get USER_LEFT/USER_JOINED, older clients
+            # one full USER_LIST per batch
+            delta_clients = [(c, d) for c, d in members if d['user_deltas']]
+            legacy_clients = [(c, d) for c, d in members if not d['user_deltas']]
+            for event in events:
+                self.deliver(event, [room_key(room)], delta_clients)
+            if legacy_clients:
+                self.update_user_list(room, legacy_clients)
+    
+    def close_client(self, client):
+        # shutdown() also wakes up a writer thread blocked in sendall
+        try:
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        client.close()
+    
+    def remove_client(self, client):
+        # Handler and writer threads can both get here; remove() lets exactly one win
+        info = self.clients.remove(client)
+        if info is not None:
+            if info['timer'] is not None:
+                self.timers.cancel(info['timer'])
+            info['outbound'].close()
+            self.close_client(client)
+            for upload in list(info['uploads'].values()):
+                self.drop_upload(upload, keep=True)
+            parked = self.park_session(info)
+            if not parked:
+                self.client_left(info['nickname'], info['rooms'])
+            event_log.log("client_disconnected", nickname=info['nickname'], address=info['address'],
+                          seconds=round(time.monotonic() - info['connected'], 3), parked=parked)
+    
+    def client_left(self, nickname, rooms):
+        for room in rooms:
+            self.local_presence_changed(room, nickname, -1)
+        self.publish({"kind": "user", "nickname": nickname, "change": -1})
+    
+    def park_session(self, info):
+        # Keep a dropped client's session for resume_grace seconds; it stays
+        # in its rooms meanwhile, so a quick reconnect costs no presence events
+        token = info['session']
+        if token is None or not self.running:
+            return False
+        with self.sequence_lock:
+            session = self.sessions.get(token)
+            if session is None:
+                return False
+            parked = session['parked'] = next(self.parkings)
+            session['rooms'] = set(info['rooms'])
+        self.set_timer(self.resume_grace, lambda: self.expire_session(token, parked))
+        return True
+    
+    def expire_session(self, token, parked):
+        with self.sequence_lock:
+            session = self.sessions.get(token)
+            if session is None or session['parked'] != parked:
+                return
+            del self.sessions[token]
+        self.client_left(session['nickname'], session['rooms'])
+    
+    def end_session(self, info):
+        if info is not None and info['session'] is not None:
+            with self.sequence_lock:
+                self.sessions.pop(info['session'], None)
+            info['session'] = None
+    
+    def publish(self, event):
+        if self.bus is not None:
+            self.bus.publish(event)
+    
+    def dispatch_bus_event(self, event):
+        # Called on the bus reader thread
+        try:
+            self.handle_bus_event(event)
+        except Exception as e:
+            event_log.log("bus_event_error", f"Bus event error: {str(e)}", ERROR,
+                          kind=event.get('kind'), error=str(e))
+    
+    def handle_bus_event(self, event):
+        # Replay something that happened on another worker for our own clients
+        kind = event.get('kind')
+        if kind == 'room':
+            self.deliver(event['message'], [room_key(event['room'])],
+                         self.clients.members(event['room']), recorded=True)
+        elif kind == 'whisper':
+            self.deliver_whisper(event['target'], event['message'])
+        elif kind == 'file':
+            self.files[event['message']['filename']] = event['file']
+            self.deliver_file_available(event['nickname'], event['target'], event['room'],
+                                        event['message'])
+        elif kind == 'file_removed':
+            if self.files.get(event['filename'], {}).get('content') == event['content']:
+                del self.files[event['filename']]
+        elif kind == 'presence':
+            remote = self.remote_presence.setdefault(event['origin'], Counter())
+            remote[(event['room'], event['nickname'])] += event['change']
+            self.presence_changed(event['room'], event['nickname'], event['change'])
+        elif kind == 'user':
+            self.remote_users.setdefault(event['origin'], Counter())[event['nickname']] += event['change']
+        elif kind == 'sync':
+            self.apply_remote_state(event['origin'], event)
+        elif kind == 'sync_request':
+            # A worker joined the bus and knows nothing of ours yet
+            self.publish(dict(self.local_state(), kind="sync", to=[event['origin']]))
+        elif kind == 'peer_lost':
+            # A sibling or node went away: everyone it announced is gone as well
+            self.apply_remote_state(event['origin'], {"presence": [], "users": [], "files": {}})
+    
+    def local_state(self):
+        # What this server would announce to a node or worker that just joined
+        presence = Counter()
+        for _, info in self.clients.items():
+            for room in list(info['rooms']):
+                presence[(room, info['nickname'])] += 1
+        return {
+            "presence": [[room, nickname, count] for (room, nickname), count in presence.items()],
+            "users": list(Counter(self.clients.nicknames()).items()),
+            "files": {name: info for name, info in list(self.files.items()) if not self.is_remote(info)}
+        }
+    
+    def apply_remote_state(self, origin, state):
+        # Replace what origin announced earlier with state, publishing only
+        # the presence differences
+        old = self.remote_presence.pop(origin, Counter())
+        new = Counter({(room, nickname): count for room, nickname, count in state['presence']})
+        for room, nickname in set(old) | set(new):
+            change = new[(room, nickname)] - old[(room, nickname)]
+            if change:
+                self.presence_changed(room, nickname, change)
+        self.remote_presence[origin] = new
+        self.remote_users[origin] = Counter(dict(state['users']))
+        
+        for name, info in list(self.files.items()):
+            if info.get('node') == origin and name not in state['files']:
+                del self.files[name]
+        self.files.update(state['files'])
     
     def shutdown(self):
         self.running = False
         self.server_socket.close()
+        event_log.log("server_stopped", pid=os.getpid())
 
-if __name__ == "__main__":
-    server = ChatServer()
+def set_keepalive(sock, idle, timeout, probes=3):
+    # Probe after idle quiet seconds, give up timeout seconds later
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle)))
+        elif hasattr(socket, 'TCP_KEEPALIVE'):
+            # macOS
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, max(1, int(idle)))
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                            max(1, int(timeout / probes)))
+        if hasattr(socket, 'TCP_KEEPCNT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, probes)
+    except OSError:
+        # Not a TCP socket (socket pairs in tests and benchmarks)
+        pass
+
+def clean_filename(filename):
+    return "".join(c for c in filename if c.isalnum() or c in (' ', '.', '_', '-')).rstrip()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Basic chat server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded',
+                        help="threaded: one thread per client (default), asyncio: single event loop")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes sharing the port via SO_REUSEPORT")
+    parser.add_argument('--peer-port', type=int,
+                        help="federate with other nodes: accept peer links on this port")
+    parser.add_argument('--peers', default='',
+                        help="comma-separated host:peer-port list of nodes to link to")
+    parser.add_argument('--peer-secret', default=os.environ.get('CHAT_PEER_SECRET'),
+                        help="secret every node of the federation shares; peers that do not know it are refused (default $CHAT_PEER_SECRET)")
+    parser.add_argument('--node-id',
+                        help="this node's name in the federation (default hostname:port)")
+    parser.add_argument('--max-queue-bytes', type=int, default=DEFAULT_MAX_BYTES,
+                        help="outbound high-water mark per client, in bytes")
+    parser.add_argument('--max-queue-messages', type=int, default=DEFAULT_MAX_MESSAGES,
+                        help="outbound high-water mark per client, in messages")
+    parser.add_argument('--slow-consumer-policy', choices=POLICIES, default=DROP_OLDEST,
+                        help="what to do when a client's outbound queue is over its high-water mark")
+    parser.add_argument('--coalesce-ms', type=float, default=DEFAULT_COALESCE_WINDOW * 1000,
+                        help="collect outgoing events for this long before writing them in one syscall (0 disables)")
+    parser.add_argument('--presence-window-ms', type=float, default=250,
+                        help="publish joins/leaves at most this often, batched (0 publishes each one)")
+    parser.add_argument('--max-files', type=int, default=DEFAULT_MAX_FILES,
+                        help="shared files to keep; the oldest are dropped and unreferenced content deleted")
+    parser.add_argument('--resume-grace', type=float, default=RESUME_GRACE,
+                        help="seconds a dropped client can reconnect and get just the events it missed (0 disables)")
+    parser.add_argument('--history-keep', type=int, default=KEEP_PER_KEY,
+                        help="messages of history kept per room and per user's whispers (0 disables history)")
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='KIND=RATE[/BURST]',
+                        help=f"per-connection limit, repeatable; KIND is one of {', '.join(DEFAULT_LIMITS)}, "
+                             "RATE per second (0 disables), BURST defaults to RATE")
+    parser.add_argument('--rate-limit-delay-ms', type=float, default=MAX_DELAY * 1000,
+                        help="hold messages over a rate limit back this long at most, then reject them (0 rejects at once)")
+    parser.add_argument('--ping-interval', type=float, default=PING_INTERVAL,
+                        help="ping clients that have been quiet this many seconds (0 disables heartbeats)")
+    parser.add_argument('--ping-timeout', type=float, default=PING_TIMEOUT,
+                        help="drop a pinged client that stays quiet this many seconds more")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve metrics in the Prometheus text format on this local port (workers use the ports after it)")
+    parser.add_argument('--admin-token',
+                        help="clients sending this token in their hello get admin STATS (default: clients on this machine)")
+    parser.add_argument('--log-max-mb', type=float, default=ROTATE_BYTES / (1024 * 1024),
+                        help="rotate the JSON-lines event log in server_files/logs at this size (0 disables the file)")
+    parser.add_argument('--log-backups', type=int, default=BACKUPS,
+                        help="rotated event log files to keep")
+    parser.add_argument('--log-queue', type=int, default=MAX_PENDING,
+                        help="events waiting for the log writer before the overflow policy applies")
+    parser.add_argument('--log-overflow', choices=OVERFLOW_POLICIES, default=DROP_NEWEST,
+                        help="what to do with events when the log writer is behind")
+    args = parser.parse_args()
+    try:
+        args.rate_limits = parse_limits(args.rate_limit)
+    except ValueError as e:
+        parser.error(f"--rate-limit: {e}")
+    if args.peers and args.peer_port is None:
+        parser.error("--peers needs --peer-port")
+    if args.peer_port is not None and not args.peer_secret:
+        parser.error("--peer-port needs --peer-secret (or CHAT_PEER_SECRET)")
+    if args.peer_port is not None and args.workers > 1:
+        parser.error("--peer-port cannot be combined with --workers")
+    return args
+
+def create_server(args, reuse_port=False, worker=None, connect_bus=None):
+    # connect_bus(server) returns the server's event bus, connected before
+    # the server accepts anyone
+    if args.mode == 'asyncio':
+        from async_server import AsyncChatServer
+        server_class = AsyncChatServer
+    else:
+        server_class = ChatServer
+    server = server_class(
+        args.host, args.port,
+        max_queue_bytes=args.max_queue_bytes,
+        max_queue_messages=args.max_queue_messages,
+        slow_consumer_policy=args.slow_consumer_policy,
+        coalesce_window=args.coalesce_ms / 1000,
+        presence_window=args.presence_window_ms / 1000,
+        reuse_port=reuse_port,
+        max_files=args.max_files,
+        history_name=f"{args.port}-w{worker}" if worker is not None else None,
+        history_keep=args.history_keep,
+        resume_grace=args.resume_grace,
+        rate_limits=args.rate_limits,
+        rate_limit_delay=args.rate_limit_delay_ms / 1000,
+        ping_interval=args.ping_interval,
+        ping_timeout=args.ping_timeout,
+        admin_token=args.admin_token,
+        log_max_bytes=int(args.log_max_mb * 1024 * 1024),
+        log_backups=args.log_backups,
+        log_queue=args.log_queue,
+        log_overflow=args.log_overflow)
+    if connect_bus is not None:
+        server.bus = connect_bus(server)
+    server.start()
+    if args.metrics_port is not None:
+        port = args.metrics_port + (worker or 0)
+        serve_metrics(server.metrics, '127.0.0.1', port)
+        event_log.log("metrics_started", f"Metrics on http://127.0.0.1:{port}/metrics", port=port)
+    return server
+
+def run_server(server):
     try:
-        server.accept_thread.join()
+        if hasattr(server, 'serve_forever'):
+            asyncio.run(server.serve_forever())
+        else:
+            server.accept_thread.join()
     except KeyboardInterrupt:
-        server.shutdown()
\ No newline at end of file
+        server.shutdown()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.workers > 1:
+        from workers import run_workers
+        run_workers(args)
+    else:
+        connect_bus = None
+        if args.peer_port is not None:
+            from federation import federate
+            connect_bus = lambda server: federate(server, args)
+        run_server(create_server(args, connect_bus=connect_bus))
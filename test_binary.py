@@ -0,0 +1,108 @@
+import unittest
+
+from binary import (MAX_CLIENT_NAMES, BinaryDecoder, NameTable, encode, read_uint, write_uint)
+from protocol import FrameDecoder, encode_binary_message
+
+MESSAGES = [
+    {"type": "TEXT_MESSAGE", "room": "general", "sender": "alice", "message": "hi ✓",
+     "time": "14:05", "seq": 12},
+    {"type": "WHISPER", "sender": "bob", "target": "alice", "message": "", "time": "23:59"},
+    {"type": "USER_LIST", "room": "general", "users": ["alice", "bob", "carol"], "version": 0},
+    {"type": "FILE_AVAILABLE", "filename": "a.bin", "size": 1 << 40, "sender": "alice",
+     "private": True, "time": "00:00", "target": "bob"},
+    {"type": "FILE_ACK", "status": "ready", "stream": 3, "transfer": "0123456789abcdef"},
+    {"type": "ROOM_LIST", "rooms": [{"name": "general", "users": 2}]},
+]
+
+
+def round_trip(message, table, decoder):
+    payload, used = encode(message, table)
+    for number in sorted(set(used)):
+        decoder.decode(table.definition(number))
+    return decoder.decode(payload)
+
+
+class BinaryCodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        table, decoder = NameTable(), BinaryDecoder()
+        for message in MESSAGES:
+            self.assertEqual(round_trip(message, table, decoder), message)
+
+    def test_values_that_do_not_fit_travel_as_json(self):
+        table, decoder = NameTable(), BinaryDecoder()
+        message = {"type": "TEXT_MESSAGE", "room": "general", "sender": "alice",
+                   "message": "hi", "time": "yesterday", "seq": -1, "extra": [1, 2]}
+        self.assertEqual(round_trip(message, table, decoder), message)
+        transfer = {"type": "FILE_ACK", "status": "ready", "transfer": "NOT-HEX"}
+        self.assertEqual(round_trip(transfer, table, decoder), transfer)
+
+    def test_types_without_a_schema(self):
+        self.assertIsNone(encode({"type": "CONNECTION_SUCCESS"}, NameTable()))
+
+    def test_varints(self):
+        for value in (0, 1, 127, 128, 300, 1 << 35):
+            out = bytearray()
+            write_uint(out, value)
+            self.assertEqual(read_uint(out, 0), (value, len(out)))
+
+    def test_names_are_interned_once(self):
+        table = NameTable()
+        first = encode(MESSAGES[0], table)[0]
+        second = encode(MESSAGES[0], table)[0]
+        self.assertEqual(first, second)
+        self.assertEqual(table.names, ["general", "alice"])
+
+    def test_unknown_name_is_an_error(self):
+        payload, _ = encode(MESSAGES[0], NameTable())
+        with self.assertRaises(ValueError):
+            BinaryDecoder().decode(payload)
+
+    def test_truncated_message_is_an_error(self):
+        table, decoder = NameTable(), BinaryDecoder()
+        payload, used = encode(MESSAGES[0], table)
+        for number in used:
+            decoder.decode(table.definition(number))
+        with self.assertRaises(ValueError):
+            decoder.decode(payload[:-3])
+
+
+class NameLimitTest(unittest.TestCase):
+    def test_names_past_the_limit_go_inline(self):
+        table = NameTable(limit=2)
+        decoder = BinaryDecoder(max_names=2)
+        message = {"type": "USER_LIST", "room": "r", "users": ["a", "b", "c", "d"], "version": 1}
+        self.assertEqual(round_trip(message, table, decoder), message)
+        self.assertEqual(table.names, ["r", "a"])
+        self.assertIsNone(table.intern("b"))
+
+    def test_text_limit(self):
+        table = NameTable(max_chars=5)
+        self.assertEqual(table.intern("abc"), 0)
+        self.assertIsNone(table.intern("def"))
+        self.assertEqual(table.intern("de"), 1)
+
+    def test_decoder_refuses_names_past_its_limits(self):
+        table = NameTable()
+        for n in range(3):
+            table.intern(f"user{n}")
+        decoder = BinaryDecoder(max_names=2)
+        decoder.decode(table.definition(1))
+        with self.assertRaises(ValueError):
+            decoder.decode(table.definition(2))
+        decoder = BinaryDecoder(max_chars=6)
+        decoder.decode(table.definition(0))
+        with self.assertRaises(ValueError):
+            decoder.decode(table.definition(1))
+
+    def test_client_frames_stay_within_the_server_caps(self):
+        table = NameTable(limit=MAX_CLIENT_NAMES)
+        decoder = FrameDecoder(server_side=True)
+        users = [f"user{n}" for n in range(MAX_CLIENT_NAMES + 10)]
+        message = {"type": "USER_LIST", "room": "general", "users": users, "version": 1}
+        decoder.feed(encode_binary_message(message, table))
+        received = [m for m in decoder.messages() if m['type'] != 'INTERN']
+        self.assertEqual(received, [message])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import unittest
+
+from compression import (MessageCompressor, MessageDecompressor, compress_chunk, decompress_chunk,
+                         negotiate, worth_compressing)
+from protocol import FrameDecoder, chunk_data, encode_compressed, encode_data, encode_message
+
+MESSAGES = [{"type": "TEXT_MESSAGE", "room": "general", "sender": "alice", "message": str(n)}
+            for n in range(20)]
+
+
+class NegotiationTest(unittest.TestCase):
+    def test_codecs_both_sides_have(self):
+        self.assertEqual(negotiate(["lzma", "brotli", "zlib"]), ["zlib", "lzma"])
+        self.assertEqual(negotiate(["brotli"]), [])
+        self.assertEqual(negotiate("zlib"), [])
+        self.assertEqual(negotiate(None), [])
+
+    def test_compressed_file_types_are_left_alone(self):
+        self.assertFalse(worth_compressing("photo.JPG"))
+        self.assertTrue(worth_compressing("notes.txt"))
+
+
+class MessageStreamTest(unittest.TestCase):
+    def test_batches_share_one_stream(self):
+        compressor = MessageCompressor()
+        decoder = FrameDecoder()
+        for start in range(0, len(MESSAGES), 5):
+            frames = [encode_message(m, True) for m in MESSAGES[start:start + 5]]
+            decoder.feed(encode_compressed(compressor.compress(frames)))
+        self.assertEqual(list(decoder.messages()), MESSAGES)
+
+    def test_inflating_past_the_limit(self):
+        data = MessageCompressor().compress([b'x' * 10000])
+        with self.assertRaises(ValueError):
+            MessageDecompressor().decompress(data, 1000)
+
+    def test_garbage(self):
+        with self.assertRaises(ValueError):
+            MessageDecompressor().decompress(b'not zlib at all', 1000)
+
+
+class ChunkTest(unittest.TestCase):
+    def test_round_trip(self):
+        data = b'hello world ' * 1000
+        for codec in ("zlib", "lzma"):
+            packed = compress_chunk(codec, data)
+            self.assertLess(len(packed), len(data))
+            self.assertEqual(decompress_chunk(codec, packed, len(data)), data)
+
+    def test_incompressible_chunk_is_sent_as_it_is(self):
+        self.assertIsNone(compress_chunk("zlib", os.urandom(4096)))
+
+    def test_limits_and_errors(self):
+        packed = compress_chunk("zlib", b'x' * 10000)
+        for codec, data, limit in (("zlib", packed, 100), ("zlib", packed[:-4], 10000),
+                                   ("lzma", packed, 10000), ("brotli", packed, 10000)):
+            with self.assertRaises(ValueError):
+                decompress_chunk(codec, data, limit)
+
+    def test_compressed_data_frame(self):
+        data = b'abc' * 5000
+        decoder = FrameDecoder()
+        decoder.feed(encode_data(1, 0, data, "zlib"))
+        message = decoder.next_message()
+        self.assertTrue(message['compressed'])
+        self.assertEqual(chunk_data(message, "zlib", len(data)), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import os
+import tempfile
+import unittest
+
+from filestore import FileStore
+
+
+class FileStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.store = FileStore(self.root.name)
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def upload(self, data):
+        upload = self.store.begin()
+        upload.write(data)
+        return upload.commit()
+
+    def test_identical_uploads_share_one_inode(self):
+        data = os.urandom(1 << 20)
+        first_id, first = self.upload(data)
+        blob = self.store.blob_path(first_id)
+        links = os.stat(blob).st_nlink
+        second_id, second = self.upload(data)
+        self.assertEqual(first_id, second_id)
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        self.assertEqual(os.stat(blob).st_ino, os.stat(second).st_ino)
+        self.assertEqual(os.stat(blob).st_nlink, links + 1)
+        self.assertEqual(os.listdir(self.store.tmp_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
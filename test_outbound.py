@@ -0,0 +1,125 @@
+import unittest
+
+from outbound import (DISCONNECT, DROP_NON_CRITICAL, DROP_OLDEST, OutboundQueue,
+                      ThreadedOutboundQueue, send_buffers)
+from protocol import EncodedEvent, FrameDecoder
+
+
+def message(text):
+    return (text.encode('utf-8'),)
+
+
+class SlowConsumerTest(unittest.TestCase):
+    def test_below_the_limits_nothing_is_dropped(self):
+        queue = OutboundQueue(max_bytes=100, max_messages=3)
+        for n in range(3):
+            self.assertTrue(queue.append(message(f"m{n}"), "TEXT_MESSAGE"))
+        self.assertEqual(queue.dropped, 0)
+        self.assertEqual(len(queue.items), 3)
+
+    def test_drop_oldest(self):
+        queue = OutboundQueue(max_bytes=100, max_messages=3, policy=DROP_OLDEST)
+        for n in range(5):
+            self.assertTrue(queue.append(message(f"m{n}"), "TEXT_MESSAGE"))
+        self.assertEqual([item[0] for item in queue.items], [message(f"m{n}") for n in (2, 3, 4)])
+        self.assertEqual(queue.dropped, 2)
+        self.assertEqual(queue.queued_bytes, 6)
+
+    def test_drop_oldest_keeps_pinned_messages(self):
+        queue = OutboundQueue(max_bytes=100, max_messages=2, policy=DROP_OLDEST)
+        queue.append(message("ack"), "FILE_ACK")
+        queue.append(message("a"), "TEXT_MESSAGE")
+        queue.append(message("b"), "TEXT_MESSAGE")
+        self.assertEqual([item[2] for item in queue.items], ["FILE_ACK", "TEXT_MESSAGE"])
+        self.assertEqual(queue.items[1][0], message("b"))
+
+    def test_drop_non_critical(self):
+        queue = OutboundQueue(max_bytes=100, max_messages=2, policy=DROP_NON_CRITICAL)
+        queue.append(message("a"), "TEXT_MESSAGE")
+        queue.append(message("list"), "USER_LIST")
+        self.assertTrue(queue.append(message("b"), "TEXT_MESSAGE"))
+        self.assertEqual([item[2] for item in queue.items], ["TEXT_MESSAGE", "TEXT_MESSAGE"])
+        # Only chat is left, which this policy never drops
+        self.assertFalse(queue.append(message("c"), "TEXT_MESSAGE"))
+
+    def test_disconnect(self):
+        queue = OutboundQueue(max_bytes=100, max_messages=2, policy=DISCONNECT)
+        self.assertTrue(queue.append(message("a"), "SYSTEM_MESSAGE"))
+        self.assertTrue(queue.append(message("b"), "SYSTEM_MESSAGE"))
+        self.assertFalse(queue.append(message("c"), "SYSTEM_MESSAGE"))
+        self.assertEqual(queue.dropped, 0)
+
+    def test_byte_limit(self):
+        queue = OutboundQueue(max_bytes=10, max_messages=100, policy=DROP_OLDEST)
+        queue.append((b'x' * 6,), "TEXT_MESSAGE")
+        self.assertTrue(queue.append((b'y' * 6,), "TEXT_MESSAGE"))
+        self.assertEqual(queue.queued_bytes, 6)
+        self.assertEqual(queue.items[0][0], (b'y' * 6,))
+
+    def test_evicts_when_only_pinned_data_is_left(self):
+        queue = OutboundQueue(max_bytes=10, max_messages=100, policy=DROP_OLDEST)
+        self.assertTrue(queue.append((b'x' * 10,), None))
+        self.assertFalse(queue.append((b'y',), None))
+
+    def test_closed_queue_refuses(self):
+        queue = ThreadedOutboundQueue()
+        queue.close()
+        self.assertFalse(queue.put(message("a"), "TEXT_MESSAGE"))
+        self.assertEqual(queue.get_batch(), [])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            OutboundQueue(policy="ignore")
+
+
+class TrickleSocket:
+    # Accepts at most limit bytes per sendmsg, like a socket with a full buffer
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = bytearray()
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        sent = bytes(b''.join(buffers))[:self.limit]
+        self.data += sent
+        return len(sent)
+
+
+class CoalescingTest(unittest.TestCase):
+    def test_recipients_share_the_encoded_buffers(self):
+        event = EncodedEvent({"type": "TEXT_MESSAGE", "message": "hi"})
+        first, second = event.segments(True), event.segments(True)
+        self.assertIs(first[0], second[0])
+        self.assertIs(first[1], second[1])
+        self.assertEqual(event.segments(False), (event.payload,))
+
+    def test_batch_holds_everything_queued(self):
+        queue = ThreadedOutboundQueue()
+        events = [EncodedEvent({"type": "TEXT_MESSAGE", "message": str(n)}) for n in range(5)]
+        for event in events:
+            queue.put(event.segments(True), "TEXT_MESSAGE")
+        batch = queue.get_batch(coalesce_window=0.001)
+        decoder = FrameDecoder()
+        decoder.feed(b''.join(batch))
+        self.assertEqual(list(decoder.messages()), [event.message for event in events])
+        self.assertEqual(queue.queued_bytes, 0)
+
+    def test_legacy_queue_writes_one_message_at_a_time(self):
+        queue = ThreadedOutboundQueue()
+        queue.coalesce = False
+        queue.put(message("a"), "TEXT_MESSAGE")
+        queue.put(message("b"), "TEXT_MESSAGE")
+        self.assertEqual(queue.get_batch(coalesce_window=0.001), [b'a'])
+        self.assertEqual(queue.get_batch(coalesce_window=0.001), [b'b'])
+
+    def test_send_buffers_resumes_after_partial_writes(self):
+        buffers = [b'header', b'', b'payload', b'x' * 100]
+        sock = TrickleSocket(7)
+        send_buffers(sock, buffers)
+        self.assertEqual(bytes(sock.data), b''.join(buffers))
+        self.assertEqual(sock.calls, 17)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import json
+import unittest
+import zlib
+
+from protocol import (FrameDecoder, JSONStreamDecoder, LegacyDecoder, ProtocolError, chunk_data,
+                      encode_data, encode_frame, encode_message, parse_handshake)
+
+MESSAGES = [
+    {"type": "TEXT_MESSAGE", "room": "general", "sender": "alice", "message": "hi"},
+    {"type": "USER_LIST", "users": ["alice", "bob"], "nested": {"a": [1, {"b": "}"}]}},
+    {"type": "WHISPER", "sender": "bob", "target": "alice", "message": "héllo ✓"},
+]
+
+
+class FrameDecoderTest(unittest.TestCase):
+    def test_round_trip(self):
+        decoder = FrameDecoder()
+        decoder.feed(b''.join(encode_message(m, True) for m in MESSAGES))
+        self.assertEqual(list(decoder.messages()), MESSAGES)
+        self.assertEqual(decoder.buffered(), 0)
+
+    def test_one_byte_at_a_time(self):
+        stream = b''.join(encode_message(m, True) for m in MESSAGES)
+        decoder = FrameDecoder()
+        received = []
+        for n in range(len(stream)):
+            decoder.feed(stream[n:n + 1])
+            received.extend(decoder.messages())
+        self.assertEqual(received, MESSAGES)
+
+    def test_incomplete_frame_waits(self):
+        frame = encode_message(MESSAGES[0], True)
+        decoder = FrameDecoder()
+        decoder.feed(frame[:-1])
+        self.assertIsNone(decoder.next_message())
+        decoder.feed(frame[-1:])
+        self.assertEqual(decoder.next_message(), MESSAGES[0])
+
+    def test_oversized_frame(self):
+        decoder = FrameDecoder(max_frame_size=16)
+        decoder.feed(encode_frame(b'x' * 17))
+        with self.assertRaises(ProtocolError):
+            decoder.next_message()
+
+    def test_take_raw_after_frame(self):
+        decoder = FrameDecoder()
+        decoder.feed(encode_message(MESSAGES[0], True) + b'file body')
+        self.assertEqual(decoder.next_message(), MESSAGES[0])
+        self.assertEqual(decoder.take_raw(4), b'file')
+        self.assertEqual(decoder.take_raw(100), b' body')
+        self.assertEqual(decoder.take_raw(100), b'')
+
+    def test_data_frame(self):
+        decoder = FrameDecoder()
+        decoder.feed(encode_data(7, 65536, b'chunk') + encode_message(MESSAGES[0], True))
+        message = decoder.next_message()
+        self.assertEqual((message['type'], message['stream'], message['offset'], message['data']),
+                         ('DATA', 7, 65536, b'chunk'))
+        self.assertEqual(message['crc'], zlib.crc32(b'chunk'))
+        self.assertEqual(chunk_data(message), b'chunk')
+        self.assertEqual(decoder.next_message(), MESSAGES[0])
+
+    def test_corrupt_data_frame(self):
+        decoder = FrameDecoder()
+        frame = bytearray(encode_data(1, 0, b'chunk'))
+        frame[-1] ^= 0xff
+        decoder.feed(bytes(frame))
+        self.assertIsNone(chunk_data(decoder.next_message()))
+
+
+class LegacyDecoderTest(unittest.TestCase):
+    def test_one_message_per_recv(self):
+        decoder = LegacyDecoder()
+        decoder.feed(encode_message(MESSAGES[0]))
+        self.assertEqual(list(decoder.messages()), [MESSAGES[0]])
+
+    def test_drops_what_does_not_parse(self):
+        decoder = LegacyDecoder()
+        decoder.feed(encode_message(MESSAGES[0])[:5])
+        self.assertEqual(list(decoder.messages()), [])
+        self.assertEqual(decoder.buffered(), 0)
+
+
+class JSONStreamDecoderTest(unittest.TestCase):
+    def test_several_messages_split_anywhere(self):
+        stream = b''.join(encode_message(m) for m in MESSAGES)
+        for split in range(1, len(stream)):
+            decoder = JSONStreamDecoder()
+            decoder.feed(stream[:split])
+            received = list(decoder.messages())
+            decoder.feed(stream[split:])
+            received.extend(decoder.messages())
+            self.assertEqual(received, MESSAGES)
+
+    def test_take_raw_returns_bytes_unchanged(self):
+        body = bytes(range(256))
+        decoder = JSONStreamDecoder()
+        decoder.feed(encode_message(MESSAGES[0]) + body)
+        self.assertEqual(decoder.next_message(), MESSAGES[0])
+        self.assertEqual(decoder.take_raw(len(body)), body)
+
+
+class HandshakeTest(unittest.TestCase):
+    def test_pipelined_bytes_are_left_over(self):
+        hello = {"nickname": "alice", "framing": "length-prefixed"}
+        frame = encode_message(MESSAGES[0], True)
+        parsed, leftover = parse_handshake(json.dumps(hello).encode('utf-8') + frame)
+        self.assertEqual(parsed, hello)
+        self.assertEqual(leftover, frame)
+
+
+if __name__ == '__main__':
+    unittest.main()
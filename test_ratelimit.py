@@ -0,0 +1,91 @@
+import unittest
+from unittest import mock
+
+from ratelimit import DEFAULT_LIMITS, RateLimiter, TokenBucket, parse_limits
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class RateLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('ratelimit.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def text(self):
+        return {"type": "TEXT_MESSAGE", "message": "hi"}
+
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=2, burst=4)
+        for _ in range(4):
+            self.assertEqual(bucket.wait(1), 0.0)
+            bucket.take(1)
+        self.assertAlmostEqual(bucket.wait(1), 0.5)
+        self.clock.now += 0.5
+        self.assertEqual(bucket.wait(1), 0.0)
+
+    def test_refill_stops_at_the_burst(self):
+        bucket = TokenBucket(rate=2, burst=4)
+        bucket.take(4)
+        self.clock.now += 60
+        bucket.wait(0)
+        self.assertEqual(bucket.tokens, 4)
+
+    def test_messages_over_the_burst_are_delayed_then_rejected(self):
+        limiter = RateLimiter({"text": (2, 3)}, max_delay=1.0)
+        for _ in range(3):
+            self.assertEqual(limiter.admit(self.text()), 0.0)
+        self.assertAlmostEqual(limiter.admit(self.text()), 0.5)
+        self.assertAlmostEqual(limiter.admit(self.text()), 1.0)
+        # Another would have to wait 1.5 s
+        self.assertIsNone(limiter.admit(self.text()))
+        # The delayed ones left the bucket two tokens in debt; the rejected
+        # one cost nothing
+        self.clock.now += 1.0
+        self.assertAlmostEqual(limiter.admit(self.text()), 0.5)
+
+    def test_kinds_are_separate_but_share_the_total(self):
+        limiter = RateLimiter({"messages": (1, 3), "text": (1, 1)}, max_delay=0)
+        self.assertEqual(limiter.admit(self.text()), 0.0)
+        self.assertIsNone(limiter.admit(self.text()))
+        self.assertEqual(limiter.admit({"type": "WHISPER"}), 0.0)
+        self.assertEqual(limiter.admit({"type": "JOIN"}), 0.0)
+        self.assertIsNone(limiter.admit({"type": "JOIN"}))
+
+    def test_file_bytes_are_only_delayed(self):
+        limiter = RateLimiter({"file_bytes": (1000, 1000)}, max_delay=0)
+        self.assertEqual(limiter.file_bytes(1000), 0.0)
+        self.assertAlmostEqual(limiter.file_bytes(5000), 5.0)
+        self.assertAlmostEqual(limiter.admit({"type": "DATA", "data": b'x' * 1000}), 6.0)
+
+    def test_no_limits(self):
+        limiter = RateLimiter({"text": (0, 0)})
+        for _ in range(1000):
+            self.assertEqual(limiter.admit(self.text()), 0.0)
+
+    def test_notice_once_per_interval(self):
+        limiter = RateLimiter(DEFAULT_LIMITS)
+        self.assertTrue(limiter.notice())
+        self.assertFalse(limiter.notice())
+        self.clock.now += 1.0
+        self.assertTrue(limiter.notice())
+
+    def test_parse_limits(self):
+        limits = parse_limits(["text=2", "file_bytes=1048576/4194304"])
+        self.assertEqual(limits["text"], (2.0, 2.0))
+        self.assertEqual(limits["file_bytes"], (1048576.0, 4194304.0))
+        self.assertEqual(limits["whisper"], DEFAULT_LIMITS["whisper"])
+        for spec in ("bogus=1", "text=", "text=-1"):
+            with self.assertRaises(ValueError):
+                parse_limits([spec])
+
+
+if __name__ == '__main__':
+    unittest.main()
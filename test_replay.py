@@ -0,0 +1,70 @@
+import unittest
+from unittest import mock
+
+from replay import ReplayBuffer
+
+
+class ReplayBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('replay.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def seqs(self, events):
+        return None if events is None else [event[0] for event in events]
+
+    def test_events_after_seq_across_audiences(self):
+        buffer = ReplayBuffer(window=60)
+        buffer.add(1, ["#general"], "a", "TEXT_MESSAGE")
+        buffer.add(2, ["@alice", "@bob"], "b", "WHISPER")
+        buffer.add(3, ["#other"], "c", "TEXT_MESSAGE")
+        buffer.add(4, ["#general", "@alice"], "d", "FILE_AVAILABLE")
+        self.assertEqual(self.seqs(buffer.since(["#general", "@alice"], 0)), [1, 2, 4])
+        self.assertEqual(self.seqs(buffer.since(["#general", "@alice"], 2)), [4])
+        self.assertEqual(buffer.since(["#general"], 4), [])
+        self.assertEqual(buffer.since(["#general"], 1)[0][2:], ("d", "FILE_AVAILABLE"))
+
+    def test_ring_size(self):
+        buffer = ReplayBuffer(window=60, size=3)
+        for seq in range(1, 6):
+            buffer.add(seq, ["#general"], seq, "TEXT_MESSAGE")
+        # 1 and 2 are gone: resuming from before them leaves a gap
+        self.assertIsNone(buffer.since(["#general"], 0))
+        self.assertIsNone(buffer.since(["#general"], 1))
+        self.assertEqual(self.seqs(buffer.since(["#general"], 2)), [3, 4, 5])
+
+    def test_gap_in_one_audience_fails_the_resume(self):
+        buffer = ReplayBuffer(window=60, size=2)
+        buffer.add(1, ["@alice"], 1, "WHISPER")
+        for seq in range(2, 5):
+            buffer.add(seq, ["#general"], seq, "TEXT_MESSAGE")
+        self.assertEqual(self.seqs(buffer.since(["@alice"], 0)), [1])
+        self.assertIsNone(buffer.since(["@alice", "#general"], 1))
+
+    def test_resume_past_the_window(self):
+        buffer = ReplayBuffer(window=60)
+        buffer.add(1, ["#general"], 1, "TEXT_MESSAGE")
+        self.now += 30
+        buffer.add(2, ["#general"], 2, "TEXT_MESSAGE")
+        self.now += 45
+        buffer.prune(self.now)
+        # The first event aged out; the second is still within the window
+        self.assertIsNone(buffer.since(["#general"], 0))
+        self.assertEqual(self.seqs(buffer.since(["#general"], 1)), [2])
+        self.now += 60
+        buffer.prune(self.now)
+        self.assertEqual(buffer.rings, {})
+        self.assertEqual(buffer.evicted, {})
+
+    def test_pruned_every_so_often(self):
+        buffer = ReplayBuffer(window=1)
+        buffer.add(1, ["#old"], 1, "TEXT_MESSAGE")
+        self.now += 10
+        with mock.patch('replay.PRUNE_EVERY', 2):
+            buffer.add(2, ["#new"], 2, "TEXT_MESSAGE")
+        self.assertEqual(list(buffer.rings), ["#new"])
+
+
+if __name__ == '__main__':
+    unittest.main()
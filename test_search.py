@@ -0,0 +1,85 @@
+import time
+import unittest
+
+from search import SearchIndex
+
+
+class MemoryHistory:
+    # The parts of HistoryLog the index uses, over a list
+    def __init__(self, records=()):
+        self.records = list(records)
+        self.on_append = None
+        self.on_compact = None
+
+    def scan(self):
+        return iter(self.records)
+
+    def fetch(self, seq, key):
+        for record_seq, _, keys, message in self.records:
+            if record_seq == seq and key in keys:
+                return dict(message, seq=seq)
+        return None
+
+
+def message(seq, room, text, sender="alice"):
+    return (seq, float(seq), ["#" + room], {"type": "TEXT_MESSAGE", "room": room,
+                                             "sender": sender, "message": text})
+
+
+def whisper(seq, sender, target, text):
+    return (seq, float(seq), ["@" + sender, "@" + target],
+            {"type": "WHISPER", "sender": sender, "target": target, "message": text})
+
+
+class SearchIndexTest(unittest.TestCase):
+    def index(self, records):
+        index = SearchIndex(MemoryHistory(records))
+        # The rebuild thread indexes the records
+        deadline = time.monotonic() + 30
+        while not index.ready and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(index.ready)
+        return index
+
+    def seqs(self, results):
+        return [m['seq'] for m in results]
+
+    def test_searches_every_audience_newest_first(self):
+        index = self.index([
+            message(1, "general", "hello world"),
+            message(2, "quiet", "hello there"),
+            whisper(3, "bob", "me", "hello you"),
+            message(4, "other", "hello all"),
+            whisper(5, "me", "me", "hello self"),
+        ])
+        results, cursor = index.search("hello", ["#quiet", "#general", "@me"])
+        self.assertEqual(self.seqs(results), [5, 3, 2, 1])
+        self.assertIsNone(cursor)
+
+    def test_pages_and_floors(self):
+        records = [message(seq, "general", f"hello {seq}") for seq in range(1, 11)]
+        records.append(whisper(11, "bob", "me", "hello"))
+        index = self.index(records)
+        floors = {"@me": 11}
+        results, cursor = index.search("hello", ["#general", "@me"], limit=4, floors=floors)
+        self.assertEqual(self.seqs(results), [10, 9, 8, 7])
+        results, cursor = index.search("hello", ["#general", "@me"], before=cursor, limit=4,
+                                       floors=floors)
+        self.assertEqual(self.seqs(results), [6, 5, 4, 3])
+        results, cursor = index.search("hello", ["#general", "@me"], before=cursor, limit=4,
+                                       floors=floors)
+        self.assertEqual(self.seqs(results), [2, 1])
+        self.assertIsNone(cursor)
+
+    def test_no_visible_matches_in_a_large_index(self):
+        records = [message(seq, "busy", "hello again") for seq in range(1, 200001)]
+        records.append(message(200001, "quiet", "nothing to see"))
+        records.append(whisper(200002, "bob", "me", "still nothing"))
+        index = self.index(records)
+        index.history = None
+        results, cursor = index.search("hello", ["#quiet", "@me"])
+        self.assertEqual((results, cursor), ([], None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+from unittest import mock
+
+from timerwheel import SLOTS, TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        # One tick a second keeps the arithmetic exact
+        self.wheel = TimerWheel(0, tick=1)
+        self.fired = []
+
+    def schedule(self, delay, name):
+        return self.wheel.schedule(0, delay, lambda: self.fired.append(name))
+
+    def run_until(self, now):
+        # Advance one tick at a time, noting when each callback came back
+        fired_at = {}
+        for tick in range(now + 1):
+            for callback in self.wheel.advance(tick):
+                callback()
+                fired_at[self.fired[-1]] = tick
+        return fired_at
+
+    def test_fires_on_its_tick(self):
+        self.schedule(0, "now")
+        self.schedule(3, "soon")
+        self.assertEqual(self.run_until(10), {"now": 0, "soon": 3})
+
+    def test_rounds_up_to_the_next_tick(self):
+        self.wheel.schedule(0, 2.5, lambda: self.fired.append("late"))
+        self.assertEqual(self.run_until(5), {"late": 3})
+
+    def test_cascades_down_the_levels(self):
+        delays = [SLOTS - 1, SLOTS, SLOTS + 5, SLOTS * 3 + 7, SLOTS ** 2 + 1, SLOTS ** 2 * 2 + 3]
+        for delay in delays:
+            self.schedule(delay, delay)
+        fired_at = self.run_until(max(delays) + 1)
+        self.assertEqual(fired_at, {delay: delay for delay in delays})
+
+    def test_advancing_several_ticks_at_once(self):
+        self.schedule(5, "a")
+        self.schedule(SLOTS * 2, "b")
+        self.assertEqual(self.wheel.advance(4), [])
+        self.assertEqual(len(self.wheel.advance(SLOTS * 2)), 2)
+
+    def test_cancel(self):
+        timer = self.schedule(5, "cancelled")
+        self.schedule(6, "kept")
+        self.wheel.cancel(timer)
+        self.wheel.cancel(timer)
+        self.assertEqual(self.run_until(10), {"kept": 6})
+
+    def test_cancel_after_cascading(self):
+        timer = self.schedule(SLOTS * 2 + 10, "cancelled")
+        self.run_until(SLOTS * 2)
+        # By now the timer has moved down to level 0
+        self.assertEqual(timer.slot, self.wheel.levels[0][10])
+        self.wheel.cancel(timer)
+        self.assertEqual(self.run_until(SLOTS * 3), {})
+
+    def test_beyond_the_top_level(self):
+        # A small wheel, so running past its range stays quick
+        with mock.patch('timerwheel.SLOTS', 4), mock.patch('timerwheel.LEVELS', 2):
+            self.wheel = TimerWheel(0, tick=1)
+            timer = self.schedule(4 ** 2 * 3 + 5, "far")
+            self.assertIn(timer, self.wheel.levels[1][3])
+            self.assertEqual(self.run_until(4 ** 2 * 3 + 10), {"far": 4 ** 2 * 3 + 5})
+
+if __name__ == '__main__':
+    unittest.main()
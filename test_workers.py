@@ -0,0 +1,57 @@
+import json
+import os
+import socket
+import tempfile
+import time
+import unittest
+
+from protocol import FRAMING
+from workers import EventBusClient, EventBusHub
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class EventBusTest(unittest.TestCase):
+    def setUp(self):
+        # The server keeps its files under the working directory
+        self.root = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.root.name)
+        self.hub = EventBusHub(os.path.join(self.root.name, "bus.sock"))
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        self.hub.close()
+        os.chdir(self.cwd)
+        self.root.cleanup()
+
+    def worker(self, worker):
+        from server import ChatServer
+        server = ChatServer('127.0.0.1', 0, history_keep=0, resume_grace=0, rate_limits={},
+                            ping_interval=0, log_max_bytes=0)
+        server.bus = EventBusClient(self.hub.path, worker, server.dispatch_bus_event)
+        return server
+
+    def connect(self, server, nickname):
+        ours, theirs = socket.socketpair()
+        self.sockets += [ours, theirs]
+        hello = json.dumps({"nickname": nickname, "framing": FRAMING}).encode('utf-8')
+        server.register_client(theirs, hello, ('test', len(self.sockets)))
+
+    def test_late_worker_gets_earlier_users(self):
+        first = self.worker(0)
+        self.connect(first, "alice")
+        second = self.worker(1)
+        self.assertTrue(wait_for(lambda: second.remote_users.get(0, {}).get("alice") == 1))
+        self.assertEqual(second.whisper_route("alice"), [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import threading
+
+# Connection timers (handshake deadlines, heartbeats) on a hierarchical
+# timing wheel instead of a socket timeout or an OS timer each. Time moves
+# in ticks; level 0 has a slot per tick for the next SLOTS ticks, and each
+# level above has slots SLOTS times as wide. A timer goes in the lowest
+# level its deadline fits in; whenever a level comes round to slot 0, the
+# next slot of the level above is emptied into the ones below. Scheduling
+# and cancelling are O(1), and so is a tick, apart from the timers that
+# expire or move down in it: tens of thousands of idle connections cost
+# nothing until their own deadline.
+#
+# The wheel only keeps time: its owner calls advance() every tick or so and
+# runs the callbacks that come back.
+
+TICK = 0.1
+SLOTS = 64
+LEVELS = 4
+
+
+class Timer:
+    def __init__(self, due, callback):
+        self.due = due
+        self.callback = callback
+        self.slot = None
+
+
+class TimerWheel:
+    def __init__(self, now, tick=TICK):
+        self.tick = tick
+        self.origin = now
+        self.lock = threading.Lock()
+        # The next tick to run
+        self.ticks = 0
+        self.levels = [[set() for _ in range(SLOTS)] for _ in range(LEVELS)]
+
+    def schedule(self, now, delay, callback):
+        # callback runs once delay seconds from now have passed; rounded up
+        # to the next tick
+        due = -int(-(now + delay - self.origin) // self.tick)
+        timer = Timer(due, callback)
+        with self.lock:
+            self.place(timer)
+        return timer
+
+    def cancel(self, timer):
+        with self.lock:
+            if timer.slot is not None:
+                timer.slot.discard(timer)
+                timer.slot = None
+
+    def place(self, timer):
+        # Caller holds the lock
+        due = max(timer.due, self.ticks)
+        delta = due - self.ticks
+        for level in range(LEVELS):
+            if delta < SLOTS ** (level + 1) or level == LEVELS - 1:
+                # Deadlines past the top level wait in its furthest slot
+                # and are placed again from there
+                due = min(due, self.ticks + SLOTS ** LEVELS - 1)
+                slot = self.levels[level][due // SLOTS ** level % SLOTS]
+                break
+        timer.slot = slot
+        slot.add(timer)
+
+    def advance(self, now):
+        # The callbacks of every timer due by now, tick by tick
+        target = int((now - self.origin) // self.tick)
+        expired = []
+        with self.lock:
+            while self.ticks <= target:
+                if self.ticks % SLOTS == 0:
+                    self.cascade()
+                slot = self.levels[0][self.ticks % SLOTS]
+                for timer in slot:
+                    timer.slot = None
+                    expired.append(timer.callback)
+                slot.clear()
+                self.ticks += 1
+        return expired
+
+    def cascade(self):
+        # Level 0 just came round: bring down the next slot of each level
+        # above that came round as well
+        for level in range(1, LEVELS):
+            index = self.ticks // SLOTS ** level % SLOTS
+            slot = self.levels[level][index]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self.place(timer)
+            if index != 0:
+                break
@@ -0,0 +1,187 @@
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import tempfile
+import threading
+from protocol import FrameDecoder, encode_frame, encode_message
+from eventlog import ERROR, WARNING, event_log
+from filestore import FileStore
+
+# Multi-process mode: N worker processes each run a full ChatServer on the
+# same port (SO_REUSEPORT lets the kernel spread new connections across
+# them), so chat handling is no longer limited to one core by the GIL.
+#
+# Workers stay in sync through a local event bus: a hub in the parent process
+# accepts one Unix-socket connection per worker and relays every event a
+# worker publishes (room messages, whispers, presence changes, new files) to
+# all the others as length-prefixed JSON frames. When a worker joins, the
+# hub asks the others for a "sync" snapshot of their users, rooms and files
+# ("sync_request"), so a worker started late, or restarted, is not left
+# without what happened before it. When a worker's bus connection drops
+# the hub tells the rest with a "peer_lost" event.
+#
+# Sessions are not shared: a resume token is only known to the worker that
+# issued it, and the kernel usually hands the reconnect to another one, so
+# with --workers a dropped client comes back as a new session.
+
+
+def bus_path(port):
+    return os.path.join(tempfile.gettempdir(), f"chat-bus-{port}.sock")
+
+
+class EventBusHub:
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(path)
+        self.server_socket.listen()
+
+        self.lock = threading.Lock()
+        self.peers = {}
+        self.running = True
+        threading.Thread(target=self.accept_peers, daemon=True).start()
+
+    def accept_peers(self):
+        while self.running:
+            try:
+                peer, _ = self.server_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handle_peer, args=(peer,), daemon=True).start()
+
+    def handle_peer(self, peer):
+        worker = None
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = peer.recv(65536)
+                if not data:
+                    break
+                decoder.feed(data)
+                while True:
+                    frame = decoder.next_frame()
+                    if frame is None:
+                        break
+                    if worker is None:
+                        # First frame is the worker's hello
+                        worker = json.loads(frame.decode('utf-8'))['worker']
+                        with self.lock:
+                            self.peers[peer] = threading.Lock()
+                        self.relay(peer, encode_message({"kind": "sync_request", "origin": worker},
+                                                        True))
+                        continue
+                    self.relay(peer, encode_frame(frame))
+        except ConnectionResetError:
+            pass
+        except (OSError, ValueError) as e:
+            event_log.log("bus_error", f"Bus peer error: {str(e)}", WARNING, error=str(e))
+        finally:
+            with self.lock:
+                self.peers.pop(peer, None)
+            peer.close()
+            if worker is not None:
+                self.relay(None, encode_message({"kind": "peer_lost", "origin": worker}, True))
+
+    def relay(self, source, data):
+        with self.lock:
+            peers = [(p, lock) for p, lock in self.peers.items() if p is not source]
+        for peer, lock in peers:
+            try:
+                with lock:
+                    peer.sendall(data)
+            except OSError:
+                pass
+
+    def close(self):
+        self.running = False
+        self.server_socket.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class EventBusClient:
+    def __init__(self, path, worker, on_event, on_lost=None):
+        self.worker = worker
+        self.on_event = on_event
+        self.on_lost = on_lost
+        self.lock = threading.Lock()
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.socket.sendall(encode_message({"worker": worker}, True))
+        threading.Thread(target=self.receive_events, daemon=True).start()
+
+    def publish(self, event):
+        event["origin"] = self.worker
+        data = encode_message(event, True)
+        try:
+            with self.lock:
+                self.socket.sendall(data)
+        except OSError as e:
+            event_log.log("bus_error", f"Bus publish error: {str(e)}", WARNING, error=str(e))
+
+    def receive_events(self):
+        decoder = FrameDecoder()
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            decoder.feed(data)
+            for event in decoder.messages():
+                # Directed events (whispers) only concern the workers they name
+                if 'to' in event and self.worker not in event['to']:
+                    continue
+                self.on_event(event)
+        event_log.log("bus_lost", f"Worker {self.worker} lost the event bus", ERROR,
+                      worker=self.worker)
+        if self.on_lost:
+            self.on_lost()
+
+
+def run_worker(args, worker, path):
+    # Imported here so each worker builds its server after the fork
+    from server import create_server, run_server
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Cut off from the bus, this worker's clients would silently stop seeing
+    # everyone else, so it goes down with the parent instead
+    server = create_server(args, reuse_port=True, worker=worker, connect_bus=lambda server:
+                           EventBusClient(path, worker, server.dispatch_bus_event,
+                                          on_lost=lambda: os.kill(os.getpid(), signal.SIGTERM)))
+    event_log.log("worker_ready", f"Worker {worker} (pid {os.getpid()}) ready", worker=worker,
+                  pid=os.getpid())
+    run_server(server)
+
+
+def run_workers(args):
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit("--workers needs SO_REUSEPORT, which this platform does not support")
+
+    # Let "kill <parent>" take the workers down with it
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    # Links left by an earlier run, cleared once for all workers (see
+    # filestore.py); ChatServer keeps its files in server_files
+    FileStore("server_files").clear_links()
+
+    path = bus_path(args.port)
+    hub = EventBusHub(path)
+    processes = []
+    for worker in range(args.workers):
+        process = multiprocessing.Process(target=run_worker, args=(args, worker, path), daemon=True)
+        process.start()
+        processes.append(process)
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+    finally:
+        hub.close()